@@ -0,0 +1,123 @@
+from collections import namedtuple
+from contextlib import closing
+import json
+import os
+import re
+import sqlite3
+from fileman.local_dir import get_local_path, make_file_dir
+
+__author__ = 'peter'
+
+"""
+A lightweight index of saved experiment records.
+
+Every saved ExperimentRecord gets a row in a small SQLite database in the experiments directory, containing just the
+summary information (name, version, time, status, duration, key scores).  This lets us list, filter and find the
+latest experiments without scanning the directory and unpickling every record.
+"""
+
+INDEX_FILE_NAME = 'experiment_index.db'
+
+ExperimentIndexEntry = namedtuple('ExperimentIndexEntry', ['identifier', 'name', 'version', 'timestamp', 'status', 'duration', 'scores'])
+
+_COLUMNS = ExperimentIndexEntry._fields
+
+
+def get_experiment_index_path():
+    return os.path.join(get_local_path('experiments'), INDEX_FILE_NAME)
+
+
+def experiment_index_exists():
+    return os.path.exists(get_experiment_index_path())
+
+
+def _connect():
+    index_path = make_file_dir(get_experiment_index_path())
+    conn = sqlite3.connect(index_path)
+    conn.text_factory = str
+    conn.create_function('REGEXP', 2, lambda expr, item: re.match(expr, item) is not None)
+    conn.execute('CREATE TABLE IF NOT EXISTS experiments (identifier TEXT PRIMARY KEY, name TEXT, version TEXT, '
+        'timestamp TEXT, status TEXT, duration REAL, scores TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS experiments_by_name ON experiments (name, timestamp)')
+    conn.execute('CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY)')
+    return conn
+
+
+def create_experiment_index():
+    with closing(_connect()):
+        pass
+
+
+def add_experiment_to_index(identifier, name, version = None, timestamp = None, status = None, duration = None, scores = None):
+    """
+    Add (or replace) the summary of an experiment in the index.
+    :param identifier: The string uniquely identifying the experiment record
+    :param name: The name of the experiment
+    :param version: Optionally, the version of the experiment that was run
+    :param timestamp: A datetime indicating when the experiment started
+    :param status: A string indicating how the experiment ended, e.g. 'finished' or 'error'
+    :param duration: Duration of the experiment, in seconds
+    :param scores: A dict<str: float> of key scores produced by the experiment
+    """
+    with closing(_connect()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?)', (
+            identifier,
+            name,
+            None if version is None else str(version),
+            None if timestamp is None else timestamp.isoformat(),
+            status,
+            duration,
+            json.dumps(scores if scores is not None else {})
+            ))
+
+
+def index_has_flag(flag):
+    """
+    :param flag: The name of a flag (e.g. marking that some one-off maintenance of the index has been done)
+    :return: True if the flag has been set on the index.
+    """
+    with closing(_connect()) as conn:
+        return conn.execute('SELECT 1 FROM flags WHERE name = ?', (flag, )).fetchone() is not None
+
+
+def set_index_flag(flag):
+    with closing(_connect()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO flags VALUES (?)', (flag, ))
+
+
+def get_indexed_identifiers():
+    """
+    :return: A list of the identifiers of all experiments in the index.
+    """
+    with closing(_connect()) as conn:
+        return [row[0] for row in conn.execute('SELECT identifier FROM experiments').fetchall()]
+
+
+def remove_experiments_from_index(identifiers):
+    with closing(_connect()) as conn, conn:
+        conn.executemany('DELETE FROM experiments WHERE identifier = ?', [(i, ) for i in identifiers])
+
+
+def get_experiment_index_entries(name = None, expr = None, latest_first = False):
+    """
+    :param name: Optionally, only return entries for experiments with this name
+    :param expr: Optionally, a regexp which experiment identifiers must match
+    :param latest_first: Order the entries from latest to earliest (otherwise, earliest to latest)
+    :return: A list<ExperimentIndexEntry>
+    """
+    conditions, args = [], []
+    if name is not None:
+        conditions.append('name = ?')
+        args.append(name)
+    if expr is not None:
+        conditions.append('identifier REGEXP ?')
+        args.append(expr)
+    query = 'SELECT %s FROM experiments%s ORDER BY timestamp %s, identifier %s' % (
+        ', '.join(_COLUMNS),
+        ' WHERE '+' AND '.join(conditions) if len(conditions) > 0 else '',
+        'DESC' if latest_first else 'ASC',
+        'DESC' if latest_first else 'ASC',
+        )
+    with closing(_connect()) as conn:
+        rows = conn.execute(query, args).fetchall()
+    return [ExperimentIndexEntry(*(row[:-1]+(json.loads(row[-1]), ))) for row in rows]
@@ -2,11 +2,15 @@ from collections import OrderedDict
 from datetime import datetime
 import inspect
 import shlex
+from time import time
 from IPython.core.magics import logging
 from general.test_mode import is_test_mode, TestMode
 import os
 import pickle
+import sys
 from IPython.core.display import display, HTML
+from fileman.experiment_index import add_experiment_to_index, get_experiment_index_entries, \
+    remove_experiments_from_index, get_indexed_identifiers, index_has_flag, set_index_flag
 from fileman.local_dir import format_filename, make_file_dir, get_local_path, get_relative_path
 from fileman.notebook_plots import show_embedded_figure
 from fileman.notebook_utils import get_local_server_dir
@@ -57,10 +61,12 @@ class ExperimentRecord(object):
 
     exp_1.show_all_figures()
     """
-    VERSION = 0  # We keep this in case we want to change this class, and need record the fact that it is an old version
-    # when unpickling.
+    VERSION = 2  # We keep this in case we want to change this class, and need record the fact that it is an old version
+    # when unpickling.  Version 0 records stored their logs in the pickle, version 1 records read them lazily from the log
+    # file, version 2 records can be checkpointed and resumed.
 
-    def __init__(self, name = 'unnamed', filename = '%T-%N', print_to_console = False, save_result = None, show_figs = None):
+    def __init__(self, name = 'unnamed', filename = '%T-%N', print_to_console = False, save_result = None, show_figs = None,
+            version = None, checkpoint_interval = 0):
         """
         :param name: Base-name of the experiment
         :param filename: Format of the filename (placeholders: %T is replaced by time, %N by name)
@@ -71,6 +77,8 @@ class ExperimentRecord(object):
             'draw': Show but keep on going
             False: Don't show figures
             None: 'draw' if in test mode, else 'hang'
+        :param version: Optionally, the version of the experiment being run (this is recorded in the experiment index)
+        :param checkpoint_interval: Minimum time, in seconds, between writing checkpoints to disk (see checkpoint).
         """
         now = datetime.now()
         if save_result is None:
@@ -87,45 +95,130 @@ class ExperimentRecord(object):
         self._print_to_console = print_to_console
         self._save_result = save_result
         self._show_figs = show_figs
+        self._name = name
+        self._version = version
+        self._start_time = now
+        self._duration = None
+        self._status = None
+        self._scores = OrderedDict()
+        self._captured_logs = None
+        self._captured_figure_locs = []
+        self._checkpoint_data = OrderedDict()
+        self._checkpoint_interval = checkpoint_interval
+        self._log_offset = 0
 
     def __enter__(self):
+        # If this record was loaded from a checkpoint (see Experiment.run(resume=True)), we continue where it left off:
+        # Logs written after the last checkpoint are dropped (since that work will be redone), and new logs are appended.
+        resuming = self._status is not None
         clear_saved_figure_locs()
         if self._show_figs == 'draw':
             plt.ion()
         else:
             plt.ioff()
-        self._log_file_path = capture_print(True, to_file = True, log_file_path = self._log_file_name, print_to_console = self._print_to_console)
+        if resuming:
+            with open(get_local_path(self._log_file_path), 'r+') as f:
+                f.truncate(self._log_offset)
+        self._log_file_path = capture_print(True, to_file = True, log_file_path = self._log_file_name, print_to_console = self._print_to_console, append = resuming)
         always_save_figures(show = self._show_figs, print_loc = False, name = self._experiment_identifier+'-%N')
         global _CURRENT_EXPERIMENT
-        _CURRENT_EXPERIMENT = self._experiment_identifier
+        _CURRENT_EXPERIMENT = self
+        self._previous_figure_locs = list(self._captured_figure_locs) if resuming else []
+        self._previous_duration = self._duration if resuming else 0
+        self._has_run = False
+        self._enter_time = self._last_checkpoint_time = time()
         return self
 
-    def __exit__(self, *args):
-        # On exit, we read the log file.  After this, the log file is no longer associated with the experiment.
+    def __exit__(self, exc_type = None, *args):
+        # On exit, we stop capturing the logs.  After this, the log file is no longer associated with the experiment,
+        # but we keep its path so that the logs can be read when they're requested.
         capture_print(False)
 
-        with open(get_local_path(self._log_file_path)) as f:
-            self._captured_logs = f.read()
-
         set_show_callback(None)
-        self._captured_figure_locs = get_saved_figure_locs()
+        self._captured_figure_locs = self._previous_figure_locs + list(get_saved_figure_locs())
 
         self._has_run = True
+        self._duration = self._previous_duration + time() - self._enter_time
+        self._status = 'finished' if exc_type is None else 'error'
 
         global _CURRENT_EXPERIMENT
         _CURRENT_EXPERIMENT = None
 
         if self._save_result:
-            file_path = get_local_experiment_path(self._experiment_identifier)
-            make_file_dir(file_path)
-            with open(file_path, 'w') as f:
-                pickle.dump(self, f)
-                print 'Saving Experiment "%s"' % (self._experiment_identifier, )
+            self._save()
+            print 'Saving Experiment "%s"' % (self._experiment_identifier, )
+
+    def _save(self):
+        # Write to a temporary file first, so that a crash while saving does not destroy the last checkpoint.
+        file_path = get_local_experiment_path(self._experiment_identifier)
+        make_file_dir(file_path)
+        with open(file_path+'.tmp', 'w') as f:
+            pickle.dump(self, f)
+        os.rename(file_path+'.tmp', file_path)
+        add_experiment_to_index(identifier = self._experiment_identifier, name = self._name, version = self._version,
+            timestamp = self._start_time, status = self._status, duration = self._duration, scores = self._scores)
+
+    def checkpoint(self, **checkpoint_data):
+        """
+        Save the progress of a running experiment, so that if it crashes it can be resumed with Experiment.run(resume=True).
+        The checkpoint contains the position in the log file, the figures saved so far, and the given data.
+
+        e.g.
+            exp_rec.checkpoint(learning_curve = record, params = dumps_params(predictor), epoch = epoch)
+
+        :param checkpoint_data: Named, picklable objects representing intermediate results (e.g. LearningCurveData, or
+            parameters serialized with plato.interfaces.param_serialization.dumps_params).  These are added to the data
+            from previous checkpoints, and can be retrieved with get_checkpoint_data.
+        """
+        self._checkpoint_data.update(checkpoint_data)
+        if not self._save_result or time() - self._last_checkpoint_time < self._checkpoint_interval:
+            return
+        sys.stdout.flush()  # This is our PrintAndStoreLogger
+        self._log_offset = os.path.getsize(get_local_path(self._log_file_path))
+        self._captured_figure_locs = self._previous_figure_locs + list(get_saved_figure_locs())
+        self._duration = self._previous_duration + time() - self._enter_time
+        self._status = 'running'
+        self._save()
+        self._last_checkpoint_time = time()
+
+    def get_checkpoint_data(self):
+        """
+        :return: An OrderedDict of the data saved with checkpoint (including data from before the experiment was resumed).
+        """
+        return self._checkpoint_data
+
+    def get_status(self):
+        """
+        :return: None if the experiment has not yet run, otherwise 'running' (if it was saved at a checkpoint and never
+            completed), 'finished' or 'error'.
+        """
+        return self._status
+
+    def __getstate__(self):
+        # Don't pickle the logs - they stay in the log file and are loaded when requested.
+        state = self.__dict__.copy()
+        state['_captured_logs'] = None
+        return state
+
+    def add_score(self, name, value):
+        """
+        Record a key score for this experiment.  Scores are saved in the experiment index, so they can be inspected
+        without loading the experiment record.
+        :param name: Name of the score (e.g. 'test_accuracy')
+        :param value: A scalar
+        """
+        self._scores[name] = float(value)
+
+    def get_scores(self):
+        return self._scores
 
     def get_identifier(self):
         return self._experiment_identifier
 
     def get_logs(self):
+        if self._captured_logs is None:
+            with open(get_local_path(self._log_file_path)) as f:
+                self._captured_logs = f.read()
         return self._captured_logs
 
     def get_figure_locs(self):
@@ -148,7 +241,7 @@ class ExperimentRecord(object):
         self.show_figures()
 
     def print_logs(self):
-        print self._captured_logs
+        print self.get_logs()
 
     def get_file_path(self):
         return get_local_experiment_path(self._experiment_identifier)
@@ -170,7 +263,38 @@ def get_current_experiment_id():
     """
     if _CURRENT_EXPERIMENT is None:
         raise Exception("No experiment is currently running!")
-    return _CURRENT_EXPERIMENT
+    return _CURRENT_EXPERIMENT.get_identifier()
+
+
+def save_experiment_checkpoint(**checkpoint_data):
+    """
+    Checkpoint the currently running experiment (see ExperimentRecord.checkpoint).  If no experiment is running, this
+    does nothing, so it's safe to call from code that may also be run outside of an experiment.
+    """
+    if _CURRENT_EXPERIMENT is not None:
+        _CURRENT_EXPERIMENT.checkpoint(**checkpoint_data)
+
+
+def load_experiment_checkpoint(name, default = None):
+    """
+    Get data saved with save_experiment_checkpoint.  When an experiment is resumed, use this to find out what work has
+    already been done.
+    :param name: The name that the data was saved under.
+    :param default: What to return if there is no such data, or if no experiment is running.
+    :return: The saved data
+    """
+    if _CURRENT_EXPERIMENT is None:
+        return default
+    return _CURRENT_EXPERIMENT.get_checkpoint_data().get(name, default)
+
+
+def add_experiment_score(name, value):
+    """
+    Record a key score for the currently running experiment.  See ExperimentRecord.add_score
+    """
+    if _CURRENT_EXPERIMENT is None:
+        raise Exception("No experiment is currently running!")
+    _CURRENT_EXPERIMENT.add_score(name, value)
 
 
 def start_experiment(*args, **kwargs):
@@ -295,12 +419,11 @@ def get_latest_experiment_identifier(name, template = '%T-%N'):
     named_template = template.replace('%N', re.escape(name))
     expr = named_template.replace('%T', '\d\d\d\d\.\d\d\.\d\d\T\d\d\.\d\d\.\d\d\.\d\d\d\d\d\d')
     expr = '^' + expr + '$'
-    matching_experiments = get_all_experiment_ids(expr)
-    if len(matching_experiments) == 0:
-        return None
-    else:
-        latest_experiment_id = sorted(matching_experiments)[-1]
-        return latest_experiment_id
+    entries = _get_index_entries(name = name if '%N' in template else None, expr = expr, latest_first = True)
+    for e in entries:
+        if _record_exists(e.identifier):
+            return e.identifier
+    return None
 
 
 def show_latest_results(experiment_name, template = '%T-%N'):
@@ -323,18 +446,88 @@ def load_experiment(experiment_identifier):
     return exp
 
 
+def get_resumable_experiment_identifier(name):
+    """
+    :param name: The name of the experiment record
+    :return: The identifier of the latest record with this name, if it did not finish (ie it crashed or was interrupted
+        after saving a checkpoint).  Otherwise None.
+    """
+    for e in _get_index_entries(name = name, latest_first = True):
+        if _record_exists(e.identifier):
+            return e.identifier if e.status in ('running', 'error') else None
+    return None
+
+
 def get_all_experiment_ids(expr = None):
     """
     :param expr: A regexp for matching experiments
         None if you just want all of them
     :return: A list of experiment identifiers.
     """
+    return [e.identifier for e in get_experiment_summaries(expr)]
+
+
+def get_experiment_summaries(expr = None, name = None):
+    """
+    Get the summaries of saved experiments from the experiment index, without loading the records themselves.
+    :param expr: A regexp for matching experiment identifiers, or None if you just want all of them
+    :param name: Optionally, only return experiments with this name
+    :return: A list<ExperimentIndexEntry>, ordered from earliest to latest.
+    """
+    return _get_index_entries(name = name, expr = expr)
+
+
+# Set on the index once it has been built from the records in the experiments directory
+_INDEX_BUILT_FLAG = 'built_from_experiments_directory'
+
+
+def delete_experiment(identifier):
+    """
+    Delete a saved experiment record, and its entry in the experiment index.
+    :param identifier: The string identifying the experiment
+    """
+    os.remove(get_local_experiment_path(identifier))
+    remove_experiments_from_index([identifier])
+
 
+def _get_index_entries(**kwargs):
+    """
+    Get entries from the experiment index (see get_experiment_index_entries).  The first time the index is read, records
+    saved before it existed are added to it (see rebuild_experiment_index).
+    """
+    if not index_has_flag(_INDEX_BUILT_FLAG):
+        rebuild_experiment_index()
+    return get_experiment_index_entries(**kwargs)
+
+
+def _record_exists(identifier):
+    """
+    Check that an indexed record still exists, and drop it from the index if it doesn't (ie if its file was deleted
+    without going through delete_experiment).
+    """
+    if os.path.exists(get_local_experiment_path(identifier)):
+        return True
+    remove_experiments_from_index([identifier])
+    return False
+
+
+def rebuild_experiment_index():
+    """
+    Bring the index in line with the experiments directory: add records which are missing from it (e.g. ones saved
+    before we had an index, or copied in from elsewhere), and remove entries whose records no longer exist.  Records are
+    not loaded - the name and time of added records are parsed from the identifier.  This is done automatically the
+    first time the index is read.
+    """
     expdir = get_local_path('experiments')
-    experiments = [e[:-len('.exp.pkl')] for e in os.listdir(expdir) if e.endswith('.exp.pkl')]
-    if expr is not None:
-        experiments = [e for e in experiments if re.match(expr, e)]
-    return experiments
+    saved = set(e[:-len('.exp.pkl')] for e in os.listdir(expdir) if e.endswith('.exp.pkl')) if os.path.isdir(expdir) else set()
+    indexed = set(get_indexed_identifiers())
+    for exp_id in sorted(saved - indexed):
+        match = re.match('^(\d\d\d\d\.\d\d\.\d\dT\d\d\.\d\d\.\d\d\.\d\d\d\d\d\d)-(.*)$', exp_id)
+        name, timestamp = (match.group(2), datetime.strptime(match.group(1), '%Y.%m.%dT%H.%M.%S.%f')) if match else (exp_id, None)
+        add_experiment_to_index(identifier = exp_id, name = name, timestamp = timestamp)
+    if len(indexed - saved) > 0:
+        remove_experiments_from_index(sorted(indexed - saved))
+    set_index_flag(_INDEX_BUILT_FLAG)
 
 
 def register_experiment(name, **kwargs):
@@ -347,9 +540,9 @@ def register_experiment(name, **kwargs):
 
 def browse_experiment_records():
 
-    ids = get_all_experiment_ids()
+    entries = get_experiment_summaries()
     while True:
-        print '\n'.join(['%s: %s' % (i, exp_id) for i, exp_id in enumerate(ids)])
+        print '\n'.join(['%s: %s' % (i, _format_summary(e)) for i, e in enumerate(entries)])
 
         user_input = raw_input('Enter Command (show # to show and experiment, or h for help) >>')
         parts = shlex.split(user_input)
@@ -365,12 +558,12 @@ def browse_experiment_records():
                 wait_for_continue()
             elif cmd == 'filter':
                 filter_text, = args
-                ids = get_all_experiment_ids(filter_text)
+                entries = get_experiment_summaries(filter_text)
             elif cmd == 'rmfilters':
-                ids = get_all_experiment_ids()
+                entries = get_experiment_summaries()
             elif cmd == 'show':
                 index, = args
-                exp_id = ids[int(index)]
+                exp_id = entries[int(index)].identifier
                 show_experiment(exp_id)
                 wait_for_continue()
             else:
@@ -382,6 +575,15 @@ def browse_experiment_records():
                 raise
 
 
+def _format_summary(entry):
+    return '%s  [%s%s]%s' % (
+        entry.identifier,
+        entry.status if entry.status is not None else 'unknown status',
+        ', %.3gs' % (entry.duration, ) if entry.duration is not None else '',
+        '  '+', '.join('%s: %.4g' % (k, v) for k, v in entry.scores.iteritems()) if len(entry.scores) > 0 else ''
+        )
+
+
 def wait_for_continue():
     raw_input('<Press Enter to Continue>')
 
@@ -410,29 +612,37 @@ class Experiment(object):
         return 'Experiment: %s\n  Defined in: %s\n  Description: %s\n  Conclusion: %s' % \
             (self.name, inspect.getmodule(self.function).__name__, self.description, self.conclusion)
 
-    def run(self, print_to_console = True, show_figs = None, test_mode=False, **experiment_record_kwargs):
+    def run(self, print_to_console = True, show_figs = None, test_mode=False, resume = False, **experiment_record_kwargs):
         """
         Run the experiment, and return the ExperimentRecord that is generated.
         Note, if you want the output of the function, you should just run the function directly.
+        :param resume: If True, and the latest record of this experiment did not finish, continue that record from its
+            last checkpoint.  The experiment function can use load_experiment_checkpoint to skip work that was already done.
         :param experiment_record_kwargs: See ExperimentRecord for kwargs
         """
         if self.versions is not None:
             assert self.current_version in self.versions, "Experiment %s: Your current version: '%s' is not in the list of versions: %s" % (self.name, self.current_version, self.versions.keys())
             kwargs = self.versions[self.current_version]
             name = self.name+'-'+(self.current_version if isinstance(self.current_version, str) else str(self.versions[self.current_version]))
+            experiment_record_kwargs.setdefault('version', self.current_version)
         else:
             kwargs = {}
             name = self.name
 
+        resume_id = get_resumable_experiment_identifier(name) if resume else None
+        make_record = lambda: \
+            ExperimentRecord(name = name, print_to_console=print_to_console, show_figs=show_figs, **experiment_record_kwargs) \
+            if resume_id is None else load_experiment(resume_id)
+
         if test_mode:
             with TestMode():
                 print '%s Testing Experiment: %s %s' % ('='*10, name, '='*10)
-                with ExperimentRecord(name = name, print_to_console=print_to_console, show_figs=show_figs, **experiment_record_kwargs) as exp_rec:
+                with make_record() as exp_rec:
                     self.function(**kwargs)
                 print '%s Done Testing Experiment: %s %s' % ('-'*11, name, '-'*12)
         else:
-            print '%s Running Experiment: %s %s' % ('='*10, name, '='*10)
-            with ExperimentRecord(name = name, print_to_console=print_to_console, show_figs=show_figs, **experiment_record_kwargs) as exp_rec:
+            print '%s %s Experiment: %s %s' % ('='*10, 'Running' if resume_id is None else 'Resuming', name, '='*10)
+            with make_record() as exp_rec:
                 self.function(**kwargs)
             print '%s Done Experiment: %s %s' % ('-'*11, name, '-'*12)
         return exp_rec
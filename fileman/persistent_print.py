@@ -1,6 +1,9 @@
+import atexit
 from datetime import datetime
 import sys
 from StringIO import StringIO
+from threading import Thread, Lock, Event
+from weakref import WeakSet
 from IPython.core.display import display, HTML
 from fileman.local_dir import get_local_path, make_file_dir, format_filename
 from fileman.notebook_utils import get_relative_link_from_local_path, get_relative_link_from_relative_path
@@ -21,24 +24,63 @@ http://stackoverflow.com/questions/4675728/redirect-stdout-to-a-file-in-python
 _ORIGINAL_STDOUT = sys.stdout
 _ORIGINAL_STDERR = sys.stderr
 
+# Loggers with files that are still open.  These are closed (so their buffers are written out) when the program exits.
+_OPEN_LOGGERS = WeakSet()
+
+
+@atexit.register
+def _close_open_loggers():
+    for logger in list(_OPEN_LOGGERS):
+        logger.close()
+
 
 class PrintAndStoreLogger(object):
     """
     An logger that both prints to stdout and writes to file.
+
+    Writes to the file are buffered, and the buffer is written out by a background thread every flush_interval seconds,
+    or as soon as it holds more than buffer_size characters.  The buffer is also written out when the logger is closed,
+    read, or when the program exits (even if it exits with an error).
     """
 
-    def __init__(self, log_file_path = None, print_to_console = True):
+    def __init__(self, log_file_path = None, print_to_console = True, flush_interval = 1., buffer_size = 65536,
+            max_file_size = None, n_rotations = 0, append = False):
+        """
+        :param log_file_path: Path to the log file, or None to just store the log in memory
+        :param print_to_console: True to also print to the console
+        :param flush_interval: Maximum time (in seconds) that text waits in the buffer before being written to file
+        :param buffer_size: Number of characters we allow in the buffer before writing to file.
+        :param max_file_size: Optionally, the maximum size (in bytes) of the log file.  When the log reaches this size,
+            it is rotated (if n_rotations > 0), or else further logs are dropped.
+        :param n_rotations: Number of old log files to keep when rotating.  Old logs are saved at "<log_file_path>.1",
+            "<log_file_path>.2", ... with higher numbers being older.
+        :param append: Append to the log file if it already exists (otherwise it is overwritten).
+        """
 
         self._print_to_console = print_to_console
 
         if log_file_path is not None:
             # self._log_file_path = os.path.join(base_dir, log_file_path.replace('%T', now))
             make_file_dir(log_file_path)
-            self.log = open(log_file_path, 'w')
+            self.log = open(log_file_path, 'a' if append else 'w')
         else:
             self.log = StringIO()
         self._log_file_path = log_file_path
         self.terminal = _ORIGINAL_STDOUT
+        self._buffer = []
+        self._buffered_chars = 0
+        self._buffer_size = buffer_size
+        self._max_file_size = max_file_size
+        self._n_rotations = n_rotations
+        self._file_size = os.path.getsize(log_file_path) if log_file_path is not None else 0
+        self._lock = Lock()
+        self._closed = Event()
+        if log_file_path is not None:
+            self._flush_interval = flush_interval
+            self._flush_thread = Thread(target = self._flush_periodically, name = 'PrintAndStoreLogger-flush')
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+            _OPEN_LOGGERS.add(self)
 
     def get_log_file_path(self):
         return self._log_file_path
@@ -46,17 +88,74 @@ class PrintAndStoreLogger(object):
     def write(self, message):
         if self._print_to_console:
             self.terminal.write(message)
-        self.log.write(message)
+        if self._log_file_path is None:
+            self.log.write(message)
+        else:
+            with self._lock:
+                self._buffer.append(message)
+                self._buffered_chars += len(message)
+                buffer_full = self._buffered_chars >= self._buffer_size
+            if buffer_full:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered text to the log file.
+        """
+        if self._log_file_path is None:
+            return
+        with self._lock:
+            if self._buffered_chars == 0 or self.log.closed:
+                return
+            text = ''.join(self._buffer)
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')  # So that file sizes are counted in bytes
+            self._buffer = []
+            self._buffered_chars = 0
+            if self._max_file_size is not None:
+                # Fill as many new files as we need to fit the text (the last n_rotations of which are kept)
+                while self._n_rotations > 0 and self._max_file_size > 0 and self._file_size + len(text) > self._max_file_size:
+                    if self._file_size > 0:
+                        self._rotate()
+                    else:
+                        self._write_to_file(text[:self._max_file_size])
+                        text = text[self._max_file_size:]
+                text = text[:max(0, self._max_file_size - self._file_size)]
+            self._write_to_file(text)
+
+    def _write_to_file(self, text):
+        self.log.write(text)
         self.log.flush()
+        self._file_size += len(text)
+
+    def _rotate(self):
+        self.log.close()
+        for i in xrange(self._n_rotations-1, 0, -1):
+            if os.path.exists('%s.%s' % (self._log_file_path, i)):
+                os.rename('%s.%s' % (self._log_file_path, i), '%s.%s' % (self._log_file_path, i+1))
+        os.rename(self._log_file_path, self._log_file_path+'.1')
+        self.log = open(self._log_file_path, 'w')
+        self._file_size = 0
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self._flush_interval):
+            self.flush()
 
     def close(self):
-        if self._log_file_path is not None:
-            self.log.close()
+        if self._log_file_path is not None and not self._closed.is_set():
+            self._closed.set()
+            _OPEN_LOGGERS.discard(self)
+            self._flush_thread.join()
+            self.flush()
+            with self._lock:
+                os.fsync(self.log.fileno())
+                self.log.close()
 
     def read(self):
         if self._log_file_path is None:
             return self.log.getvalue()
         else:
+            self.flush()
             with open(self._log_file_path) as f:
                 txt = f.read()
             return txt
@@ -74,6 +173,9 @@ def capture_print(state = True, to_file = False, log_file_path = 'dump/%T-log',
     :return: The relative path to the logger.
     """
 
+    if isinstance(sys.stdout, PrintAndStoreLogger):
+        sys.stdout.close()
+
     if state:
         rel_log_file_path = format_filename(log_file_path, current_time = datetime.now(), directory='logs', ext = 'txt')
         local_log_file_path = get_local_path(rel_log_file_path)
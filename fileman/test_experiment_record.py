@@ -2,9 +2,18 @@ import time
 from general.test_mode import set_test_mode
 import os
 import pickle
+import sys
+from StringIO import StringIO
 from fileman.experiment_record import ExperimentRecord, start_experiment, run_experiment, show_experiment, \
     get_latest_experiment_identifier, get_or_run_notebook_experiment, get_local_experiment_path, register_experiment, \
-    get_experiment_info, load_experiment
+    get_experiment_info, load_experiment, add_experiment_score, get_experiment_summaries, Experiment, \
+    save_experiment_checkpoint, load_experiment_checkpoint, get_all_experiment_ids, delete_experiment, \
+    rebuild_experiment_index
+from fileman.experiment_index import get_experiment_index_path
+from fileman import local_dir
+from contextlib import contextmanager
+import shutil
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -125,10 +134,114 @@ def test_experiment_interface():
     assert same_exp_rec.get_logs() == 'aaa\nbbb\n'
 
 
+def test_experiment_index():
+
+    with ExperimentRecord(name = 'test_experiment_index', save_result = True) as exp_rec:
+        print 'aaa'
+        add_experiment_score('accuracy', 0.9)
+
+    summary, = [s for s in get_experiment_summaries(name = 'test_experiment_index') if s.identifier == exp_rec.get_identifier()]
+    assert summary.status == 'finished'
+    assert summary.duration >= 0
+    assert summary.scores == {'accuracy': 0.9}
+
+    # Logs are not stored in the record, but read from the log file when requested
+    with open(exp_rec.get_file_path()) as f:
+        exp_rec_copy = pickle.load(f)
+    assert exp_rec_copy._captured_logs is None
+    assert exp_rec_copy.get_logs() == 'aaa\n'
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        exp_rec_copy.print_logs()
+        printed = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    assert printed == 'aaa\n\n'
+
+    delete_experiment(exp_rec.get_identifier())
+    assert not os.path.exists(exp_rec.get_file_path())
+    assert exp_rec.get_identifier() not in [s.identifier for s in get_experiment_summaries(name = 'test_experiment_index')]
+
+
+@contextmanager
+def _temporary_local_dir():
+    """ Keep the experiments (and index) that a test creates out of the real data directory. """
+    old_local_dir = local_dir.LOCAL_DIR
+    local_dir.LOCAL_DIR = tempfile.mkdtemp()
+    try:
+        yield local_dir.LOCAL_DIR
+    finally:
+        shutil.rmtree(local_dir.LOCAL_DIR)
+        local_dir.LOCAL_DIR = old_local_dir
+
+
+def test_experiment_index_upgrade():
+
+    with _temporary_local_dir():
+        # Records saved before the index existed are picked up, even after a later save has created the index
+        with ExperimentRecord(name = 'test_experiment_index_upgrade_old', save_result = True) as old_rec:
+            print 'old'
+        os.remove(get_experiment_index_path())
+        with ExperimentRecord(name = 'test_experiment_index_upgrade_new', save_result = True) as new_rec:
+            print 'new'
+        assert get_all_experiment_ids() == [old_rec.get_identifier(), new_rec.get_identifier()]
+        assert get_latest_experiment_identifier('test_experiment_index_upgrade_old') == old_rec.get_identifier()
+
+        # Records deleted behind the index's back are dropped when they're found to be missing, or on a rebuild
+        os.remove(old_rec.get_file_path())
+        assert get_latest_experiment_identifier('test_experiment_index_upgrade_old') is None
+        assert get_all_experiment_ids() == [new_rec.get_identifier()]
+        os.remove(new_rec.get_file_path())
+        rebuild_experiment_index()
+        assert get_all_experiment_ids() == []
+
+
+def test_resume_experiment():
+
+    completed_steps = []
+    crash_at = [2]
+
+    def experiment_with_steps():
+        for i in xrange(load_experiment_checkpoint('n_steps_done', default = 0), 4):
+            print 'Step %s' % (i, )
+            completed_steps.append(i)
+            if i == crash_at[0]:
+                raise Exception('Crash!')
+            save_experiment_checkpoint(n_steps_done = i+1)
+
+    exp = Experiment(function = experiment_with_steps, name = 'test_resume_experiment')
+    try:
+        exp.run(save_result = True, resume = True)
+        raise AssertionError('Experiment should have crashed')
+    except Exception as err:
+        assert err.message == 'Crash!'
+    assert completed_steps == [0, 1, 2]
+    first_identifier = get_latest_experiment_identifier('test_resume_experiment')
+    assert load_experiment(first_identifier).get_status() == 'error'
+
+    crash_at[0] = None
+    exp_rec = exp.run(save_result = True, resume = True)
+    assert completed_steps == [0, 1, 2, 2, 3]  # Steps 0 and 1 were not redone
+    assert exp_rec.get_identifier() == first_identifier
+    assert exp_rec.get_status() == 'finished'
+    assert exp_rec.get_logs() == 'Step 0\nStep 1\nStep 2\nStep 3\n'
+
+    # The experiment finished, so a new run starts from scratch
+    exp_rec_2 = exp.run(save_result = True, resume = True)
+    assert completed_steps == [0, 1, 2, 2, 3, 0, 1, 2, 3]
+    os.remove(exp_rec.get_file_path())
+    os.remove(exp_rec_2.get_file_path())
+
+
 if __name__ == '__main__':
 
     set_test_mode(True)
 
+    test_resume_experiment()
+
+    test_experiment_index()
+    test_experiment_index_upgrade()
+
     test_experiment_interface()
     test_get_or_run_experiment()
     test_get_latest()
@@ -1,6 +1,9 @@
 from fileman.local_dir import get_local_path
 import os
-from fileman.persistent_print import capture_print, read_print, new_log_file
+from fileman.persistent_print import capture_print, read_print, new_log_file, PrintAndStoreLogger
+import time
+import weakref
+import gc
 
 __author__ = 'peter'
 
@@ -38,7 +41,81 @@ def test_new_log_file():
     os.remove(local_log_loc)
 
 
+def test_buffered_logger():
+
+    log_path = get_local_path('dump/test_buffered_logger.txt', make_local_dir=True)
+    logger = PrintAndStoreLogger(log_file_path=log_path, print_to_console=False, flush_interval=0.05, buffer_size=10)
+    logger.write('aaa\n')
+    with open(log_path) as f:
+        assert f.read() == ''  # Still in the buffer
+    time.sleep(0.5)
+    with open(log_path) as f:
+        assert f.read() == 'aaa\n'  # Flushed by the background thread
+    logger.write('bbbbbbbbbb\n')
+    with open(log_path) as f:
+        assert f.read() == 'aaa\nbbbbbbbbbb\n'  # Flushed because the buffer was full
+    logger.write('ccc\n')
+    logger.close()
+    with open(log_path) as f:
+        assert f.read() == 'aaa\nbbbbbbbbbb\nccc\n'
+    os.remove(log_path)
+
+
+def test_log_rotation():
+
+    log_path = get_local_path('dump/test_log_rotation.txt', make_local_dir=True)
+    logger = PrintAndStoreLogger(log_file_path=log_path, print_to_console=False, buffer_size=1, max_file_size=8, n_rotations=2)
+    for line in ['aaa\n', 'bbb\n', 'ccc\n', 'ddd\n', 'eee\n', 'fff\n']:
+        logger.write(line)
+    logger.close()
+    with open(log_path) as f:
+        assert f.read() == 'eee\nfff\n'
+    with open(log_path+'.1') as f:
+        assert f.read() == 'ccc\nddd\n'
+    with open(log_path+'.2') as f:
+        assert f.read() == 'aaa\nbbb\n'
+    for path in [log_path, log_path+'.1', log_path+'.2']:
+        os.remove(path)
+
+    # A flush bigger than the file size is spread over new files, rather than cut off
+    logger = PrintAndStoreLogger(log_file_path=log_path, print_to_console=False, buffer_size=100, max_file_size=8, n_rotations=2)
+    logger.write('aaa\nbbb\n')
+    logger.write('ccc\nddd\neee\n')
+    logger.close()
+    with open(log_path) as f:
+        assert f.read() == 'eee\n'
+    with open(log_path+'.1') as f:
+        assert f.read() == 'aaa\nbbb\nccc\nddd\n'[8:]
+    with open(log_path+'.2') as f:
+        assert f.read() == 'aaa\nbbb\n'
+    for path in [log_path, log_path+'.1', log_path+'.2']:
+        os.remove(path)
+
+    # Sizes are counted in bytes
+    logger = PrintAndStoreLogger(log_file_path=log_path, print_to_console=False, buffer_size=1, max_file_size=8)
+    logger.write(u'\xe9\xe9\xe9\xe9\xe9')
+    logger.close()
+    assert os.path.getsize(log_path) == 8
+    os.remove(log_path)
+
+
+def test_closed_loggers_are_released():
+
+    log_path = get_local_path('dump/test_closed_loggers_are_released.txt', make_local_dir=True)
+    logger = PrintAndStoreLogger(log_file_path=log_path, print_to_console=False)
+    logger_ref = weakref.ref(logger)
+    logger.write('aaa\n')
+    logger.close()
+    del logger
+    gc.collect()
+    assert logger_ref() is None
+    os.remove(log_path)
+
+
 if __name__ == '__main__':
+    test_buffered_logger()
+    test_log_rotation()
+    test_closed_loggers_are_released()
 
     test_persistent_print()
     test_new_log_file()
\ No newline at end of file
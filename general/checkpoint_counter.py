@@ -1,3 +1,5 @@
+import numpy as np
+
 __author__ = 'peter'
 
 
@@ -38,3 +40,28 @@ class CheckPointCounter(object):
                 self._index += 1
 
         return counter, done
+
+
+def get_checkpoint_steps(checkpoints, step_size, unit_size = 1):
+    """
+    A vectorized alternative to CheckPointCounter, for when progress increases by a fixed amount on each step.  Instead
+    of calling check on every step, we compute up front the steps on which checkpoints will be passed.  This is
+    equivalent to calling CheckPointCounter(checkpoints).check(float(i*step_size)/unit_size) on steps i=0, 1, 2, ...,
+    and noting the steps on which points_passed>0.
+
+    :param checkpoints: An increasing sequence of checkpoints
+    :param step_size: Progress made per step (e.g. the minibatch size)
+    :param unit_size: Progress in a unit of the checkpoint scale (e.g. the number of samples in an epoch, if
+        checkpoints are specified in epochs).
+    :return: (steps, points_passed), where:
+        steps is an array of the unique, increasing steps at which one or more checkpoints are passed
+        points_passed is an array of the number of checkpoints passed at each of those steps.
+        The last checkpoint is passed on steps[-1].
+    """
+    checkpoints = np.asarray(checkpoints, dtype = float)
+    steps = np.maximum(np.ceil(checkpoints*unit_size/step_size).astype(int), 0)
+    # Fix any off-by-one steps due to floating point error, so that we match CheckPointCounter exactly.
+    steps += (steps*step_size/float(unit_size) < checkpoints)
+    steps -= (steps > 0) & ((steps-1)*step_size/float(unit_size) >= checkpoints)
+    unique_steps, points_passed = np.unique(steps, return_counts = True)
+    return unique_steps, points_passed
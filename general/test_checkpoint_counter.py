@@ -1,5 +1,6 @@
 from itertools import count
-from general.checkpoint_counter import CheckPointCounter
+from general.checkpoint_counter import CheckPointCounter, get_checkpoint_steps
+import numpy as np
 
 __author__ = 'peter'
 
@@ -24,5 +25,33 @@ def test_checkpoint_counter():
     # More generally len(checkpoints) will be <= len(points)
 
 
+def test_get_checkpoint_steps():
+
+    assert [list(x) for x in get_checkpoint_steps([0, 0.2, 0.4, 0.6, 0.9], step_size = 1, unit_size = 100)] == [[0, 20, 40, 60, 90], [1, 1, 1, 1, 1]]
+
+    # Compare against CheckPointCounter, including cases where several checkpoints fall between steps.
+    rng = np.random.RandomState(1234)
+    for checkpoints, step_size, unit_size in [
+            (np.linspace(0, 3, 21), 7, 30),
+            (np.sqrt(np.linspace(0, 10, 20)), 10, 1000),
+            (np.sort(rng.rand(30)*5), 13, 17),
+            ([0.1, 0.3, 0.30001, 1], 1, 3),
+            ]:
+        cpc = CheckPointCounter(checkpoints)
+        expected_steps = []
+        expected_points_passed = []
+        for i in count(0):
+            points_passed, done = cpc.check(float(i*step_size)/unit_size)
+            if points_passed:
+                expected_steps.append(i)
+                expected_points_passed.append(points_passed)
+                if done:
+                    break
+        steps, points_passed = get_checkpoint_steps(checkpoints, step_size = step_size, unit_size = unit_size)
+        assert list(steps) == expected_steps
+        assert list(points_passed) == expected_points_passed
+
+
 if __name__ == '__main__':
     test_checkpoint_counter()
+    test_get_checkpoint_steps()
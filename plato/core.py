@@ -3,6 +3,7 @@ from functools import partial
 import inspect
 import logging
 import sys
+import time
 from general.local_capture import CaptureLocals
 from general.nested_structures import flatten_struct, expand_struct
 from theano.compile.sharedvalue import SharedVariable
@@ -472,6 +473,7 @@ class AutoCompilingFunction(object):
         self._local_values = None
         self._callbacks = []
         self._add_test_values = add_test_values
+        self.compilation_times = None  # Becomes a dict with 'trace' and 'compile' times (in seconds) on the first call.
 
         # Create convenient debugging functions: showloc() and locinfo()
         __builtins__['showloc'] = show_all_locals
@@ -485,6 +487,7 @@ class AutoCompilingFunction(object):
 
         if self._compiled_fcn is None:  # Need to do first pass and compile.
 
+            trace_start_time = time.time()
             d2t = partial(_data_to_tensor, cast_to_floatx = self._cast_to_floatx, add_test_value = self._add_test_values)
             tensor_args = [d2t(arg) for arg in args]
             tensor_kwargs = OrderedDict((k, d2t(a)) for k, a in kwargs.iteritems())
@@ -513,7 +516,9 @@ class AutoCompilingFunction(object):
                 outputs = outputs+tuple(trace_variables.values())+tuple(self._original_fcn.locals().values())
 
             PLATO_LOGGER.info('Compiling %s...' % (self._original_fcn.fcn_str(), ))
+            compile_start_time = time.time()
             self._compiled_fcn = theano.function(inputs = args_and_kwarg_tensors, outputs = outputs, updates = updates, allow_input_downcast=self._cast_to_floatx)
+            self.compilation_times = {'trace': compile_start_time - trace_start_time, 'compile': time.time() - compile_start_time}
             PLATO_LOGGER.info('Done.\n')
 
         arg_and_kwarg_values = args + tuple(kwargs[k] for k in self._kwarg_order)
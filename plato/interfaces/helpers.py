@@ -1,3 +1,5 @@
+import hashlib
+import sys
 import numpy as np
 from plato.core import symbolic_simple, add_update, create_shared_variable
 from plato.interfaces.interfaces import IParameterized
@@ -38,42 +40,136 @@ class MRG_RandomStreams_ext(MRG_RandomStreams):
             return options[ix]
 
 
-def get_theano_rng(seed, rngtype = 'mrg'):
+STREAM_TYPES = {
+    'mrg': MRG_RandomStreams_ext,
+    'mrg-old': MRG_RandomStreams,
+    'default': RandomStreams,
+    'cuda': CURAND_RandomStreams
+}
+
+
+def get_theano_rng(seed, rngtype = 'mrg', path = None):
     """
     Helper for getting a theano random number generator.  How this is started depends on the form
     of the seed.
 
     :param seed: Can be:
         - An integer, in which case the random number generator is seeded with this..
-        - None, in which case a random seed is chosen
+        - None, in which case a seed is taken from the active RandomStreamService (see below) if there is one, or
+          chosen randomly otherwise.
         - A numpy random number generator, in which case we randomly select a seed from this.
         - A theano random number generator, in which case we just pass it through.
     :param rngtype: The type of random number generator to use.  Options are:
         - 'default': The default theano type (which seems to be slow)
-        - 'mrg': The
+        - 'mrg': The MRG31k3p generator (fast, and works on GPU)
+        - 'mrg-old': MRG without the extra methods of MRG_RandomStreams_ext
+        - 'cuda': CURAND
+    :param path: When seeding from the RandomStreamService, the name that the stream is keyed by (e.g. 'my_rbm/hidden').
+        Defaults to the module that called this function.  Streams that share a path are numbered in the order they are
+        created, so if a module creates several streams (e.g. one per layer), give each a path of its own if you want
+        its seed not to depend on how many were created before it.
     :return:
     """
-
-    stream_types = {
-        'mrg': MRG_RandomStreams_ext,
-        'mrg-old': MRG_RandomStreams,
-        'default': RandomStreams,
-        'cuda': CURAND_RandomStreams
-    }
-    rng_con = stream_types[rngtype]
+    rng_con = STREAM_TYPES[rngtype]
 
     if isinstance(seed, np.random.RandomState):
         return rng_con(seed.randint(1e9))
     elif isinstance(seed, int):
         return rng_con(seed)
     elif seed is None:
+        if _RNG_SERVICE is not None:
+            return _RNG_SERVICE.get_stream(path if path is not None else sys._getframe(1).f_globals['__name__'], rngtype = rngtype)
         return rng_con(np.random.randint(1e9))
-    elif isinstance(seed, tuple(stream_types.values())):
+    elif isinstance(seed, tuple(STREAM_TYPES.values())):
         return seed
     else:
         raise Exception("Can't initialize a random number generator with %s" % (seed, ))
 
 
+def derive_seed(seed, path, worker_id, index):
+    """
+    Counter-based seed derivation: the seed of a substream is a hash of the master seed, the path the stream is keyed by,
+    the worker id and the stream's index along that path.  So a stream's seed depends only on where it is used, and not on
+    how many other streams were created before it (or in other processes).
+
+    :return: An integer seed in [1, 2**31-1), which is valid for all stream types (MRG requires seeds below 2**31-1)
+    """
+    digest = hashlib.md5(repr((seed, path, worker_id, index))).hexdigest()
+    return int(digest[:15], 16) % (2**31-2) + 1
+
+
+_RNG_SERVICE = None
+
+
+class RandomStreamService(object):
+    """
+    A central source of random streams, for reproducible runs (including parallel ones).  Each stream gets its seed from
+    derive_seed(seed, path, worker_id, n), where path names what asks for the stream (by default, the module calling
+    get_theano_rng), and n counts the streams already handed out for that path.  So two runs with the same seed build
+    identical streams, and workers with different ids get independent ones.  Streams on different paths don't affect one
+    another, but streams on the same path do: adding or removing a layer shifts the seeds of all layers of the same
+    module built after it.  Pass a path per object (e.g. StochasticNonlinearity(..., rng_path = 'my_rbm/hidden')) to
+    avoid this.
+
+    Use it as a context manager, and all the models you build inside that get their random streams from it:
+
+        with RandomStreamService(seed = 1234, worker_id = worker_index):
+            rbm = simple_rbm(...)  # Its layers' random streams are seeded by the service
+    """
+
+    def __init__(self, seed = 0, worker_id = 0, rngtype = None):
+        """
+        :param seed: The master seed
+        :param worker_id: Identifies this worker (e.g. a process index) so that parallel workers get independent streams
+        :param rngtype: Optionally, force all streams to be of this type (see get_theano_rng).  If None, streams are of
+            the type that the code asking for them requests.
+        """
+        self.seed = seed
+        self.worker_id = worker_id
+        self.rngtype = rngtype
+        self._counters = {}
+
+    def get_seed(self, path):
+        """
+        :param path: A string identifying what the stream is for (e.g. a module path)
+        :return: A seed for the next stream on this path.
+        """
+        index = self._counters.get(path, 0)
+        self._counters[path] = index + 1
+        return derive_seed(self.seed, path, self.worker_id, index)
+
+    def get_stream(self, path, rngtype = 'mrg'):
+        """
+        :param path: A string identifying what the stream is for (e.g. a module path)
+        :param rngtype: The type of stream (see get_theano_rng), unless the service forces a type.
+        :return: A theano random stream
+        """
+        return STREAM_TYPES[self.rngtype if self.rngtype is not None else rngtype](self.get_seed(path))
+
+    def get_numpy_rng(self, path):
+        """
+        :return: A numpy RandomState for the next stream on the given path
+        """
+        return np.random.RandomState(self.get_seed(path))
+
+    def __enter__(self):
+        global _RNG_SERVICE
+        self._old_service = _RNG_SERVICE
+        _RNG_SERVICE = self
+        return self
+
+    def __exit__(self, *args):
+        global _RNG_SERVICE
+        _RNG_SERVICE = self._old_service
+
+
+def get_rng_service():
+    """
+    :return: The active RandomStreamService, or None if there isn't one.
+    """
+    return _RNG_SERVICE
+
+
 normalize= lambda x, axis = None: x/(x.sum(axis=axis, keepdims = True) + 1e-9)
 
 normalize_safely= lambda x, axis = None, degree = 1: x/((x**degree).sum(axis=axis, keepdims = True) + 1)**(1./degree)
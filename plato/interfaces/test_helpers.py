@@ -1,5 +1,9 @@
 from plato.interfaces.decorators import symbolic_simple
-from plato.interfaces.helpers import MRG_RandomStreams_ext
+from plato.interfaces.helpers import MRG_RandomStreams_ext, RandomStreamService, get_theano_rng, get_rng_service, \
+    derive_seed
+from plato.tools.rbm.rbm_parts import StochasticNonlinearity
+import theano
+import theano.tensor as tt
 import numpy as np
 import pytest
 
@@ -29,6 +33,61 @@ def test_mrg_choice():
     assert all(ixs2 < 10) and len(np.unique(ixs2)) == len(ixs2)
 
 
+def test_random_stream_service():
+
+    def sample_layer():
+        layer = StochasticNonlinearity('bernoulli')
+        x = tt.matrix('x')
+        x.tag.test_value = np.zeros((3, 4))
+        return theano.function([x], layer(x))(np.zeros((20, 30)))
+
+    assert get_rng_service() is None
+    with RandomStreamService(seed = 1234) as service:
+        assert get_rng_service() is service
+        samples_1 = sample_layer()
+        samples_2 = sample_layer()  # The next stream on the same path is a different one
+    assert get_rng_service() is None
+    with RandomStreamService(seed = 1234):
+        assert np.array_equal(sample_layer(), samples_1)
+    with RandomStreamService(seed = 1234, worker_id = 1):
+        assert not np.array_equal(sample_layer(), samples_1)
+    assert not np.array_equal(samples_1, samples_2)
+
+    # Streams depend on their path and index, not on the order they're requested in.
+    with RandomStreamService(seed = 1234) as service:
+        seeds = [service.get_seed('a'), service.get_seed('b'), service.get_seed('a')]
+    with RandomStreamService(seed = 1234) as service:
+        assert [service.get_seed('b'), service.get_seed('a'), service.get_seed('a')] == [seeds[1], seeds[0], seeds[2]]
+    assert seeds[0] == derive_seed(1234, 'a', 0, 0)
+    assert all(1 <= s < 2**31-1 for s in seeds)
+
+    # Layers given their own paths don't depend on what was built before them.
+    def sample_named_layer(name):
+        layer = StochasticNonlinearity('bernoulli', rng_path = name)
+        x = tt.matrix('x')
+        x.tag.test_value = np.zeros((3, 4))
+        return theano.function([x], layer(x))(np.zeros((20, 30)))
+    with RandomStreamService(seed = 1234):
+        hidden_samples = sample_named_layer('my_rbm/hidden')
+    with RandomStreamService(seed = 1234):
+        sample_named_layer('my_rbm/visible')
+        assert np.array_equal(sample_named_layer('my_rbm/hidden'), hidden_samples)
+
+    # Layers sample from the stream type that is fastest for their distribution
+    def get_random_op_types(activation):
+        x = tt.matrix('x')
+        x.tag.test_value = np.zeros((3, 4))
+        sample = StochasticNonlinearity(activation)(x)
+        return set(type(v.owner.op).__name__ for v in theano.gof.graph.ancestors([sample]) if v.owner is not None)
+    assert 'mrg_uniform' in get_random_op_types('bernoulli')
+    assert 'RandomFunction' in get_random_op_types('gaussian') and 'mrg_uniform' not in get_random_op_types('gaussian')
+
+    with RandomStreamService(seed = 1234, rngtype = 'default'):
+        assert isinstance(get_theano_rng(None), theano.tensor.shared_randomstreams.RandomStreams)
+
+
 if __name__ == '__main__':
 
+    test_random_stream_service()
+
     test_mrg_choice()
@@ -21,3 +21,31 @@ def running_average(data):
     add_update(avg, new_avg)
     add_update(n_points, n_points+1)
     return new_avg
+
+
+def pack_bits(x, n_dims):
+    """
+    Pack a matrix of binary values into bytes (8 values per byte), for compact storage of binary states.  The layout
+    matches numpy's packbits, so utils.tools.packed_binary can read it.
+    :param x: An (n_samples, n_dims) matrix of 0/1 values
+    :param n_dims: The (fixed) number of columns of x
+    :return: An (n_samples, ceil(n_dims/8)) uint8 matrix
+    """
+    n_bytes = (n_dims+7)//8
+    padded = tt.zeros((x.shape[0], n_bytes*8), dtype = 'uint8')
+    padded = tt.set_subtensor(padded[:, :n_dims], tt.cast(x, 'uint8'))
+    bit_values = tt.constant(2**np.arange(7, -1, -1), dtype = 'uint8')
+    return tt.cast(tt.sum(padded.reshape((x.shape[0], n_bytes, 8)) * bit_values, axis = 2), 'uint8')
+
+
+def unpack_bits(packed, n_dims, dtype = theano.config.floatX):
+    """
+    Inverse of pack_bits
+    :param packed: An (n_samples, n_bytes) uint8 matrix
+    :param n_dims: The number of columns to unpack
+    :param dtype: The dtype of the output
+    :return: An (n_samples, n_dims) matrix of 0/1 values
+    """
+    bit_values = tt.constant(2**np.arange(7, -1, -1), dtype = 'uint8')
+    bits = (packed.dimshuffle(0, 1, 'x') // bit_values) % 2  # (n_samples, n_bytes, 8)
+    return tt.cast(bits.reshape((packed.shape[0], packed.shape[1]*8))[:, :n_dims], dtype)
@@ -6,6 +6,7 @@ import theano
 import theano.tensor as tt
 from utils.graph_utils import FactorGraph, InferencePath
 import numpy as np
+import weakref
 
 
 class DeepBeliefNet(object):
@@ -19,9 +20,32 @@ class DeepBeliefNet(object):
     def __init__(self, layers, bridges):
         assert all(src in layers and dest in layers for src, dest in bridges.viewkeys()), \
             'All bridges must project to and from layers'
-        self._graph = FactorGraph(variables=layers, factors=bridges)
         self._layers = layers
         self._bridges = bridges
+        # Bridge currents, keyed by the symbolic input signal and then by bridge direction.  This lets inference, free
+        # energy and sampling share one current per bridge and input, instead of each adding its own copy to the graph.
+        # Keys and values are weak, so the cache goes away along with the graph it belongs to.
+        self._bridge_currents = weakref.WeakKeyDictionary()
+        self._graph = FactorGraph(variables=layers, factors={(src, dest): _CachedBridge(self, src, dest) for src, dest in bridges})
+
+    def get_bridge_current(self, src, dest, signal):
+        """
+        Get the current that flows from layer src to layer dest given the signal in layer src.  The bridge can point
+        either way: if there's only a bridge from dest to src, we use its reverse.  Currents are cached, so asking for the
+        same current from the same symbolic signal twice returns the same variable.
+
+        :param src: The name of the layer the signal comes from
+        :param dest: The name of the layer the current goes to
+        :param signal: The symbolic signal in the src layer
+        :return: The symbolic current into the dest layer.
+        """
+        currents = self._bridge_currents.setdefault(signal, {})
+        current = currents[src, dest]() if (src, dest) in currents else None
+        if current is None:
+            current = self._bridges[src, dest](signal) if (src, dest) in self._bridges else \
+                self._bridges[dest, src].reverse(signal)
+            currents[src, dest] = weakref.ref(current)  # (A strong reference would keep the signal, and so the entry, alive)
+        return current
 
     def get_inference_function(self, input_layers, output_layers, path=None, smooth = False):
         """
@@ -66,7 +90,8 @@ class DeepBeliefNet(object):
             up to the visible layers before training.
         :param up_path: The path from the input_layers to the hidden_layers (in the future this should be found
             automatically - now it is only computed automatically if there's a direct connection from input to visible)
-        :param n_gibbs: Number of Gibbs block sampling steps to do
+        :param n_gibbs: Number of Gibbs block sampling steps to do.  The chain is a scan, so this can also be a shared
+            variable, which you can change without recompiling.
         :param persistent: True for pCD, false for regular
         :param optimizer: An IGradientOptimizer object.
         :return: A symbolic function of upate form:
@@ -87,8 +112,14 @@ class DeepBeliefNet(object):
             up_path = self._graph.get_execution_path(up_path)
 
         propup = self.get_inference_function(visible_layers, hidden_layers)
+        propdown = self.get_inference_function(hidden_layers, visible_layers, path = [(hidden_layers, visible_layers)])
         free_energy = self.get_free_energy_function(visible_layers, hidden_layers)
 
+        @symbolic_multi
+        def gibbs_step(*hidden):
+            visible = propdown(*hidden)
+            return tuple(visible) + tuple(propup(*visible))
+
         @symbolic_updater
         def cd_function(*input_signals):
 
@@ -98,9 +129,9 @@ class DeepBeliefNet(object):
             initial_hidden =[theano.shared(np.zeros(wh.tag.test_value.shape, dtype = theano.config.floatX), name = 'persistent_hidden_state') for wh in wake_hidden] \
                 if persistent else wake_hidden
 
-            gibbs_path = [(hidden_layers, visible_layers)] + [(visible_layers, hidden_layers), (hidden_layers, visible_layers)] * (n_gibbs-1)
-            sleep_visible = self.get_inference_function(hidden_layers, visible_layers, gibbs_path)(*initial_hidden)
-            sleep_hidden = propup(*sleep_visible)
+            chains = gibbs_step.scan(outputs_info = [None]*len(visible_layers) + list(initial_hidden), n_steps = n_gibbs)
+            sleep_visible = tuple(chain[-1] for chain in chains[:len(visible_layers)])
+            sleep_hidden = tuple(chain[-1] for chain in chains[len(visible_layers):])
 
             all_params = sum([x.parameters for x in ([self._layers[i] for i in visible_layers]
                 +[self._layers[i] for i in hidden_layers]+[self._bridges[i, j] for i in visible_layers for j in hidden_layers])], [])
@@ -145,10 +176,28 @@ class DeepBeliefNet(object):
             :return: A float vector representing the free energy of each sample.
             """
             visible_signals = {lay: sig for lay, sig in zip(visible_layers, visible_signals)}
-            hidden_currents = {hid: sum([b(visible_signals[src]) for (src, dest), b in bridges.iteritems() if dest == hid]) for hid in hidden_layers}
+            hidden_currents = {hid: sum([self.get_bridge_current(src, dest, visible_signals[src]) for (src, dest) in bridges if dest == hid]) for hid in hidden_layers}
             visible_contributions = [b.free_energy(visible_signals[src]) for (src, dest), b in bridges.iteritems()]
             hidden_contributions = [self._layers[hid].free_energy(hidden_currents[hid]) for hid in hidden_layers]
             # Note: Need to add another term for Gaussian RBMs, which have a the sigma parameter attached to the visible layer
             return sum(visible_contributions+hidden_contributions)
 
         return free_energy
+
+
+class _CachedBridge(object):
+    """
+    Stands in for a bridge in the DBN's factor graph, so that currents computed along an inference path go through the
+    DBN's current cache.
+    """
+
+    def __init__(self, dbn, src, dest):
+        self._dbn = dbn
+        self._src = src
+        self._dest = dest
+
+    def __call__(self, signal):
+        return self._dbn.get_bridge_current(self._src, self._dest, signal)
+
+    def reverse(self, signal):
+        return self._dbn.get_bridge_current(self._dest, self._src, signal)
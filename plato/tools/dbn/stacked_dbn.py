@@ -1,12 +1,18 @@
 from abc import abstractmethod
+import os
+from fileman.disk_memoize import compute_fixed_hash
+from fileman.local_dir import get_local_path, make_file_dir
 from plato.core import symbolic_multi, add_update, create_shared_variable
 from plato.interfaces.decorators import symbolic_updater, symbolic_simple
 from plato.interfaces.helpers import get_theano_rng, create_shared_variable
+from plato.tools.common.basic import pack_bits, unpack_bits
 from plato.tools.optimization.optimizers import SimpleGradientDescent
 from theano.compile.sharedvalue import SharedVariable
 import theano.tensor as tt
 import theano
 import numpy as np
+from utils.tools.iteration import minibatch_iterate
+from utils.tools.packed_binary import pack_bits as pack_bits_numpy
 __author__ = 'peter'
 
 """
@@ -31,11 +37,11 @@ def bernoulli_activation(inputs, rng):
         return p
 
 
-def linear_gaussian_activation(inputs, rng):
+def linear_gaussian_activation(inputs, rng, std = 1):
     if rng is None:
         return inputs
     else:
-        return rng.normal(size = inputs.shape, avg = inputs, std = 1, dtype = theano.config.floatX)
+        return rng.normal(size = inputs.shape, avg = inputs, std = std, dtype = theano.config.floatX)
 
 
 class IGenerativeNet(object):
@@ -59,8 +65,18 @@ class IGenerativeNet(object):
 
 class BaseRBM(IGenerativeNet):
 
-    def __init__(self, w, b_vis, b_hid, rng):
-        self.rng = get_theano_rng(rng)
+    binary_hidden = False  # True if hidden states are always 0/1 (so can be stored bit-packed)
+
+    def __init__(self, w, b_vis, b_hid, rng, rng_path = None):
+        """
+        :param w: The (n_visible, n_hidden) weight matrix
+        :param b_vis: The visible biases
+        :param b_hid: The hidden biases
+        :param rng: Random number generator or seed (see get_theano_rng)
+        :param rng_path: Optionally, a name for this RBM's random stream, used when it is seeded by a RandomStreamService
+            (see get_theano_rng).
+        """
+        self.rng = get_theano_rng(rng, path = rng_path)
         self.w = create_shared_variable(w)
         self.b_vis = create_shared_variable(b_vis)
         self.b_hid = create_shared_variable(b_hid)
@@ -69,27 +85,58 @@ class BaseRBM(IGenerativeNet):
     def parameters(self):
         return [self.w, self.b_vis, self.b_hid]
 
-    def get_training_fcn(self, n_gibbs=1, persistent = False, optimizer = SimpleGradientDescent(eta = 0.01)):
+    @symbolic_multi
+    def _gibbs_step_from_hidden(self, hidden):
+        visible = self.propdown(hidden)
+        return visible, self.propup(visible)
+
+    @symbolic_multi
+    def _gibbs_step_from_visible(self, visible):
+        hidden = self.propup(visible)
+        return hidden, self.propdown(hidden)
+
+    def get_training_fcn(self, n_gibbs=1, persistent = False, optimizer = SimpleGradientDescent(eta = 0.01), pack_persistent_state = False):
+        """
+        :param n_gibbs: Number of Gibbs steps.  The chain is a scan, so this can also be a shared variable, which you
+            can change without recompiling.
+        :param persistent: False for regular CD, True for persistent CD, or a ParallelTemperingChains object for
+            persistent CD where the negative samples are drawn from chains run with parallel tempering.
+        :param pack_persistent_state: For persistent CD with binary hidden units, store the persistent hidden state
+            bit-packed (8 units per byte) rather than as floats, and unpack it in the graph.
+        """
+        assert not pack_persistent_state or self.binary_hidden, "Can't pack the hidden state of %s: it's not binary" % (self.__class__.__name__, )
 
         @symbolic_updater
         def train(wake_visible):
 
-            wake_hidden = self.propup(wake_visible)
-            persistent_state = sleep_hidden = create_shared_variable(np.zeros(wake_hidden.tag.test_value.shape),
-                name = 'persistend_hidden_state') if persistent else wake_hidden
-            for _ in xrange(n_gibbs):
-                sleep_visible = self.propdown(sleep_hidden)
-                sleep_hidden = self.propup(sleep_visible)
+            if isinstance(persistent, ParallelTemperingChains):
+                sleep_visible = persistent.sample(n_gibbs = n_gibbs)
+            else:
+                wake_hidden = self.propup(wake_visible)
+                n_hidden = self.w.get_value().shape[1]
+                if persistent and pack_persistent_state:
+                    persistent_state = create_shared_variable(pack_bits_numpy(np.zeros(wake_hidden.tag.test_value.shape)), name = 'packed_persistent_hidden_state')
+                    sleep_hidden = unpack_bits(persistent_state, n_hidden)
+                else:
+                    persistent_state = sleep_hidden = create_shared_variable(np.zeros(wake_hidden.tag.test_value.shape),
+                        name = 'persistend_hidden_state') if persistent else wake_hidden
+                sleep_visible_chain, sleep_hidden_chain = self._gibbs_step_from_hidden.scan(outputs_info = [None, sleep_hidden], n_steps = n_gibbs)
+                sleep_visible, sleep_hidden = sleep_visible_chain[-1], sleep_hidden_chain[-1]
+                if persistent:
+                    add_update(persistent_state, pack_bits(sleep_hidden, n_hidden) if pack_persistent_state else sleep_hidden)
             wake_energy = self.energy(wake_visible)
             sleep_energy = self.energy(sleep_visible)
             cost = wake_energy - sleep_energy
             optimizer(cost = cost, parameters = self.parameters, constants = [wake_visible, sleep_visible])
-            if persistent:
-                add_update(persistent_state, sleep_hidden)
 
         return train
 
     def get_sampling_fcn(self, initial_vis, n_steps):
+        """
+        :param initial_vis: The initial visible state of the chain
+        :param n_steps: Number of Gibbs steps per call.  This can also be a shared variable, which you can change
+            without recompiling.
+        """
 
         initial_vis = \
             create_shared_variable(initial_vis) if isinstance(initial_vis, np.ndarray) else \
@@ -98,49 +145,139 @@ class BaseRBM(IGenerativeNet):
 
         @symbolic_multi
         def sample():
-            vis = initial_vis
-            for i in xrange(n_steps):
-                hid = self.propup(vis)
-                vis = self.propdown(hid)
+            hid_chain, vis_chain = self._gibbs_step_from_visible.scan(outputs_info = [None, initial_vis], n_steps = n_steps)
+            hid, vis = hid_chain[-1], vis_chain[-1]
             add_update(initial_vis, vis)
             return vis, hid
         return sample
 
     @classmethod
-    def from_initializer(cls, n_visible, n_hidden, w_init_fcn, rng = None):
-        return cls(w = w_init_fcn((n_visible, n_hidden)), b_vis = np.zeros(n_visible), b_hid = np.zeros(n_hidden), rng = rng)
+    def from_initializer(cls, n_visible, n_hidden, w_init_fcn, rng = None, rng_path = None):
+        return cls(w = w_init_fcn((n_visible, n_hidden)), b_vis = np.zeros(n_visible), b_hid = np.zeros(n_hidden), rng = rng, rng_path = rng_path)
 
 
 class BernoulliBernoulliRBM(BaseRBM):
 
-    def propup(self, visible, stochastic = True):
-        current = tt.dot(visible, self.w) + self.b_hid
+    binary_hidden = True
+
+    def propup(self, visible, stochastic = True, inverse_temperature = 1):
+        current = (tt.dot(visible, self.w) + self.b_hid) * inverse_temperature
         return bernoulli_activation(current, rng = self.rng if stochastic else None)
 
-    def propdown(self, hidden, stochastic = True):
-        current = tt.dot(hidden, self.w.T) + self.b_vis
+    def propdown(self, hidden, stochastic = True, inverse_temperature = 1):
+        current = (tt.dot(hidden, self.w.T) + self.b_vis) * inverse_temperature
         return bernoulli_activation(current, rng = self.rng if stochastic else None)
 
     def energy(self, visible):
         hidden = self.propup(visible, stochastic = False)
         return -tt.mean(tt.sum(visible.dot(self.w)*hidden, axis = 1) + visible.dot(self.b_vis) + hidden.dot(self.b_hid))
 
+    def joint_energy(self, visible, hidden):
+        return -(tt.sum(visible.dot(self.w)*hidden, axis = -1) + visible.dot(self.b_vis) + hidden.dot(self.b_hid))
+
 
 class BernoulliGaussianRBM(BaseRBM):
 
-    def propup(self, visible, stochastic = True):
-        current = visible.dot(self.w) + self.b_hid
+    binary_hidden = False
 
-        return linear_gaussian_activation(current, rng = self.rng if stochastic else None)
+    def propup(self, visible, stochastic = True, inverse_temperature = 1):
+        current = visible.dot(self.w) + self.b_hid
+        # Temperature scales the variance of the gaussian units, not their mean
+        return linear_gaussian_activation(current, rng = self.rng if stochastic else None, std = 1./tt.sqrt(inverse_temperature))
 
-    def propdown(self, hidden, stochastic = True):
-        current = hidden.dot(self.w.T) + self.b_vis
+    def propdown(self, hidden, stochastic = True, inverse_temperature = 1):
+        current = (hidden.dot(self.w.T) + self.b_vis) * inverse_temperature
         return bernoulli_activation(current, rng = self.rng if stochastic else None)
 
     def energy(self, visible):
         hidden = self.propup(visible, stochastic = False)
         return -tt.mean(tt.sum(visible.dot(self.w)*hidden, axis = 1) + visible.dot(self.b_vis) + tt.sum(0.5*(hidden - self.b_hid)**2, axis = 1))
 
+    def joint_energy(self, visible, hidden):
+        return -(tt.sum(visible.dot(self.w)*hidden, axis = -1) + visible.dot(self.b_vis)) + tt.sum(0.5*(hidden - self.b_hid)**2, axis = -1)
+
+
+class ParallelTemperingChains(object):
+    """
+    Persistent Gibbs chains for an RBM, run with parallel tempering.  We keep n_chains replica chains at each of a ladder
+    of inverse temperatures, all in one (n_temperatures, n_chains, n_units) tensor, so one Gibbs step updates every
+    replica at once.  After the Gibbs steps, neighbouring temperatures propose to swap states (alternating between the
+    even and odd pairs of neighbours on each call), which lets the cold chains escape modes they'd otherwise get stuck
+    in.  The samples from the chains at inverse temperature 1 are the ones you'd use for training.
+
+    The inverse temperatures are stored in a shared variable, so you can change them (but not their number) without
+    recompiling.
+
+    See paper:
+    Tempered Markov Chain Monte Carlo for training of Restricted Boltzmann Machines
+    Desjardins G, Courville A, Bengio Y, Vincent P, Delalleau O
+    http://proceedings.mlr.press/v9/desjardins10a/desjardins10a.pdf
+
+    Usage:
+        rbm = BernoulliBernoulliRBM.from_initializer(...)
+        train = rbm.get_training_fcn(persistent = ParallelTemperingChains(rbm, n_chains = 20)).compile()
+    """
+
+    def __init__(self, rbm, n_chains, inverse_temperatures = np.linspace(1, 0.5, 10), rng = None):
+        """
+        :param rbm: A BaseRBM which implements propup/propdown with an inverse_temperature argument, and joint_energy.
+        :param n_chains: Number of chains at each temperature
+        :param inverse_temperatures: A decreasing sequence of inverse temperatures, starting at 1.
+        :param rng: Random number generator or seed for the swap moves
+        """
+        assert inverse_temperatures[0] == 1, 'The first inverse temperature must be 1.  Got %s' % (inverse_temperatures[0], )
+        n_visible, n_hidden = rbm.w.get_value().shape
+        n_temperatures = len(inverse_temperatures)
+        self.rbm = rbm
+        self.inverse_temperatures = create_shared_variable(inverse_temperatures, name = 'inverse_temperatures')
+        self.visible = create_shared_variable(np.zeros((n_temperatures, n_chains, n_visible)), name = 'tempered_visible')
+        self.hidden = create_shared_variable(np.zeros((n_temperatures, n_chains, n_hidden)), name = 'tempered_hidden')
+        self._swap_parity = theano.shared(np.array(0, dtype = 'int64'), name = 'swap_parity')
+        self._n_swaps = create_shared_variable(np.zeros(n_temperatures-1), name = 'n_swaps')
+        self._n_swap_proposals = create_shared_variable(np.zeros(n_temperatures-1), name = 'n_swap_proposals')
+        self.rng = get_theano_rng(rng)
+
+    @symbolic_multi
+    def _gibbs_step(self, hidden):
+        inverse_temperatures = self.inverse_temperatures.dimshuffle(0, 'x', 'x')
+        visible = self.rbm.propdown(hidden, inverse_temperature = inverse_temperatures)
+        return visible, self.rbm.propup(visible, inverse_temperature = inverse_temperatures)
+
+    def sample(self, n_gibbs = 1):
+        """
+        Symbolically advance the chains by n_gibbs Gibbs steps followed by one round of swaps.
+        :return: The new visible states of the chains at inverse temperature 1: an (n_chains, n_visible) tensor
+        """
+        visible_chain, hidden_chain = self._gibbs_step.scan(outputs_info = [None, self.hidden], n_steps = n_gibbs)
+        visible, hidden = visible_chain[-1], hidden_chain[-1]
+
+        # Swap the states of neighbouring temperatures (i, i+1) with probability min(1, exp((b_i-b_(i+1))*(E_i-E_(i+1))))
+        betas = self.inverse_temperatures
+        energies = self.rbm.joint_energy(visible, hidden)  # (n_temperatures, n_chains)
+        log_accept_ratio = (betas[:-1] - betas[1:]).dimshuffle(0, 'x') * (energies[:-1] - energies[1:])
+        is_proposed = tt.eq(tt.arange(betas.shape[0]-1) % 2, self._swap_parity).dimshuffle(0, 'x')
+        swap = tt.and_(is_proposed, tt.log(self.rng.uniform(size = log_accept_ratio.shape, dtype = theano.config.floatX)) < log_accept_ratio)
+        no_swap = tt.zeros_like(swap[:1])
+        swap_with_next = tt.concatenate([swap, no_swap]).dimshuffle(0, 1, 'x')
+        swap_with_previous = tt.concatenate([no_swap, swap]).dimshuffle(0, 1, 'x')
+
+        def do_swaps(x):
+            return tt.switch(swap_with_next, tt.concatenate([x[1:], x[-1:]]), tt.switch(swap_with_previous, tt.concatenate([x[:1], x[:-1]]), x))
+
+        add_update(self.visible, do_swaps(visible))
+        add_update(self.hidden, do_swaps(hidden))
+        add_update(self._swap_parity, 1 - self._swap_parity)
+        add_update(self._n_swaps, tt.cast(self._n_swaps + swap.sum(axis = 1), self._n_swaps.dtype))
+        add_update(self._n_swap_proposals, tt.cast(self._n_swap_proposals + is_proposed.sum(axis = 1) * swap.shape[1], self._n_swap_proposals.dtype))
+        return do_swaps(visible)[0]
+
+    def get_swap_rates(self):
+        """
+        :return: A vector of the fraction of proposed swaps that were accepted between each pair of neighbouring
+            temperatures so far.  Rates near 0 mean the temperatures are too far apart.
+        """
+        return self._n_swaps.get_value() / np.maximum(self._n_swap_proposals.get_value(), 1)
+
 
 class StackedDeepBeliefNet(IGenerativeNet):
 
@@ -178,6 +315,9 @@ class StackedDeepBeliefNet(IGenerativeNet):
 
     def get_training_fcn(self, **cd_params):
         """
+        Note: This propagates every minibatch up through all the lower RBMs on every training step.  For greedy
+        pretraining, where the lower RBMs are frozen, see pretrain_greedily, which computes their features just once.
+
         :param cd_params: named-args for function BaseRBM.get_training_fcn
         :return: A symbolic function that takes a (n_samples, n_input_dims) tensor of visible data, and returns
             state updates.
@@ -217,3 +357,102 @@ class StackedDeepBeliefNet(IGenerativeNet):
         :return: The new StackedDeepBeliefNet (with the new RBM on top)
         """
         return StackedDeepBeliefNet(self.rbms + [rbm])
+
+
+def pretrain_greedily(dbn, data, n_epochs = 1, minibatch_size = 10, training_kwargs = {}, cache_features = True,
+        feature_batch_size = 1000, callback = None):
+    """
+    Greedy layer-wise pretraining: train each RBM in the stack in turn, on the features of the (now-frozen) RBMs below
+    it.  Rather than propagating each minibatch up through the lower RBMs on every training step (as the function from
+    StackedDeepBeliefNet.get_training_fcn does), we compute each layer's deterministic features once for the whole
+    dataset, and train the next RBM directly on them.
+
+    :param dbn: A StackedDeepBeliefNet
+    :param data: An (n_samples, n_input_dims) array of training data
+    :param n_epochs: Number of epochs to train each RBM for, or a list with one number per RBM
+    :param minibatch_size: The minibatch size for training
+    :param training_kwargs: Named arguments for BaseRBM.get_training_fcn (e.g. n_gibbs, persistent, optimizer), or a list
+        with one dict per RBM.  (Give each RBM its own optimizer if the optimizer keeps state.)
+    :param cache_features: True to store the features in memory-mapped files, keyed on the parameters of the lower RBMs
+        and a hash of the input data (so that re-running the pretraining does not recompute them).  False to just keep
+        them in memory.
+    :param feature_batch_size: Number of samples to propagate at a time when computing features
+    :param callback: Optionally, a function callback(layer_index, rbm, minibatch_index) called before each training step.
+    :return: A list of the feature arrays used as input to each RBM above the first.
+    """
+    n_layers = len(dbn.rbms)
+    n_epochs = n_epochs if isinstance(n_epochs, (list, tuple)) else [n_epochs]*n_layers
+    training_kwargs = training_kwargs if isinstance(training_kwargs, (list, tuple)) else [training_kwargs]*n_layers
+    assert len(n_epochs) == len(training_kwargs) == n_layers
+
+    features = data
+    features_key = compute_fixed_hash(np.asarray(data)) if cache_features else None  # Upper layers' features are keyed on this
+    all_features = []
+    for i, rbm in enumerate(dbn.rbms):
+        if i > 0:
+            if cache_features:
+                features = load_cached_rbm_features(dbn.rbms[i-1], features, batch_size = feature_batch_size, data_key = features_key)
+                features_key = get_rbm_features_key(dbn.rbms[i-1], features_key)
+            else:
+                features = get_rbm_features(dbn.rbms[i-1], features, batch_size = feature_batch_size)
+            all_features.append(features)
+        train = rbm.get_training_fcn(**training_kwargs[i]).compile()
+        for j, visible in enumerate(minibatch_iterate(features, minibatch_size = minibatch_size, n_epochs = n_epochs[i])):
+            if callback is not None:
+                callback(i, rbm, j)
+            train(np.asarray(visible, dtype = theano.config.floatX))
+    return all_features
+
+
+def get_rbm_features(rbm, data, batch_size = 1000, out = None):
+    """
+    Deterministically propagate data up through an RBM.
+    :param rbm: A BaseRBM
+    :param data: An (n_samples, n_visible) array
+    :param batch_size: Number of samples to propagate at a time
+    :param out: Optionally, an (n_samples, n_hidden) array (e.g. a memmap) to write the features into.
+    :return: The (n_samples, n_hidden) array of features
+    """
+    propup = symbolic_simple(lambda visible: rbm.propup(visible, stochastic = False)).compile()
+    if out is None:
+        out = np.empty((len(data), rbm.w.get_value().shape[1]), dtype = theano.config.floatX)
+    for start in xrange(0, len(data), batch_size):
+        out[start:start+batch_size] = propup(np.asarray(data[start:start+batch_size], dtype = theano.config.floatX))
+    return out
+
+
+def get_rbm_features_key(rbm, data_key):
+    """
+    :param rbm: A BaseRBM
+    :param data_key: A string identifying the data
+    :return: A string identifying the features of that data from this RBM, in its current state.
+    """
+    rbm_type = '%s.%s' % (rbm.__class__.__module__, rbm.__class__.__name__)
+    return compute_fixed_hash((rbm_type, [p.get_value() for p in rbm.parameters], data_key))
+
+
+def load_cached_rbm_features(rbm, data, batch_size = 1000, data_key = None):
+    """
+    Get the deterministic features of the data from an RBM, as a read-only memory-mapped array.  The features are
+    computed once and saved to disk, keyed by the RBM's type and parameters and the data.
+
+    :param rbm: A BaseRBM
+    :param data: An (n_samples, n_visible) array
+    :param batch_size: Number of samples to propagate at a time
+    :param data_key: Optionally, a string identifying the data (e.g. the get_rbm_features_key of the RBM that produced
+        it).  If None, the key is a hash of the data, which means reading all of it.
+    :return: An (n_samples, n_hidden) memmap of features
+    """
+    if data_key is None:
+        data_key = compute_fixed_hash(np.asarray(data))
+    path = get_local_path('dbn_features/%s.npy' % (get_rbm_features_key(rbm, data_key), ))
+    if not os.path.exists(path):
+        # Write to a temporary file first, so that an interrupted computation does not leave a partial feature file.
+        make_file_dir(path)
+        temp_path = path[:-len('.npy')]+'.tmp.npy'
+        out = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = theano.config.floatX, shape = (len(data), rbm.w.get_value().shape[1]))
+        get_rbm_features(rbm, data, batch_size = batch_size, out = out)
+        out.flush()
+        del out
+        os.rename(temp_path, path)
+    return np.load(path, mmap_mode = 'r')
@@ -1,7 +1,149 @@
 from plato.tools.dbn.demo_dbn import demo_dbn_mnist
+from plato.tools.dbn.dbn import DeepBeliefNet
+from plato.core import symbolic_simple
+from plato.tools.dbn.stacked_dbn import StackedDeepBeliefNet, BernoulliBernoulliRBM, ParallelTemperingChains, \
+    BernoulliGaussianRBM, pretrain_greedily, load_cached_rbm_features, get_rbm_features_key
+from fileman.disk_memoize import compute_fixed_hash
+from plato.tools.rbm.rbm_parts import StochasticNonlinearity, FullyConnectedBridge
+import numpy as np
+import theano
+import theano.tensor as tt
 
 __author__ = 'peter'
 
 
 def test_demo_dbn_mnist():
-    demo_dbn_mnist(plot = True)
\ No newline at end of file
+    demo_dbn_mnist(plot = True)
+
+
+def test_gibbs_chains_with_runtime_length():
+    """
+    The number of Gibbs steps can be a shared variable, changed between calls without recompiling.
+    """
+    rng = np.random.RandomState(1234)
+    data = (rng.rand(10, 20) > 0.5).astype(theano.config.floatX)
+    n_steps = theano.shared(1)
+
+    dbn = DeepBeliefNet(
+        layers = {'vis': StochasticNonlinearity('bernoulli'), 'hid': StochasticNonlinearity('bernoulli')},
+        bridges = {('vis', 'hid'): FullyConnectedBridge(w = 0.01*rng.randn(20, 8), b_rev = 0)}
+        )
+    train_dbn = dbn.get_constrastive_divergence_function(visible_layers = 'vis', hidden_layers = 'hid', n_gibbs = n_steps, persistent = True).compile()
+
+    stacked_dbn = StackedDeepBeliefNet(rbms = [BernoulliBernoulliRBM.from_initializer(n_visible = 20, n_hidden = 8, w_init_fcn = lambda shape: 0.01*rng.randn(*shape), rng = 1234)])
+    train_stacked_dbn = stacked_dbn.get_training_fcn(n_gibbs = n_steps, persistent = True).compile()
+    sample_stacked_dbn = stacked_dbn.get_sampling_fcn(initial_vis = data, n_steps = n_steps).compile()
+
+    for n in (1, 20):
+        n_steps.set_value(n)
+        train_dbn(data)
+        train_stacked_dbn(data)
+        assert sample_stacked_dbn().shape == (10, 20)
+    assert not np.allclose(dbn._bridges['vis', 'hid'].w.get_value(), 0)
+
+
+def test_bridge_currents_are_shared():
+    """
+    Inference and free energy given the same visible signal should share one bridge current, rather than each
+    multiplying by the weights.
+    """
+    rng = np.random.RandomState(1234)
+    dbn = DeepBeliefNet(
+        layers = {'vis': StochasticNonlinearity('bernoulli'), 'hid': StochasticNonlinearity('bernoulli')},
+        bridges = {('vis', 'hid'): FullyConnectedBridge(w = 0.01*rng.randn(20, 8), b_rev = 0)}
+        )
+    x = tt.matrix('x')
+    x.tag.test_value = rng.rand(3, 20)
+    hid, = dbn.get_inference_function('vis', 'hid', smooth = True)(x)
+    free_energy = dbn.get_free_energy_function('vis', 'hid')(x)
+    assert dbn.get_bridge_current('vis', 'hid', x) is dbn.get_bridge_current('vis', 'hid', x)
+    # One product with w (the current), and one with b_rev (the visible free energy term)
+    assert sum(isinstance(node.op, tt.basic.Dot) for node in theano.gof.graph.io_toposort([x], [hid, free_energy])) == 2
+
+    vis, = dbn.get_inference_function('hid', 'vis', path = [('hid', 'vis')], smooth = True)(hid)
+    assert vis.tag.test_value.shape == (3, 20)
+
+
+def test_greedy_pretraining():
+
+    rng = np.random.RandomState(1234)
+    data = (rng.rand(50, 20) > 0.5).astype(theano.config.floatX)
+    w_init = lambda shape: 0.1*rng.randn(*shape)
+    dbn = StackedDeepBeliefNet(rbms = [
+        BernoulliBernoulliRBM.from_initializer(n_visible = 20, n_hidden = 10, w_init_fcn = w_init, rng = 1234),
+        BernoulliGaussianRBM.from_initializer(n_visible = 10, n_hidden = 3, w_init_fcn = w_init, rng = 1235),
+        ])
+    initial_params = [[p.get_value() for p in rbm.parameters] for rbm in dbn.rbms]
+    features, = pretrain_greedily(dbn, data, n_epochs = [2, 1], minibatch_size = 10, training_kwargs = dict(persistent = True))
+
+    # The second RBM was trained on the features of the trained first one.
+    assert isinstance(features, np.memmap) and features.shape == (50, 10)
+    assert np.allclose(features, dbn.propup.compile(fixed_args = dict(stochastic = False, to_layer = 1))(data))
+    for rbm, params in zip(dbn.rbms, initial_params):
+        assert not np.array_equal(rbm.w.get_value(), params[0])
+
+    # The features are cached on disk, and reloaded rather than recomputed
+    assert load_cached_rbm_features(dbn.rbms[0], data).filename == features.filename
+    data_key = compute_fixed_hash(np.asarray(data))
+    assert load_cached_rbm_features(dbn.rbms[0], data, data_key = data_key).filename == features.filename
+    assert get_rbm_features_key(dbn.rbms[0], data_key) in features.filename
+    uncached_features, = pretrain_greedily(dbn, data, n_epochs = 0, cache_features = False)
+    assert not isinstance(uncached_features, np.memmap)
+
+    # RBM classes defined outside of stacked_dbn work too
+    class MyRBM(BernoulliBernoulliRBM):
+        pass
+    my_rbm = MyRBM(*[p.get_value() for p in dbn.rbms[0].parameters], rng = 1234)
+    my_features = load_cached_rbm_features(my_rbm, data)
+    assert my_features.filename != features.filename and np.allclose(my_features, features)
+
+
+def test_packed_persistent_state():
+    """
+    Storing the persistent state bit-packed should give exactly the same training as storing it as floats.
+    """
+    data = (np.random.RandomState(1234).rand(10, 20) > 0.5).astype(theano.config.floatX)
+    weights = []
+    for pack in (False, True):
+        rbm = BernoulliBernoulliRBM.from_initializer(n_visible = 20, n_hidden = 11, w_init_fcn = lambda shape: 0.1*np.random.RandomState(1235).randn(*shape), rng = 1236)
+        train = rbm.get_training_fcn(persistent = True, pack_persistent_state = pack).compile()
+        for _ in xrange(5):
+            train(data)
+        weights.append(rbm.w.get_value())
+    assert np.allclose(*weights)
+
+
+def test_parallel_tempering():
+    """
+    Check that samples from the inverse-temperature-1 chains of parallel tempering follow the exact distribution of a
+    small RBM, and that they can be used for training.
+    """
+    rng = np.random.RandomState(1234)
+    n_visible, n_hidden = 5, 3
+    rbm = BernoulliBernoulliRBM(w = 2*rng.randn(n_visible, n_hidden), b_vis = rng.randn(n_visible), b_hid = rng.randn(n_hidden), rng = 1234)
+
+    all_visible = ((np.arange(2**n_visible)[:, None] >> np.arange(n_visible)) & 1).astype(float)
+    w, b_vis, b_hid = [p.get_value() for p in rbm.parameters]
+    log_unnormalized = all_visible.dot(b_vis) + np.sum(np.log(1+np.exp(all_visible.dot(w)+b_hid)), axis = 1)
+    exact_probs = np.exp(log_unnormalized - log_unnormalized.max())
+    exact_probs /= exact_probs.sum()
+
+    chains = ParallelTemperingChains(rbm, n_chains = 20, inverse_temperatures = np.linspace(1, 0.3, 6), rng = 1234)
+    sample = symbolic_simple(lambda: chains.sample(n_gibbs = 1)).compile()
+    samples = np.concatenate([sample() for _ in xrange(500)])
+    sample_probs = np.bincount(samples.astype(int).dot(2**np.arange(n_visible)), minlength = 2**n_visible) / float(len(samples))
+    assert 0.5*np.abs(sample_probs - exact_probs).sum() < 0.05
+    swap_rates = chains.get_swap_rates()
+    assert swap_rates.shape == (5, ) and np.all(swap_rates > 0.1)
+
+    train = rbm.get_training_fcn(persistent = chains).compile()
+    train(all_visible[:10])
+    assert not np.array_equal(rbm.w.get_value(), w)
+
+
+if __name__ == '__main__':
+    test_packed_persistent_state()
+    test_greedy_pretraining()
+    test_bridge_currents_are_shared()
+    test_gibbs_chains_with_runtime_length()
+    test_parallel_tempering()
@@ -0,0 +1,231 @@
+from plato.core import add_update
+import theano
+import theano.tensor as tt
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+Learning rate schedules which live in shared variables, so that the rate can change without recompiling the training
+function.
+
+A schedule can be passed to an optimizer anywhere a learning rate is expected (or as the learning_rate argument of
+get_named_optimizer).  The optimizer reads the schedule's current rate from its shared variable, and (if
+advance_in_graph is True) adds an update which moves the schedule forward one step each time the compiled update is
+called.  If advance_in_graph is False, you move the schedule yourself from python with step() or set_step().
+
+e.g.
+    optimizer = Adam(alpha = CosineSchedule(1e-3, n_steps = 10000))
+"""
+
+
+class LearningRateSchedule(object):
+    """
+    Base class for schedules where the rate is a function of the number of steps taken.  Subclasses implement
+    _get_rate(step, lib), where lib is either numpy or theano.tensor, so that the same formula serves for setting the
+    value from python and for updating it inside the compiled function.
+    """
+
+    def __init__(self, advance_in_graph = True):
+        """
+        :param advance_in_graph: True to advance the schedule every time the optimizer's compiled update is called.
+            False to leave it to you to call step() from python.
+        """
+        self.advance_in_graph = advance_in_graph
+        self._step = theano.shared(np.array(0, dtype = 'int64'), name = 'lr_step')
+        self._rate = theano.shared(np.array(self._get_rate(0, np), dtype = theano.config.floatX), name = 'learning_rate')
+
+    def _get_rate(self, step, lib):
+        """
+        :param step: The number of steps taken so far (an int or a symbolic int scalar)
+        :param lib: numpy or theano.tensor, depending on whether step is numeric or symbolic
+        :return: The learning rate to use for the next step.
+        """
+        raise NotImplementedError()
+
+    def _as_TensorVariable(self):
+        # Lets theano treat the schedule as a scalar wherever it is used in an expression (e.g. self.eta * gradient)
+        return self._rate
+
+    # Arithmetic with numbers (e.g. 1. - beta_1, in Adam) gives an expression of the current rate.
+    __add__ = lambda self, other: self._rate + other
+    __radd__ = lambda self, other: other + self._rate
+    __sub__ = lambda self, other: self._rate - other
+    __rsub__ = lambda self, other: other - self._rate
+    __mul__ = lambda self, other: self._rate * other
+    __rmul__ = lambda self, other: other * self._rate
+    __div__ = lambda self, other: self._rate / other
+    __rdiv__ = lambda self, other: other / self._rate
+    __truediv__ = lambda self, other: self._rate / other
+    __rtruediv__ = lambda self, other: other / self._rate
+    __pow__ = lambda self, other: self._rate ** other
+    __rpow__ = lambda self, other: other ** self._rate
+    __neg__ = lambda self: -self._rate
+
+    def get_shared_variable(self):
+        return self._rate
+
+    def get_value(self):
+        return self._rate.get_value()
+
+    def get_step(self):
+        return int(self._step.get_value())
+
+    def set_step(self, step):
+        """
+        Set the number of steps taken, and the rate accordingly.  This does not require recompiling anything.
+        """
+        self._step.set_value(np.array(step, dtype = 'int64'))
+        self._rate.set_value(np.array(self._get_rate(step, np), dtype = theano.config.floatX))
+
+    def step(self, n_steps = 1):
+        """
+        Advance the schedule from python.
+        """
+        self.set_step(self.get_step() + n_steps)
+
+    def add_step_update(self):
+        """
+        Called by the optimizer (within a symbolic function) after it has used the rate.  Adds the updates which advance
+        the schedule, if advance_in_graph is True.
+        """
+        if self.advance_in_graph:
+            new_step = self._step + 1
+            add_update(self._step, new_step)
+            add_update(self._rate, tt.cast(self._get_rate(new_step, tt), self._rate.dtype))
+
+
+class ConstantSchedule(LearningRateSchedule):
+    """
+    A fixed rate, which you can change from python with set_rate.
+    """
+
+    def __init__(self, rate, **kwargs):
+        self.rate = rate
+        LearningRateSchedule.__init__(self, **kwargs)
+
+    def _get_rate(self, step, lib):
+        return self.rate + 0*step
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.set_step(self.get_step())
+
+
+class StepSchedule(LearningRateSchedule):
+    """
+    Multiply the rate by gamma every step_size steps.
+    """
+
+    def __init__(self, initial_rate, step_size, gamma = 0.1, **kwargs):
+        self.initial_rate = initial_rate
+        self.step_size = step_size
+        self.gamma = gamma
+        LearningRateSchedule.__init__(self, **kwargs)
+
+    def _get_rate(self, step, lib):
+        return self.initial_rate * self.gamma ** lib.floor(step / float(self.step_size))
+
+
+class ExponentialSchedule(LearningRateSchedule):
+    """
+    Multiply the rate by decay every step.
+    """
+
+    def __init__(self, initial_rate, decay, min_rate = 0, **kwargs):
+        self.initial_rate = initial_rate
+        self.decay = decay
+        self.min_rate = min_rate
+        LearningRateSchedule.__init__(self, **kwargs)
+
+    def _get_rate(self, step, lib):
+        return lib.maximum(self.initial_rate * self.decay ** step, self.min_rate)
+
+
+class CosineSchedule(LearningRateSchedule):
+    """
+    Anneal the rate from initial_rate to min_rate along half a cosine over n_steps, then stay at min_rate.
+
+    See paper:
+    SGDR: Stochastic Gradient Descent with Warm Restarts
+    Loshchilov I, Hutter F
+    http://arxiv.org/abs/1608.03983
+    """
+
+    def __init__(self, initial_rate, n_steps, min_rate = 0, **kwargs):
+        self.initial_rate = initial_rate
+        self.n_steps = n_steps
+        self.min_rate = min_rate
+        LearningRateSchedule.__init__(self, **kwargs)
+
+    def _get_rate(self, step, lib):
+        progress = lib.minimum(step, self.n_steps) / float(self.n_steps)
+        return self.min_rate + 0.5 * (self.initial_rate - self.min_rate) * (1 + lib.cos(np.pi * progress))
+
+
+class WarmupSchedule(LearningRateSchedule):
+    """
+    Ramp the rate up linearly over the first n_steps, from rate/n_steps to the full rate.  The rate can be a number or
+    another LearningRateSchedule (whose rate then follows its own schedule, scaled by the warmup).
+    """
+
+    def __init__(self, rate, n_steps, **kwargs):
+        self.rate = rate
+        self.n_steps = n_steps
+        LearningRateSchedule.__init__(self, **kwargs)
+
+    def _get_rate(self, step, lib):
+        base_rate = self.rate._get_rate(step, lib) if isinstance(self.rate, LearningRateSchedule) else self.rate
+        return base_rate * lib.minimum(1, (step + 1) / float(self.n_steps))
+
+
+class ReduceOnPlateauSchedule(LearningRateSchedule):
+    """
+    Multiply the rate by factor whenever the score hasn't improved for patience reports.  Since this depends on scores
+    computed outside of the training function, it's always advanced from python, with report(score).
+    """
+
+    def __init__(self, initial_rate, factor = 0.1, patience = 10, min_rate = 0, higher_is_better = False):
+        """
+        :param initial_rate: The starting learning rate
+        :param factor: Factor to multiply the rate by when the score plateaus
+        :param patience: Number of reports without improvement to tolerate before reducing the rate
+        :param min_rate: The rate is never reduced below this.
+        :param higher_is_better: True if higher scores are better (e.g. percent correct), False if lower is better (e.g. cost)
+        """
+        self.initial_rate = initial_rate
+        self.factor = factor
+        self.patience = patience
+        self.min_rate = min_rate
+        self.higher_is_better = higher_is_better
+        self._best_score = None
+        self._n_bad_reports = 0
+        self._n_reductions = 0
+        LearningRateSchedule.__init__(self, advance_in_graph = False)
+
+    def _get_rate(self, step, lib):
+        return max(self.initial_rate * self.factor ** self._n_reductions, self.min_rate)
+
+    def report(self, score):
+        """
+        :param score: The latest score (e.g. validation cost).
+        :return: The (possibly reduced) learning rate
+        """
+        if self._best_score is None or (score > self._best_score if self.higher_is_better else score < self._best_score):
+            self._best_score = score
+            self._n_bad_reports = 0
+        else:
+            self._n_bad_reports += 1
+            if self._n_bad_reports > self.patience:
+                self._n_reductions += 1
+                self._n_bad_reports = 0
+        self.step()
+        return self.get_value()
+
+
+def get_schedules(optimizer):
+    """
+    :param optimizer: An optimizer object
+    :return: A list of the LearningRateSchedules among its attributes.
+    """
+    return [v for v in vars(optimizer).values() if isinstance(v, LearningRateSchedule)]
@@ -1,10 +1,13 @@
 from abc import abstractmethod
-from plato.core import add_update, create_shared_variable
+from collections import OrderedDict
+from plato.core import add_update, create_shared_variable, StateCatcher
 from plato.interfaces.decorators import symbolic_updater
 import theano.tensor as tt
 import theano
+from theano.ifelse import ifelse
 import numpy as np
 from plato.interfaces.helpers import get_theano_rng
+from plato.tools.optimization.learning_rate_schedules import get_schedules
 
 __author__ = 'peter'
 
@@ -21,12 +24,38 @@ class IGradientOptimizer(object):
 @symbolic_updater
 class UniformParameterOptimizer(IGradientOptimizer):
     """
-    Subclass off this if you're optimizing the same way across all parameters
+    Subclass off this if you're optimizing the same way across all parameters.
+
+    Learning rates (and other hyperparameters) can be LearningRateSchedules instead of numbers, in which case the
+    schedules are advanced after each update (see learning_rate_schedules.py).
+
+    If fuse_updates is True, all parameters (and their gradients) are concatenated into one flat vector, and the update
+    is applied to that vector as a whole, before being split back into the individual parameters.  The optimizer then
+    keeps one flat buffer for each type of state (e.g. Adam's moment estimates) instead of one per parameter, and the
+    compiled function does one big elementwise update instead of many small ones.  This can cut compile time and
+    per-step overhead for models with many parameter tensors, at the cost of copying parameters in and out of the
+    flat vector.
+
+    If sparse_updates is True, parameters which the cost only uses through row-indexing (e.g. an embedding matrix w,
+    used as w[word_indices]) are updated only on the rows that were indexed.  The gradient is taken with respect to the
+    selected rows rather than the whole matrix, and the parameter and any optimizer state of the same shape (e.g. Adam's
+    moment estimates) are updated with set_subtensor on those rows, so the cost of an update scales with the size of
+    the minibatch instead of the size of the matrix.  For plain gradient descent this gives exactly the same result as
+    the dense update.  For optimizers with state it gives the "lazy" variant, where the state of untouched rows is left
+    alone until they're next used.
     """
 
+    fuse_updates = False
+    sparse_updates = False
+
     def __call__(self, cost, parameters, constants = []):
-        gradients = theano.grad(cost, parameters, consider_constant = constants)  # Can be faster than [theano.grad(p) for p in parameters]
-        self.update_from_gradients(parameters, gradients)
+        row_indexed = _find_row_indexed_parameters(cost, parameters) if self.sparse_updates else {}
+        dense_parameters = [p for p in parameters if p not in row_indexed]
+        wrt = dense_parameters + [row_indexed[p][0] for p in parameters if p in row_indexed]
+        gradients = theano.grad(cost, wrt, consider_constant = constants)  # Can be faster than [theano.grad(p) for p in parameters]
+        for p, row_gradients in zip([p for p in parameters if p in row_indexed], gradients[len(dense_parameters):]):
+            self._update_param_rows(p, row_indexed[p][1], row_gradients)
+        self.update_from_gradients(dense_parameters, gradients[:len(dense_parameters)])
 
     @symbolic_updater
     def update_from_gradients(self, parameters, gradients):
@@ -35,14 +64,77 @@ class UniformParameterOptimizer(IGradientOptimizer):
         of pseudo-gradient)) use this.
         """
         assert len(parameters)==len(gradients), 'Lenght of parameter vector must match length of gradients.'
-        for p, g in zip(parameters, gradients):
-            self._update_param(p, g)
+        if self.fuse_updates and len(parameters) > 1:
+            self._update_fused_params(parameters, gradients)
+        else:
+            for p, g in zip(parameters, gradients):
+                self._update_param(p, g)
+        for schedule in get_schedules(self):
+            schedule.add_step_update()
+
+    def _update_fused_params(self, parameters, gradients):
+        """
+        Apply _update_param once to the concatenation of all parameters.  We do this by giving _update_param a
+        stand-in shared variable for the flat parameter vector (from which it can initialize its state), and then
+        replacing it, in the resulting updates, with the concatenation of the actual parameters.
+        """
+        assert len(set(p.dtype for p in parameters)) == 1, 'Can only fuse updates for parameters of the same dtype.  Got %s' \
+            % ([p.dtype for p in parameters], )
+        flat_param_stand_in = theano.shared(np.concatenate([p.get_value().ravel() for p in parameters]), name = 'flat_params')
+        with StateCatcher(swallow_updates = True) as sc:
+            self._update_param(flat_param_stand_in, tt.concatenate([g.flatten() for g in gradients]))
+        replacement = {flat_param_stand_in: tt.concatenate([p.flatten() for p in parameters])}
+        for shared_var, new_val in sc.get_updates():
+            new_val = theano.clone(new_val, replace = replacement)
+            if shared_var is flat_param_stand_in:
+                for p, new_p in zip(parameters, _split_flat(new_val, parameters)):
+                    add_update(p, new_p)
+            else:
+                add_update(shared_var, new_val)
+
+    def _update_param_rows(self, param, indices, row_gradients):
+        """
+        Apply _update_param to the rows of param selected by indices.  We let _update_param build its update as if for
+        the whole parameter (with a stand-in for the full gradient), and then replace, in the resulting updates, the
+        parameter and every state variable of the same shape with just the selected rows, and the stand-in with the
+        gradients of those rows (summed over repeated indices).
+        """
+        rows, positions = tt.extra_ops.Unique(return_inverse = True)(indices)
+        summed_gradients = tt.inc_subtensor(tt.zeros_like(row_gradients)[:rows.shape[0]][positions], row_gradients)
+        gradient_stand_in = theano.shared(np.zeros_like(param.get_value()), name = 'row_gradient')
+        with StateCatcher(swallow_updates = True) as sc:
+            self._update_param(param, gradient_stand_in)
+        updates = sc.get_updates()
+        row_variables = [v for v, _ in updates if v.get_value().shape == param.get_value().shape]
+        replacement = {v: v[rows] for v in row_variables}
+        replacement[gradient_stand_in] = summed_gradients
+        for shared_var, new_val in updates:
+            new_val = _rebuild_graph(new_val, replace = replacement)
+            add_update(shared_var, tt.set_subtensor(shared_var[rows], new_val) if shared_var in row_variables else new_val)
 
     @abstractmethod
     def _update_param(self, param, gradient):
         pass
 
 
+def _rebuild_graph(output, replace):
+    """
+    Like theano.clone(output, replace = replace), except that the nodes downstream of the replaced variables are rebuilt
+    by calling their ops, rather than copied.  This way their test values (if compute_test_value is on) are computed from
+    the replacements, instead of being copied from the original graph, where they may not even have the same shape.
+
+    :param output: A symbolic variable
+    :param replace: A dict<original_variable: replacement_variable>
+    :return: The equivalent of output, computed from the replacement variables.
+    """
+    equiv = dict(replace)
+    for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs([output]), [output]):
+        new_inputs = [equiv.get(i, i) for i in node.inputs]
+        if any(new is not old for new, old in zip(new_inputs, node.inputs)):
+            equiv.update(zip(node.outputs, node.op(*new_inputs, return_list = True)))
+    return equiv.get(output, output)
+
+
 class GradientStepUpdater(UniformParameterOptimizer):
     """
     Just subtract the gradient to the parameter.  This is mainly useful in some situations the step size doesn't matter
@@ -58,11 +150,15 @@ class SimpleGradientDescent(UniformParameterOptimizer):
     GradientDescent class instead.
     """
 
-    def __init__(self, eta):
+    def __init__(self, eta, fuse_updates = False, sparse_updates = False):
         """
         :param eta: The learning rate
+        :param fuse_updates: Update all parameters as one flat vector (see UniformParameterOptimizer)
+        :param sparse_updates: Only update the rows of row-indexed parameters that were used (see UniformParameterOptimizer)
         """
         self._eta = eta
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         add_update(param, param - self._eta * gradient)
@@ -74,12 +170,14 @@ class LangevinGradientDescent(UniformParameterOptimizer):
     GradientDescent class instead.
     """
 
-    def __init__(self, eta, rng = None):
+    def __init__(self, eta, rng = None, fuse_updates = False):
         """
         :param eta: The learning rate
+        :param fuse_updates: Update all parameters as one flat vector (see UniformParameterOptimizer)
         """
         self._eta = eta
         self._rng = get_theano_rng(rng)
+        self.fuse_updates = fuse_updates
 
     def _update_param(self, param, gradient):
         add_update(param, param - self._eta*gradient + 2*tt.sqrt(self._eta)*self._rng.normal(size = param.ishape))
@@ -98,11 +196,13 @@ class Adam(UniformParameterOptimizer):
     https://gist.github.com/Newmu/acb738767acb4788bac3
     """
 
-    def __init__(self, alpha = 1e-3, beta_1=0.1, beta_2=0.001, eps = 1e-8):
+    def __init__(self, alpha = 1e-3, beta_1=0.1, beta_2=0.001, eps = 1e-8, fuse_updates = False, sparse_updates = False):
         self.alpha = alpha
         self.beta_1 = beta_1
         self.beta_2 = beta_2
         self.eps = eps
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         # Initialize variables
@@ -127,11 +227,13 @@ class Adam(UniformParameterOptimizer):
 
 class AdaMax(UniformParameterOptimizer):
 
-    def __init__(self, alpha = 1e-3, beta_1=0.1, beta_2=0.001, eps = 1e-8):
+    def __init__(self, alpha = 1e-3, beta_1=0.1, beta_2=0.001, eps = 1e-8, fuse_updates = False, sparse_updates = False):
         self._alpha = alpha
         self._beta_1 = beta_1
         self._beta_2 = beta_2
         self._eps = eps
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         mom1 = theano.shared(np.zeros_like(param.get_value()))
@@ -146,15 +248,17 @@ class AdaMax(UniformParameterOptimizer):
 
 class RMSProp(UniformParameterOptimizer):
 
-    def __init__(self, learning_rate = 0.1, decay = 0.9, max_scaling = 1e5):
+    def __init__(self, learning_rate = 0.1, decay = 0.9, max_scaling = 1e5, fuse_updates = False, sparse_updates = False):
         self.decay = decay
         self.epsilon = 1./max_scaling
         self.learning_rate = learning_rate
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         mean_squared_grad = theano.shared(np.zeros_like(param.get_value()))
         new_mean_squared_grad = self.decay * mean_squared_grad + (1-self.decay) * gradient**2
-        delta_p = - self.learning_rate * gradient / tt.maximum(tt.sqrt(new_mean_squared_grad), self.epsilon)
+        delta_p = - (self.learning_rate * gradient) / tt.maximum(tt.sqrt(new_mean_squared_grad), self.epsilon)
         add_update(param, param + delta_p)
         add_update(mean_squared_grad, new_mean_squared_grad)
 
@@ -169,10 +273,12 @@ class AdaGrad(UniformParameterOptimizer):
     https://github.com/lisa-lab/pylearn2/blob/master/pylearn2/training_algorithms/learning_rule.py
     """
 
-    def __init__(self, learning_rate = 0.01, decay_rate = 0, max_scaling = 1e5):
+    def __init__(self, learning_rate = 0.01, decay_rate = 0, max_scaling = 1e5, fuse_updates = False, sparse_updates = False):
         self.eps = 1./max_scaling
         self.learning_rate = learning_rate
         self.decay_rate = decay_rate
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         sum_squared_grad = theano.shared(param.get_value()*0)
@@ -185,13 +291,17 @@ class AdaGrad(UniformParameterOptimizer):
 class GradientDescent(UniformParameterOptimizer):
     """ Gradient descent, with all bells and whistles"""
 
-    def __init__(self, eta, momentum = 0, decay = 0):
+    def __init__(self, eta, momentum = 0, decay = 0, fuse_updates = False, sparse_updates = False):
         """
         :param eta: The learning rate
+        :param fuse_updates: Update all parameters as one flat vector (see UniformParameterOptimizer)
+        :param sparse_updates: Only update the rows of row-indexed parameters that were used (see UniformParameterOptimizer)
         """
         self.eta = eta
         self.momentum = momentum
         self.decay = decay
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
 
@@ -207,27 +317,313 @@ class GradientDescent(UniformParameterOptimizer):
 
 class MultiplicativeGradientDescent(UniformParameterOptimizer):
 
-    def __init__(self, factor = 0.01):
+    def __init__(self, factor = 0.01, fuse_updates = False, sparse_updates = False):
         self.factor = factor
+        self.fuse_updates = fuse_updates
+        self.sparse_updates = sparse_updates
 
     def _update_param(self, param, gradient):
         multiplier = tt.exp(-tt.tanh(gradient)*self.factor)
         add_update(param, param*multiplier)
 
 
-def get_named_optimizer(name, learning_rate, rng = None):
+@symbolic_updater
+class AccumulatingOptimizer(IGradientOptimizer):
+    """
+    Wraps another optimizer so that gradients are summed over n_steps calls, and the wrapped optimizer's update is only
+    applied (with the average gradient) on every n_steps'th call.  This lets you train with a large "virtual" minibatch
+    when a real one wouldn't fit in memory: n_steps calls with minibatches of size N act like one call with a minibatch
+    of size n_steps*N (for a cost that's a mean over samples).
+
+    The choice of whether to apply the update is made inside the compiled function (with ifelse), so there's no
+    recompilation, and the update itself is only computed on the steps where it's applied.
+    """
+
+    def __init__(self, optimizer, n_steps):
+        """
+        :param optimizer: An optimizer with an update_from_gradients method (e.g. a UniformParameterOptimizer)
+        :param n_steps: Number of calls over which to accumulate gradients
+        """
+        assert hasattr(optimizer, 'update_from_gradients'), 'Can only accumulate gradients for an optimizer with an update_from_gradients method.'
+        assert n_steps >= 1, 'n_steps must be at least 1.  Got %s' % (n_steps, )
+        self._optimizer = optimizer
+        self._n_steps = n_steps
+
+    def __call__(self, cost, parameters, constants = []):
+        gradients = theano.grad(cost, parameters, consider_constant = constants)
+        self.update_from_gradients(parameters, gradients)
+
+    @symbolic_updater
+    def update_from_gradients(self, parameters, gradients):
+        counter = theano.shared(np.array(0, dtype = 'int64'), name = 'accumulation_counter')
+        gradient_sums = [theano.shared(np.zeros_like(p.get_value()), name = 'gradient_sum') for p in parameters]
+        new_count = counter + 1
+        apply_now = tt.ge(new_count, self._n_steps)
+        new_gradient_sums = [s + g for s, g in zip(gradient_sums, gradients)]
+
+        with StateCatcher(swallow_updates = True) as sc:
+            self._optimizer.update_from_gradients(parameters, [s / self._n_steps for s in new_gradient_sums])
+        shared_vars, new_values = zip(*sc.get_updates())
+        new_values = [tt.patternbroadcast(tt.cast(v, var.dtype), var.broadcastable) for var, v in zip(shared_vars, new_values)]
+        for var, val in zip(shared_vars, ifelse(apply_now, new_values, list(shared_vars))):
+            add_update(var, val)
+        for s, new_s in zip(gradient_sums, new_gradient_sums):
+            add_update(s, ifelse(apply_now, tt.zeros_like(new_s), new_s))
+        add_update(counter, ifelse(apply_now, tt.zeros_like(new_count), new_count))
+
+
+@symbolic_updater
+class MixedPrecisionOptimizer(IGradientOptimizer):
+    """
+    Wraps another optimizer so that it works on high-precision (e.g. float64) "master" copies of low-precision (e.g.
+    float32) parameters.  The forward and backward passes use the low-precision parameters (so they run at float32
+    speed), but the gradients are cast up, and the update is applied to the master copies (and the optimizer's state,
+    such as momentum, is kept at the same precision).  The parameters are then set to the rounded master copies.  This
+    way, updates that are too small to change a float32 parameter on their own still accumulate.
+
+    Note that the master copies are only changed by this optimizer, so if you change the parameters in some other way
+    (e.g. with set_value), the change will be overwritten on the next update.
+    """
+
+    def __init__(self, optimizer, master_dtype = 'float64'):
+        """
+        :param optimizer: An optimizer with an update_from_gradients method (e.g. a UniformParameterOptimizer)
+        :param master_dtype: The dtype of the master copies of parameters.
+        """
+        assert hasattr(optimizer, 'update_from_gradients'), 'Can only wrap an optimizer with an update_from_gradients method.'
+        self._optimizer = optimizer
+        self._master_dtype = master_dtype
+
+    def __call__(self, cost, parameters, constants = []):
+        gradients = theano.grad(cost, parameters, consider_constant = constants)
+        self.update_from_gradients(parameters, gradients)
+
+    @symbolic_updater
+    def update_from_gradients(self, parameters, gradients):
+        master_copies = [p if p.dtype == self._master_dtype else
+            theano.shared(p.get_value().astype(self._master_dtype), name = 'master_copy_of_%s' % (p.name, ), broadcastable = p.broadcastable)
+            for p in parameters]
+        with StateCatcher(swallow_updates = True) as sc:
+            self._optimizer.update_from_gradients(master_copies, [tt.cast(g, self._master_dtype) for g in gradients])
+        updates = OrderedDict(sc.get_updates())
+        for shared_var, new_val in updates.iteritems():
+            add_update(shared_var, new_val)
+        for p, master_copy in zip(parameters, master_copies):
+            if master_copy is not p and master_copy in updates:
+                add_update(p, tt.cast(updates[master_copy], p.dtype))
+
+
+def _find_row_indexed_parameters(cost, parameters):
+    """
+    Find the parameters which the cost only depends on through a single row-indexing operation (AdvancedSubtensor1,
+    e.g. w[indices] where indices is an integer vector).
+    :return: A dict mapping each such parameter to (selected_rows, indices)
+    """
+    clients = {}
+    for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs([cost]), [cost]):
+        for i, inp in enumerate(node.inputs):
+            clients.setdefault(inp, []).append((node, i))
+    row_indexed = {}
+    for p in parameters:
+        if len(clients.get(p, [])) == 1:
+            (node, i), = clients[p]
+            if isinstance(node.op, tt.subtensor.AdvancedSubtensor1) and i == 0:
+                row_indexed[p] = (node.outputs[0], node.inputs[1])
+    return row_indexed
+
+
+def _split_flat(flat_vector, parameters):
+    """
+    :param flat_vector: A symbolic vector with as many elements as there are in all the parameters combined
+    :param parameters: A list of shared variables
+    :return: A list of symbolic variables, shaped (and broadcastable) like the parameters, formed from the vector.
+    """
+    ends = np.cumsum([p.get_value().size for p in parameters])
+    return [tt.patternbroadcast(flat_vector[start:end].reshape(p.get_value().shape), p.broadcastable)
+        for p, start, end in zip(parameters, np.concatenate([[0], ends[:-1]]), ends)]
+
+
+def _cost_at(cost, parameters, flat_params):
+    """
+    :return: The cost, re-evaluated with the parameters replaced by the values in the flat vector flat_params
+    """
+    return theano.clone(cost, replace = dict(zip(parameters, _split_flat(flat_params, parameters))))
+
+
+def _line_search(cost, parameters, flat_params, direction, step_sizes):
+    """
+    Evaluate the cost at flat_params - step_size*direction for each of a fixed set of step sizes (all within the same
+    compiled function), and return the step size giving the lowest cost.
+    """
+    costs = tt.stack([_cost_at(cost, parameters, flat_params - step_size*direction) for step_size in step_sizes])
+    costs = tt.switch(tt.isnan(costs), np.inf, costs)
+    return tt.constant(np.array(step_sizes, dtype = theano.config.floatX))[tt.argmin(costs)]
+
+
+@symbolic_updater
+class LBFGS(IGradientOptimizer):
+    """
+    Limited-memory BFGS, for full-batch training.  Each call does one iteration: it records the change in parameters and
+    gradients since the last call, uses the last n_memory of these to approximate the inverse Hessian (with the usual
+    two-loop recursion, unrolled into the graph), and then takes a step along the resulting direction, with the step
+    size chosen by evaluating the cost at each of line_search_steps.
+
+    The parameters are treated as one flat vector.  Since the cost is re-evaluated for the line search, this only makes
+    sense when the cost is computed on the same data at every call (i.e. full-batch training).
+
+    See:
+    Nocedal J, Wright S - Numerical Optimization, Algorithm 7.4
+    """
+
+    def __init__(self, n_memory = 10, line_search_steps = (1., 0.5, 0.25, 0.1, 0.01, 0.001), min_curvature = 1e-10):
+        """
+        :param n_memory: Number of past (parameter change, gradient change) pairs to remember
+        :param line_search_steps: Step sizes to try along the search direction on each iteration.
+        :param min_curvature: Pairs where the curvature (dot product of parameter and gradient change) is below this
+            are not recorded, to keep the inverse Hessian approximation positive definite.
+        """
+        self.n_memory = n_memory
+        self.line_search_steps = line_search_steps
+        self.min_curvature = min_curvature
+
+    def __call__(self, cost, parameters, constants = []):
+        gradients = theano.grad(cost, parameters, consider_constant = constants)
+        x = tt.concatenate([p.flatten() for p in parameters])
+        g = tt.concatenate([gr.flatten() for gr in gradients])
+        n_params = sum(p.get_value().size for p in parameters)
+        s_memory = theano.shared(np.zeros((self.n_memory, n_params), dtype = x.dtype), name = 'lbfgs_s')
+        y_memory = theano.shared(np.zeros((self.n_memory, n_params), dtype = x.dtype), name = 'lbfgs_y')
+        rho_memory = theano.shared(np.zeros(self.n_memory, dtype = x.dtype), name = 'lbfgs_rho')  # 0 for empty slots
+        prev_x = theano.shared(np.zeros(n_params, dtype = x.dtype), name = 'lbfgs_prev_x')
+        prev_g = theano.shared(np.zeros(n_params, dtype = x.dtype), name = 'lbfgs_prev_g')
+        is_started = theano.shared(np.array(0, dtype = 'int8'), name = 'lbfgs_started')
+
+        # Record the latest pair, dropping the oldest one (newest pairs are last)
+        s = x - prev_x
+        y = g - prev_g
+        curvature = s.dot(y)
+        is_valid = tt.and_(is_started, curvature > self.min_curvature)
+        s_memory_new = tt.switch(is_valid, tt.concatenate([s_memory[1:], s.dimshuffle('x', 0)]), s_memory)
+        y_memory_new = tt.switch(is_valid, tt.concatenate([y_memory[1:], y.dimshuffle('x', 0)]), y_memory)
+        rho_memory_new = tt.switch(is_valid, tt.concatenate([rho_memory[1:], (1./tt.maximum(curvature, self.min_curvature)).dimshuffle('x')]), rho_memory)
+
+        # Two-loop recursion.  Empty slots have rho=0 so they have no effect.
+        q = g
+        alphas = []
+        for i in reversed(xrange(self.n_memory)):
+            alpha = rho_memory_new[i] * s_memory_new[i].dot(q)
+            q = q - alpha * y_memory_new[i]
+            alphas.insert(0, alpha)
+        newest_s, newest_y = s_memory_new[-1], y_memory_new[-1]
+        gamma = tt.switch(rho_memory_new[-1] > 0, newest_s.dot(newest_y) / tt.maximum(newest_y.dot(newest_y), self.min_curvature),
+            1. / tt.maximum(g.norm(2), self.min_curvature))  # Before we have any curvature information, take a normalized gradient step
+        direction = gamma * q
+        for i in xrange(self.n_memory):
+            beta = rho_memory_new[i] * y_memory_new[i].dot(direction)
+            direction = direction + s_memory_new[i] * (alphas[i] - beta)
+
+        step_size = _line_search(cost, parameters, x, direction, self.line_search_steps)
+        for p, new_p in zip(parameters, _split_flat(x - step_size * direction, parameters)):
+            add_update(p, new_p)
+        add_update(s_memory, s_memory_new)
+        add_update(y_memory, y_memory_new)
+        add_update(rho_memory, rho_memory_new)
+        add_update(prev_x, x)
+        add_update(prev_g, g)
+        add_update(is_started, tt.ones_like(is_started))
+
+
+@symbolic_updater
+class HessianFree(IGradientOptimizer):
+    """
+    Hessian-free optimization, for full-batch training.  Each call does one iteration: it approximately solves
+    (H + damping*I) d = g with n_cg_steps of conjugate gradient (unrolled into the graph), where products with the
+    Hessian H are computed with theano.gradient.Lop, so H is never formed.  It then steps along -d, with the step size
+    chosen by evaluating the cost at each of line_search_steps.  The damping is adapted Levenberg-Marquardt style, by
+    comparing the actual reduction in cost with the reduction predicted by the quadratic model, and CG is warm-started
+    from the previous solution.
+
+    As with LBFGS, parameters are treated as one flat vector, and the cost should be computed on the same data at every
+    call.
+
+    See paper:
+    Deep learning via Hessian-free optimization
+    Martens J
+    http://www.cs.toronto.edu/~jmartens/docs/Deep_HessianFree.pdf
+    """
+
+    def __init__(self, n_cg_steps = 10, initial_damping = 1., warm_start_decay = 0.95,
+            line_search_steps = (1., 0.5, 0.25, 0.1, 0.01)):
+        """
+        :param n_cg_steps: Number of conjugate gradient steps per iteration
+        :param initial_damping: Initial value of the damping term added to the diagonal of the Hessian
+        :param warm_start_decay: CG starts from this times the previous iteration's solution.
+        :param line_search_steps: Step sizes to try along the search direction on each iteration.
+        """
+        self.n_cg_steps = n_cg_steps
+        self.initial_damping = initial_damping
+        self.warm_start_decay = warm_start_decay
+        self.line_search_steps = line_search_steps
+
+    def __call__(self, cost, parameters, constants = []):
+        gradients = theano.grad(cost, parameters, consider_constant = constants)
+        x = tt.concatenate([p.flatten() for p in parameters])
+        g = tt.concatenate([gr.flatten() for gr in gradients])
+        n_params = sum(p.get_value().size for p in parameters)
+        damping = theano.shared(np.array(self.initial_damping, dtype = x.dtype), name = 'hf_damping')
+        prev_direction = theano.shared(np.zeros(n_params, dtype = x.dtype), name = 'hf_prev_direction')
+
+        def hessian_product(v):
+            return tt.concatenate([hv.flatten() for hv in theano.gradient.Lop(gradients, parameters, _split_flat(v, parameters))])
+
+        eps = 1e-20
+        direction = self.warm_start_decay * prev_direction
+        residual = g - hessian_product(direction) - damping * direction
+        search = residual
+        residual_norm_sq = residual.dot(residual)
+        for _ in xrange(self.n_cg_steps):
+            a_search = hessian_product(search) + damping * search
+            search_curvature = search.dot(a_search)
+            alpha = tt.switch(search_curvature > 0, residual_norm_sq / tt.maximum(search_curvature, eps), 0)  # Stop on negative curvature
+            direction = direction + alpha * search
+            residual = residual - alpha * a_search
+            new_residual_norm_sq = residual.dot(residual)
+            search = residual + (new_residual_norm_sq / tt.maximum(residual_norm_sq, eps)) * search
+            residual_norm_sq = new_residual_norm_sq
+
+        # Levenberg-Marquardt adjustment of the damping
+        predicted_reduction = g.dot(direction) - 0.5 * direction.dot(hessian_product(direction))
+        actual_reduction = cost - _cost_at(cost, parameters, x - direction)
+        reduction_ratio = tt.switch(predicted_reduction > 0, actual_reduction / tt.maximum(predicted_reduction, eps), 0)
+        new_damping = tt.switch(reduction_ratio < 0.25, damping * 1.5, tt.switch(reduction_ratio > 0.75, damping * 2./3, damping))
+
+        step_size = _line_search(cost, parameters, x, direction, self.line_search_steps)
+        for p, new_p in zip(parameters, _split_flat(x - step_size * direction, parameters)):
+            add_update(p, new_p)
+        add_update(damping, tt.cast(new_damping, damping.dtype))
+        add_update(prev_direction, direction)
+
+
+def get_named_optimizer(name, learning_rate, rng = None, fuse_updates = False, sparse_updates = False, master_dtype = None):
     """
     Convenience function for easily specifying optimizers.
     :param name: The name of the optimizer
-    :param learning_rate: A scalar, representing the parameter that's most equivalent to a learning rate.
+    :param learning_rate: A scalar, representing the parameter that's most equivalent to a learning rate, or a
+        LearningRateSchedule, if the rate should change during training without recompiling.
+    :param fuse_updates: Update all parameters as one flat vector (see UniformParameterOptimizer)
+    :param sparse_updates: Only update the rows of row-indexed parameters that were used (see UniformParameterOptimizer).
+        Not supported for 'langevin'.
+    :param master_dtype: Optionally, a dtype (e.g. 'float64') in which to keep master copies of parameters and
+        optimizer state (see MixedPrecisionOptimizer).
     :return: An IGradientOptimizer object.
     """
-    return {
-        'sgd': lambda: SimpleGradientDescent(eta = learning_rate),
-        'adam': lambda: Adam(alpha=learning_rate),
-        'adamax': lambda: AdaMax(alpha=learning_rate),
-        'rmsprop': lambda: RMSProp(learning_rate=learning_rate),
-        'adagrad': lambda: AdaGrad(learning_rate=learning_rate),
-        'mulsgd': lambda: MultiplicativeGradientDescent(factor=learning_rate),
-        'langevin': lambda: LangevinGradientDescent(eta = learning_rate, rng = rng),
+    optimizer = {
+        'sgd': lambda: SimpleGradientDescent(eta = learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'adam': lambda: Adam(alpha=learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'adamax': lambda: AdaMax(alpha=learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'rmsprop': lambda: RMSProp(learning_rate=learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'adagrad': lambda: AdaGrad(learning_rate=learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'mulsgd': lambda: MultiplicativeGradientDescent(factor=learning_rate, fuse_updates=fuse_updates, sparse_updates=sparse_updates),
+        'langevin': lambda: LangevinGradientDescent(eta = learning_rate, rng = rng, fuse_updates=fuse_updates),
     }[name]()
+    return MixedPrecisionOptimizer(optimizer, master_dtype = master_dtype) if master_dtype is not None else optimizer
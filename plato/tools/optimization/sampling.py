@@ -6,8 +6,8 @@ from plato.interfaces.decorators import symbolic_simple
 from plato.interfaces.helpers import get_theano_rng
 from plato.tools.common.basic import softmax
 import theano
-from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
 from theano.sandbox.rng_mrg import MRG_RandomStreams
+from theano.tensor.shared_randomstreams import RandomStreams
 import theano.tensor as tt
 from theano.tensor.elemwise import TensorVariable
 
@@ -15,54 +15,76 @@ from theano.tensor.elemwise import TensorVariable
 __author__ = 'peter'
 
 
-def sample_categorical(rng, p, axis = -1, values = None):
+def sample_categorical(rng, p, axis = -1, values = None, method = 'inverse_cdf'):
     """
     p is a n-d array, where the final dimension is a discrete distibution (does not need to be normalized).
     Sample from that distribution.
     This will return an array of shape p.shape[:-1] with values in range [0, p.shape[-1])
 
-    :param rng: A theano shared_randomstreams.RandomStream object
+    The sampling is done from uniform random numbers, so that all random number generators (MRG, default, CURAND, or a
+    tensor of externally generated uniform numbers) do the same thing, and give the same samples given the same
+    random numbers.
+
+    :param rng: A theano random stream (MRG, default, or CURAND), or a tensor of uniform random numbers in [0, 1).  If
+        a tensor, it must contain at least as many numbers as we need (p.size/p.shape[-1] for 'inverse_cdf', p.size for
+        'gumbel'), and we use the first ones.
     :param p: An ndarray of arbitrary shape, where the values along (axis) are interpreted as an unnormalized
         discrete probability distribution (so if p.shape[2]==5, it means that the variable can take on 5 possible
         values).
     :param axis: The axis which we consider to be the distribution (only -1 (last axis)) supported now.
     :param values: The values of the variable.  len(values) must equal p.shape[axis].  If not included, the
         values will be considered to be integers in range(0, p.shape[axis])
+    :param method: How to turn the uniform numbers into samples:
+        'inverse_cdf': One uniform number per distribution, compared against the cumulative probability mass.
+        'gumbel': The Gumbel-max trick: One uniform number per element of p: argmax(log(p) + gumbel noise)
+        'multinomial': The random stream's own multinomial (not available for CURAND or external random numbers)
+    :return: An array of shape p.shape[:-1] containing the samples.
     """
-    # TODO: assert no negative values in p / assert p normalized along axis instead of dividing
+    # TODO: assert no negative values in p
     # TODO: assert len(values) == p.shape[axis]
     assert axis == -1, 'Currenly you can only sample along the last axis.'
-    p = p/tt.sum(p, axis = axis, keepdims=True)
-    # TODO: Check that differnt RNGs are doing the same thing!
-
-    if isinstance(rng, TensorVariable):
-        # Externally generated random numbers - we receive the maximum number of uniform random numbers
-        # we could need, and then generate samplews from thos.
-        old_p_shape = p.shape
-        random_numbers = rng[:p.size].reshape((p.size, 1))
-        cumulative_prob_mass = tt.cumsum(p.reshape((-1, p.shape[-1])), axis = 1)
-        samples = random_numbers < cumulative_prob_mass
-        samples.reshape(old_p_shape)
+    assert method in ('inverse_cdf', 'gumbel', 'multinomial'), 'Unknown sampling method: %s' % (method, )
+
+    if method == 'inverse_cdf':
+        cumulative_prob_mass = tt.cumsum(p, axis = -1)
+        leading = (slice(None), )*(p.ndim-1)  # (Theano doesn't support Ellipsis indexing)
+        uniform = _get_uniform(rng, p.shape[:-1], p.ndim-1) * cumulative_prob_mass[leading+(-1, )]  # (p.shape[:-1])
+        # Count the values whose cumulative mass falls under the random number (a searchsorted, for small K)
+        indices = tt.sum(tt.shape_padright(uniform) >= cumulative_prob_mass[leading+(slice(None, -1), )], axis = -1)
+    elif method == 'gumbel':
+        uniform = _get_uniform(rng, p.shape, p.ndim)
+        gumbel_noise = -tt.log(-tt.log(tt.clip(uniform, 1e-20, 1)))
+        indices = tt.argmax(tt.log(p) + gumbel_noise, axis = -1)
     elif isinstance(rng, MRG_RandomStreams):
-        # MRG_RandomStreams is faster but only works for 2-d pvals, so we have to reshape and
-        # then unreshape.
-        old_p_shape = p.shape
-        samples = rng.multinomial(n=1, pvals = p.reshape((-1, p.shape[-1])))
-        samples = samples.reshape(old_p_shape)
-    elif isinstance(rng, CURAND_RandomStreams):
-        # TODO: Make this work if possible - problem now is it needs to know shape in advance
-        raise NotImplementedError("Curand doesn't work yet.")
-        cumulative_prob_mass = np.cumsum(p, axis = axis)
-        samples = rng.uniform(size = tt.set_subtensor(p.shape[axis], 1)) > cumulative_prob_mass
-    else:
+        # MRG_RandomStreams only works for 2-d pvals, so we have to reshape and then unreshape.
+        p = p/tt.sum(p, axis = axis, keepdims=True)
+        samples = rng.multinomial(n=1, pvals = p.reshape((-1, p.shape[-1]))).reshape(p.shape)
+        indices = tt.argmax(samples, axis = -1)  # Argmax is just a way to find the location of the only element that is 1.
+    elif isinstance(rng, RandomStreams):
+        p = p/tt.sum(p, axis = axis, keepdims=True)
         samples = tt.switch(tt.eq(p.size, 0), tt.zeros(p.shape), rng.multinomial(n=1, pvals = tt.switch(tt.eq(p.size, 0), 1, p)))
+        indices = tt.argmax(samples, axis = -1)
+    else:
+        raise NotImplementedError("Method 'multinomial' isn't available for random number source %s" % (rng, ))
 
-    indices = tt.argmax(samples, axis = -1)  # Argmax is just a way to find the location of the only element that is 1.
     if values is not None:
         return values[indices]
     return indices
 
 
+def _get_uniform(rng, shape, ndim):
+    """
+    :param rng: A theano random stream or a tensor of uniform random numbers
+    :param shape: The (symbolic) shape of the array of uniform numbers we want
+    :param ndim: The number of dimensions of that array
+    :return: An array of uniform random numbers in [0, 1)
+    """
+    if isinstance(rng, TensorVariable):
+        return rng.flatten()[:tt.prod(shape)].reshape(shape, ndim = ndim)
+    else:
+        return rng.uniform(size = shape, ndim = ndim)
+
+
 bernoulli_likelihood = lambda k, p: tt.switch(k, p, 1-p)  # or (p**k)*((1-p)**(1-k))
 
 
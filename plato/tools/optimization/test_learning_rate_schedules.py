@@ -0,0 +1,96 @@
+from plato.interfaces.decorators import symbolic_updater
+from plato.tools.optimization.learning_rate_schedules import StepSchedule, ExponentialSchedule, CosineSchedule, \
+    WarmupSchedule, ReduceOnPlateauSchedule, ConstantSchedule
+from plato.tools.optimization.optimizers import get_named_optimizer, SimpleGradientDescent, Adam
+import numpy as np
+import theano
+
+__author__ = 'peter'
+
+
+def _get_rates_in_graph(schedule, n_steps):
+    """
+    Run n_steps of gradient descent on a dummy parameter, and return the rate used on each step.
+    """
+    w = theano.shared(np.zeros(1), name = 'w')
+    train = symbolic_updater(lambda: SimpleGradientDescent(eta = schedule)(cost = -w.sum(), parameters = [w])).compile()
+    rates = []
+    for _ in xrange(n_steps):
+        before = w.get_value()[0]
+        train()
+        rates.append(w.get_value()[0] - before)
+    return np.array(rates)
+
+
+def test_schedules_in_graph():
+
+    for schedule, expected in [
+            (StepSchedule(1., step_size = 3, gamma = 0.5), [1, 1, 1, .5, .5, .5, .25, .25]),
+            (ExponentialSchedule(1., decay = 0.5), [1, .5, .25, .125, .0625, .03125, .015625, .0078125]),
+            (CosineSchedule(1., n_steps = 4), [1, .5+.5*np.cos(np.pi/4), .5, .5-.5*np.cos(np.pi/4), 0, 0, 0, 0]),
+            (WarmupSchedule(StepSchedule(1., step_size = 3, gamma = 0.5), n_steps = 4), [.25, .5, .75, .5, .5, .5, .25, .25]),
+            ]:
+        rates = _get_rates_in_graph(schedule, n_steps = 8)
+        assert np.allclose(rates, expected), 'Rates %s did not match %s' % (rates, expected)
+        assert schedule.get_step() == 8
+
+
+def test_schedules_from_python():
+
+    schedule = ExponentialSchedule(1., decay = 0.5, advance_in_graph = False)
+    rates = _get_rates_in_graph(schedule, n_steps = 3)
+    assert np.allclose(rates, 1)
+    schedule.step(2)
+    assert np.allclose(_get_rates_in_graph(schedule, n_steps = 2), .25)
+    schedule.set_step(0)
+    assert schedule.get_value() == 1
+
+    schedule = ConstantSchedule(1., advance_in_graph = False)
+    w = theano.shared(np.zeros(1), name = 'w')
+    train = symbolic_updater(lambda: SimpleGradientDescent(eta = schedule)(cost = -w.sum(), parameters = [w])).compile()
+    train()
+    schedule.set_rate(3.)
+    train()
+    assert np.allclose(w.get_value(), 4)
+
+    plateau = ReduceOnPlateauSchedule(1., factor = 0.5, patience = 2)
+    rates = [plateau.report(score) for score in [5, 4, 4, 4, 4, 3, 3]]
+    assert np.allclose(rates, [1, 1, 1, 1, .5, .5, .5])
+
+
+def test_named_optimizers_with_schedules():
+
+    for name in ['sgd', 'adam', 'adamax', 'rmsprop', 'adagrad', 'mulsgd', 'langevin']:
+        schedule = ExponentialSchedule(0.01, decay = 0.9)
+        w = theano.shared(np.ones(3), name = 'w')
+        optimizer = get_named_optimizer(name, learning_rate = schedule)
+        train = symbolic_updater(lambda: optimizer(cost = (w**2).sum(), parameters = [w])).compile()
+        for _ in xrange(3):
+            train()
+        assert schedule.get_step() == 3, name
+        assert np.isclose(schedule.get_value(), 0.01*0.9**3), name
+
+
+def test_schedules_as_other_hyperparameters():
+
+    schedule = ConstantSchedule(0.1)
+    for expression, expected in [(1. - schedule, 0.9), (schedule - 1., -0.9), (2 * schedule, 0.2), (1. / schedule, 10.),
+            (2. ** schedule, 2.**0.1), (schedule ** 2, 0.01), (-schedule, -0.1), (schedule + 1, 1.1)]:
+        assert np.isclose(expression.eval(), expected)
+
+    final_params = []
+    for beta_1 in (0.1, ConstantSchedule(0.1)):
+        w = theano.shared(np.ones(3), name = 'w')
+        train = symbolic_updater(lambda: Adam(alpha = 0.01, beta_1 = beta_1)(cost = (w**2).sum(), parameters = [w])).compile()
+        for _ in xrange(3):
+            train()
+        final_params.append(w.get_value())
+    assert np.allclose(*final_params)
+    assert beta_1.get_step() == 3
+
+
+if __name__ == '__main__':
+    test_schedules_in_graph()
+    test_schedules_from_python()
+    test_named_optimizers_with_schedules()
+    test_schedules_as_other_hyperparameters()
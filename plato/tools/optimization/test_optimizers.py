@@ -1,7 +1,13 @@
 from plato.tools.optimization.demo_compare_optimizers import get_experiments
-from plato.tools.optimization.optimizers import GradientDescent, Adam, AdaMax
+from plato.core import symbolic_updater
+from plato.tools.mlp.mlp import MultiLayerPerceptron
+from plato.tools.optimization.cost import negative_log_likelihood_dangerous
+from plato.tools.optimization.optimizers import GradientDescent, Adam, AdaMax, get_named_optimizer, AccumulatingOptimizer, \
+    MixedPrecisionOptimizer, SimpleGradientDescent, LBFGS, HessianFree
 from plato.tools.regressors.online_regressor import OnlineRegressor
 from utils.predictors.predictor_tests import assert_online_predictor_not_broken
+import numpy as np
+import theano
 
 
 def _test_optimizer_on_simple_classification_problem(optimizer):
@@ -32,10 +38,185 @@ def test_adamax_optimizer():
     _test_optimizer_on_simple_classification_problem(AdaMax(alpha=0.01))
 
 
+def test_fused_updates():
+    """
+    Check that updating all parameters as one flat vector gives the same result as updating them separately.
+    """
+    rng = np.random.RandomState(1234)
+    x = rng.randn(10, 8)
+    y = rng.randint(3, size = 10)
+
+    for optimizer_name in ('sgd', 'adam', 'adamax', 'rmsprop', 'adagrad', 'mulsgd'):
+        final_params = []
+        for fuse_updates in (False, True):
+            mlp = MultiLayerPerceptron.from_init(layer_sizes = [8, 6, 5, 3], hidden_activation = 'tanh',
+                output_activation = 'softmax', w_init = 0.1, rng = 1234)
+            optimizer = get_named_optimizer(optimizer_name, learning_rate = 0.01, fuse_updates = fuse_updates)
+
+            @symbolic_updater
+            def train(x, y):
+                optimizer(cost = negative_log_likelihood_dangerous(mlp(x), y), parameters = mlp.parameters)
+
+            f = train.compile()
+            for _ in xrange(3):
+                f(x, y)
+            final_params.append([p.get_value() for p in mlp.parameters])
+        assert all(np.allclose(p_separate, p_fused) for p_separate, p_fused in zip(*final_params)), optimizer_name
+
+
+def test_accumulating_optimizer():
+    """
+    Check that accumulating gradients over 4 minibatches of 5 gives the same update as one minibatch of 20.
+    """
+    rng = np.random.RandomState(1234)
+    x = rng.randn(20, 8)
+    y = rng.randint(3, size = 20)
+
+    for optimizer_name in ('sgd', 'adam'):
+        mlps = [MultiLayerPerceptron.from_init(layer_sizes = [8, 6, 3], hidden_activation = 'tanh',
+            output_activation = 'softmax', w_init = 0.1, rng = 1234) for _ in xrange(2)]
+        optimizers = [get_named_optimizer(optimizer_name, learning_rate = 0.1), AccumulatingOptimizer(get_named_optimizer(optimizer_name, learning_rate = 0.1), n_steps = 4)]
+        train_functions = []
+        for mlp, optimizer in zip(mlps, optimizers):
+            @symbolic_updater
+            def train(x, y, mlp=mlp, optimizer=optimizer):
+                optimizer(cost = negative_log_likelihood_dangerous(mlp(x), y), parameters = mlp.parameters)
+            train_functions.append(train.compile())
+        big_batch_train, accumulating_train = train_functions
+        initial_params = [p.get_value() for p in mlps[1].parameters]
+
+        for big_step in xrange(2):
+            big_batch_train(x, y)
+            for i in xrange(4):
+                accumulating_train(x[i*5:(i+1)*5], y[i*5:(i+1)*5])
+                if big_step == 0 and i < 3:  # No update until the 4th call
+                    assert all(np.array_equal(p0, p.get_value()) for p0, p in zip(initial_params, mlps[1].parameters))
+            assert all(np.allclose(p_big.get_value(), p_acc.get_value()) for p_big, p_acc in zip(mlps[0].parameters, mlps[1].parameters)), optimizer_name
+
+
+def test_mixed_precision_optimizer():
+    """
+    Check that updates too small to change a float32 parameter still accumulate when there's a float64 master copy.
+    """
+    for optimizer, expect_change in [
+            (SimpleGradientDescent(eta = np.float32(1e-9)), False),
+            (MixedPrecisionOptimizer(SimpleGradientDescent(eta = 1e-9), master_dtype = 'float64'), True),
+            (get_named_optimizer('sgd', learning_rate = 1e-9, master_dtype = 'float64'), True),
+            ]:
+        w = theano.shared(np.ones(3, dtype = 'float32'))
+
+        @symbolic_updater
+        def train(x):
+            optimizer(cost = (x*w).sum(), parameters = [w])
+
+        f = train.compile()
+        for _ in xrange(1000):
+            f(np.ones(3, dtype = 'float32'))
+        assert w.get_value().dtype == 'float32'
+        if expect_change:
+            assert np.allclose(w.get_value(), 1 - 1e-6, rtol = 0, atol = 1e-7)
+        else:
+            assert np.array_equal(w.get_value(), np.ones(3))
+
+
+def test_sparse_updates():
+    """
+    Check that when parameters are only used through row-indexing, sparse updates match dense ones for plain gradient
+    descent, and leave unused rows alone for optimizers with state.
+    """
+    rng = np.random.RandomState(1234)
+    n_words, n_dims = 50, 4
+    index_batches = [rng.randint(10, size = 8) for _ in xrange(5)]  # Only the first 10 rows get used, with repeats
+    targets = rng.randn(8, n_dims)
+    initial_w = rng.randn(n_words, n_dims)
+    initial_v = rng.randn(n_dims, n_dims)
+
+    for optimizer_name in ('sgd', 'adam', 'adamax', 'rmsprop', 'adagrad', 'mulsgd'):
+        final_params = []
+        for sparse_updates in (False, True):
+            w = theano.shared(initial_w.copy(), name = 'w')
+            v = theano.shared(initial_v.copy(), name = 'v')  # A dense parameter
+            optimizer = get_named_optimizer(optimizer_name, learning_rate = 0.01, sparse_updates = sparse_updates)
+
+            @symbolic_updater
+            def train(indices):
+                optimizer(cost = ((w[indices].dot(v) - targets)**2).sum(), parameters = [w, v])
+
+            f = train.compile()
+            for indices in index_batches:
+                f(indices)
+            final_params.append((w.get_value(), v.get_value()))
+            if sparse_updates:
+                assert np.array_equal(w.get_value()[10:], initial_w[10:])
+                used_rows = np.unique(np.concatenate(index_batches))
+                assert not np.any(np.all(w.get_value()[used_rows] == initial_w[used_rows], axis = 1))
+        if optimizer_name in ('sgd', 'adagrad', 'mulsgd'):  # Stateless or state that doesn't change without gradients
+            (w_dense, v_dense), (w_sparse, v_sparse) = final_params
+            assert np.allclose(w_dense, w_sparse) and np.allclose(v_dense, v_sparse), optimizer_name
+
+
+def test_second_order_optimizers():
+    """
+    Check that on a full-batch problem, LBFGS and Hessian-free get to the least-squares solution in a few tens of
+    iterations, where gradient descent does not.
+    """
+    rng = np.random.RandomState(1234)
+    x = rng.randn(50, 10) * np.logspace(0, 1, 10)  # Badly conditioned
+    y = x.dot(rng.randn(10, 2)) + 0.1*rng.randn(50, 2)
+    w_opt = np.linalg.lstsq(x, y, rcond = None)[0]
+    optimal_cost = ((x.dot(w_opt) - y)**2).sum(axis=1).mean()
+
+    final_costs = {}
+    for name, optimizer in [('sgd', SimpleGradientDescent(eta = 0.005)), ('lbfgs', LBFGS()), ('hf', HessianFree())]:
+        w = theano.shared(np.zeros((10, 2)), name = 'w')
+        b = theano.shared(np.zeros(2), name = 'b')
+
+        @symbolic_updater
+        def train(x, y):
+            optimizer(cost = ((x.dot(w) + b - y)**2).sum(axis=1).mean(), parameters = [w, b])
+
+        f = train.compile()
+        for _ in xrange(30):
+            f(x, y)
+        final_costs[name] = ((x.dot(w.get_value()) + b.get_value() - y)**2).sum(axis=1).mean()
+
+    assert final_costs['sgd'] > 1.1 * optimal_cost
+    assert final_costs['lbfgs'] < 1.01 * optimal_cost
+    assert final_costs['hf'] < 1.01 * optimal_cost
+
+
+def test_second_order_optimizers_on_mlp():
+
+    rng = np.random.RandomState(1234)
+    x = rng.randn(40, 8)
+    y = rng.randint(3, size = 40)
+    for optimizer in (LBFGS(n_memory = 5), HessianFree(n_cg_steps = 5)):
+        mlp = MultiLayerPerceptron.from_init(layer_sizes = [8, 6, 3], hidden_activation = 'tanh',
+            output_activation = 'softmax', w_init = 0.1, rng = 1234)
+
+        @symbolic_updater
+        def train(x, y):
+            optimizer(cost = negative_log_likelihood_dangerous(mlp(x), y), parameters = mlp.parameters)
+
+        f = train.compile()
+        predict = mlp.compile()
+        initial_cost = -np.log(predict(x)[np.arange(40), y]).mean()
+        for _ in xrange(20):
+            f(x, y)
+        final_cost = -np.log(predict(x)[np.arange(40), y]).mean()
+        assert final_cost < 0.5 * initial_cost
+
+
 if __name__ == '__main__':
     test_gradient_descent_optimizer()
     test_adam_optimizer()
     test_adamax_optimizer()
+    test_fused_updates()
+    test_accumulating_optimizer()
+    test_mixed_precision_optimizer()
+    test_sparse_updates()
+    test_second_order_optimizers()
+    test_second_order_optimizers_on_mlp()
 
 
 def test_demo_compare_optimizers():
@@ -1,7 +1,10 @@
 from general.test_mode import set_test_mode
 from plato.interfaces.helpers import get_theano_rng
 from plato.tools.optimization.sampling import compute_hypothetical_vs, p_w_given, p_x_given, SequentialIndexGenerator, \
-    RandomIndexGenerator, OrderedIndexGenerator, RowIndexGenerator
+    RandomIndexGenerator, OrderedIndexGenerator, RowIndexGenerator, sample_categorical
+import theano
+import theano.tensor as tt
+from theano.tensor.shared_randomstreams import RandomStreams
 import pytest
 
 __author__ = 'peter'
@@ -190,10 +193,33 @@ def test_row_indices():
     assert np.array_equal(a[[3, 0, 1], :].flatten(), a[ixs2])
 
 
+def test_sample_categorical():
+
+    p = np.array([[0.1, 0.6, 0.3], [0.5, 0, 0.5], [0, 0, 2.]])
+    n_draws = 4000
+    p_batch = np.repeat(p[None], n_draws, axis = 0)  # (n_draws, 3, 3)
+    expected_frequencies = p/p.sum(axis=1, keepdims=True)
+    for rng in (get_theano_rng(seed = 1234, rngtype = 'mrg'), RandomStreams(1234)):
+        for method in ('inverse_cdf', 'gumbel', 'multinomial'):
+            samples = theano.function([], sample_categorical(rng, tt.constant(p_batch), method = method))()
+            assert samples.shape == (n_draws, 3)
+            frequencies = np.array([np.bincount(samples[:, i], minlength = 3) for i in xrange(3)]) / float(n_draws)
+            assert np.allclose(frequencies, expected_frequencies, atol = 0.03), (rng, method, frequencies)
+
+    # External random numbers give the same samples as an explicit inverse-cdf, and values are looked up.
+    uniform = np.random.RandomState(1235).rand(n_draws, 3)
+    u = tt.vector('u')
+    samples = theano.function([u], sample_categorical(u, tt.constant(p_batch), values = tt.constant(np.array([-1, 0, 1]))))(uniform.flatten())
+    cumulative = np.cumsum(p, axis = 1)
+    expected_samples = np.sum(uniform[:, :, None]*cumulative[None, :, -1:] >= cumulative[None, :, :-1], axis = 2) - 1
+    assert np.array_equal(samples, expected_samples)
+
+
 if __name__ == '__main__':
 
     set_test_mode(True)
 
+    test_sample_categorical()
     test_row_indices()
     test_matrix_indices()
     test_random_index_generator()
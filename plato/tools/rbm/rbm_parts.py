@@ -1,8 +1,8 @@
 from plato.core import symbolic_simple, initialize_param, create_shared_variable
+from plato.interfaces.helpers import get_theano_rng
 from plato.interfaces.interfaces import IParameterized, IFreeEnergy
 import theano
 import theano.tensor as tt
-from theano.tensor.shared_randomstreams import RandomStreams
 
 __author__ = 'peter'
 
@@ -78,6 +78,17 @@ class ConvolutionalBridge(IParameterized, IFreeEnergy):
         return -tt.sum(visible*self._b_rev.dimshuffle('x', 0, 'x', 'x'), axis = (2, 3))
 
 
+# The type of random stream each layer type samples with.  MRG generates binomials about twice as fast as the default
+# stream, but normals and uniforms more slowly (see utils/benchmarks/perf/sampling_benchmark.py).
+STREAM_TYPES_BY_ACTIVATION = {
+    'bernoulli': 'mrg',
+    'gaussian': 'default',
+    'adaptive_gaussian': 'default',
+    'rect-lin': 'default',
+    'relu': 'default',
+    }
+
+
 @symbolic_simple
 class StochasticNonlinearity(IParameterized, IFreeEnergy):
     """
@@ -85,14 +96,16 @@ class StochasticNonlinearity(IParameterized, IFreeEnergy):
     (see smooth method).  These are building blocks in RBMs.
     """
 
-    def __init__(self, activation_fcn, rng = None, shape = None):
+    def __init__(self, activation_fcn, rng = None, shape = None, rng_path = None):
         """
         :param activation_fcn: A string identifying the type of activation function.
             {'bernoulli', 'gaussian', 'adaptive_gaussian', 'rect-lin'}
-        :param rng: Numpy random number generator for the stochastic component
+        :param rng: Numpy random number generator or seed for the stochastic component (see get_theano_rng)
         :param shape: Optionally, reshape the output to this shape.
+        :param rng_path: Optionally, a name for this layer's random stream (e.g. 'my_rbm/hidden'), used when it is seeded
+            by a RandomStreamService.  By default, all layers share one path, and are seeded in the order they're built.
         """
-        rng = RandomStreams(rng.randint(1e9) if rng is not None else None)
+        rng = get_theano_rng(rng, rngtype = STREAM_TYPES_BY_ACTIVATION.get(activation_fcn, 'mrg'), path = rng_path)
         self.activation_fcn = activation_fcn
         self._smooth_activation_fcn, self._stochastic_activation_fcn, self._free_energy_fcn, self._params = \
             self._stochastic_layer_name_to_functions(activation_fcn, rng)
@@ -127,21 +140,21 @@ class StochasticNonlinearity(IParameterized, IFreeEnergy):
         params = []
         if activation_type == 'bernoulli':
             smooth_activation_fcn = lambda x: tt.nnet.sigmoid(x)
-            stochastic_activation_fcn = lambda x: rng.binomial(p=tt.nnet.sigmoid(x), dtype = theano.config.floatX)
+            stochastic_activation_fcn = lambda x: rng.binomial(p=tt.nnet.sigmoid(x), size = x.shape, dtype = theano.config.floatX)
             free_energy_fcn = lambda x: -tt.nnet.softplus(x).sum(axis = 1)
         elif activation_type == 'gaussian':
             smooth_activation_fcn = lambda x: x
-            stochastic_activation_fcn = lambda x: rng.normal(avg = x, std = 1)
+            stochastic_activation_fcn = lambda x: rng.normal(avg = x, std = 1, size = x.shape)
             free_energy_fcn = None
         elif activation_type == 'adaptive_gaussian':
             smooth_activation_fcn = lambda x: x
             sigma = theano.shared(1, name = 'sigma', dtype = theano.config.floatX)
-            stochastic_activation_fcn = lambda x: rng.normal(avg = x, std = sigma)
+            stochastic_activation_fcn = lambda x: rng.normal(avg = x, std = sigma, size = x.shape)
             free_energy_fcn = None
             params.append(sigma)
         elif activation_type in ('rect-lin', 'relu'):
             smooth_activation_fcn = lambda x: tt.maximum(0, x)
-            stochastic_activation_fcn = lambda x: tt.maximum(0, x+rng.normal(avg=0, std=tt.sqrt(tt.nnet.sigmoid(x)), size = x.tag.test_value.shape))
+            stochastic_activation_fcn = lambda x: tt.maximum(0, x+rng.normal(avg=0, std=tt.sqrt(tt.nnet.sigmoid(x)), size = x.shape))
             free_energy_fcn = lambda x: -tt.nnet.softplus(x).sum(axis = 1)
         else:
             raise Exception('Unknown activation type: "%s"' (activation_type, ))
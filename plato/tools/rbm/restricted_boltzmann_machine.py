@@ -22,7 +22,21 @@ def simple_rbm(visible_layer, bridge, hidden_layer):
     def propdown(h):
         return visible_layer(bridge.reverse(h))
 
+    @symbolic_multi
+    def gibbs_step_from_hidden(hidden):
+        visible = propdown(hidden)
+        return visible, propup(visible)
+
+    @symbolic_multi
+    def gibbs_step_from_visible(visible):
+        hidden = propup(visible)
+        return hidden, propdown(hidden)
+
     def get_training_fcn(n_gibbs=1, persistent = False, optimizer = SimpleGradientDescent(eta = 0.01)):
+        """
+        :param n_gibbs: Number of Gibbs steps.  The chain is a scan, so this can also be a shared variable, which you
+            can change without recompiling.
+        """
 
         @symbolic_updater
         def train(wake_visible):
@@ -32,9 +46,8 @@ def simple_rbm(visible_layer, bridge, hidden_layer):
             persistent_state = sleep_hidden = theano.shared(np.zeros(wake_hidden.tag.test_value.shape, dtype = theano.config.floatX),
                 name = 'persistend_hidden_state') if persistent else wake_hidden
 
-            for _ in xrange(n_gibbs):
-                sleep_visible = propdown(sleep_hidden)
-                sleep_hidden = propup(sleep_visible)
+            sleep_visible_chain, sleep_hidden_chain = gibbs_step_from_hidden.scan(outputs_info = [None, sleep_hidden], n_steps = n_gibbs)
+            sleep_visible, sleep_hidden = sleep_visible_chain[-1], sleep_hidden_chain[-1]
 
             wake_energy = bridge.free_energy(wake_visible) + hidden_layer.free_energy(bridge(wake_visible))
             sleep_energy = bridge.free_energy(sleep_visible) + hidden_layer.free_energy(bridge(sleep_visible))
@@ -58,7 +71,7 @@ def simple_rbm(visible_layer, bridge, hidden_layer):
 
         @symbolic_multi
         def free_sample():
-            (visible_state, hidden_state), _ = get_bounce_fcn(start_from=start_from, n_steps = n_steps, return_smooth_visible = return_smooth_visible)(persistent_state)
+            visible_state, hidden_state = get_bounce_fcn(start_from=start_from, n_steps = n_steps, return_smooth_visible = return_smooth_visible)(persistent_state)
             add_update(persistent_state, visible_state if start_from == 'visible' else hidden_state)
             return visible_state, hidden_state
         return free_sample
@@ -68,17 +81,15 @@ def simple_rbm(visible_layer, bridge, hidden_layer):
 
         @symbolic_multi
         def bounce_from_visible(visible):
-            for _ in xrange(n_steps):
-                hidden = propup(visible)
-                visible = propdown(hidden)
+            hidden_chain, visible_chain = gibbs_step_from_visible.scan(outputs_info = [None, visible], n_steps = n_steps)
+            hidden, visible = hidden_chain[-1], visible_chain[-1]
             visible = visible_layer.smooth(bridge.reverse(hidden)) if return_smooth_visible else visible
             return visible, hidden
 
         @symbolic_multi
         def bounce_from_hidden(hidden):
-            for _ in xrange(n_steps):
-                visible = propdown(hidden)
-                hidden = propup(visible)
+            visible_chain, hidden_chain = gibbs_step_from_hidden.scan(outputs_info = [None, hidden], n_steps = n_steps)
+            visible, hidden = visible_chain[-1], hidden_chain[-1]
             visible = visible_layer.smooth(bridge.reverse(hidden)) if return_smooth_visible else visible
             return visible, hidden
 
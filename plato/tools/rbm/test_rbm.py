@@ -1,5 +1,9 @@
 from plato.tools.rbm.demo_rbm import demo_rbm_mnist
 from plato.tools.rbm.demo_rbm_tutorial import demo_rbm_tutorial
+from plato.tools.rbm.restricted_boltzmann_machine import simple_rbm
+from plato.tools.rbm.rbm_parts import StochasticNonlinearity, FullyConnectedBridge
+import numpy as np
+import theano
 
 __author__ = 'peter'
 
@@ -9,4 +13,40 @@ def test_demo_rbm_mnist():
 
 
 def test_rbm_tutorial():
-    demo_rbm_tutorial()
\ No newline at end of file
+    demo_rbm_tutorial()
+
+
+def test_gibbs_chain_length():
+    """
+    The Gibbs chain is a scan, so the size of the compiled graph shouldn't depend on its length, and the length can be
+    changed through a shared variable without recompiling.
+    """
+    data = (np.random.RandomState(1234).rand(10, 20) > 0.5).astype(theano.config.floatX)
+
+    def get_rbm():
+        return simple_rbm(
+            visible_layer = StochasticNonlinearity('bernoulli'),
+            bridge = FullyConnectedBridge(w = 0.01*np.random.RandomState(1234).randn(20, 8), b = 0, b_rev = 0),
+            hidden_layer = StochasticNonlinearity('bernoulli')
+            )
+
+    graph_sizes = []
+    for n_gibbs in (5, 50):
+        train = get_rbm().get_training_fcn(n_gibbs = n_gibbs, persistent = True).compile()
+        train(data)
+        graph_sizes.append(len(train._compiled_fcn.maker.fgraph.apply_nodes))
+    assert graph_sizes[0] == graph_sizes[1]
+
+    n_steps = theano.shared(1)
+    sample = get_rbm().get_free_sampling_fcn(init_visible_state = data, n_steps = n_steps).compile()
+    visible, hidden = sample()
+    assert visible.shape == (10, 20) and hidden.shape == (10, 8)
+    compiled = sample._compiled_fcn
+    n_steps.set_value(100)
+    visible, hidden = sample()
+    assert sample._compiled_fcn is compiled
+    assert visible.shape == (10, 20) and hidden.shape == (10, 8)
+
+
+if __name__ == '__main__':
+    test_gibbs_chain_length()
@@ -1,12 +1,11 @@
 import numpy as np
 from plato.core import add_update
 from plato.interfaces.decorators import symbolic_updater, symbolic_simple
+from plato.interfaces.helpers import get_theano_rng
 from plato.tools.common.online_predictors import ISymbolicPredictor
 from plato.tools.optimization.sampling import sample_categorical
 import theano
 from theano import tensor as tt
-from theano.tensor.shared_randomstreams import RandomStreams
-from utils.tools.mymath import bernoulli
 
 __author__ = 'peter'
 
@@ -14,9 +13,23 @@ __author__ = 'peter'
 class GibbsRegressor(ISymbolicPredictor):
 
     def __init__(self, n_dim_in, n_dim_out, sample_y = False, n_alpha = 1, possible_ws = [0, 1],
-            alpha_update_policy = 'sequential', seed = None):
+            alpha_update_policy = 'sequential', alpha_chunk_size = None, max_chunk_elements = None, seed = None):
+        """
+        :param n_dim_in: Number of input dimensions
+        :param n_dim_out: Number of output dimensions
+        :param sample_y: True to predict sampled outputs, False to predict probabilities
+        :param n_alpha: Number of rows of w to resample on each call to train, or 'all' to sweep the whole matrix.
+        :param possible_ws: The values that the weights can take on
+        :param alpha_update_policy: 'sequential' or 'random': How to select the next rows to resample.
+        :param alpha_chunk_size: The n_alpha rows are resampled in chunks of this many rows.  Rows in a chunk are sampled
+            together (given the same state), and chunks are sampled one after another, each given the rows updated before
+            it.  None puts all n_alpha rows in one chunk.  1 does an exact Gibbs sweep over the n_alpha rows.
+        :param max_chunk_elements: Optionally, further limit the chunk size so that the (chunk_size, n_samples, n_dim_out,
+            n_possible_ws) temporaries hold at most this many elements.
+        :param seed: Random seed
+        """
         self._w = theano.shared(np.zeros((n_dim_in, n_dim_out), dtype = theano.config.floatX), name = 'w')
-        self._rng = RandomStreams(seed)
+        self._rng = get_theano_rng(seed, rngtype = 'default')
         if n_alpha == 'all':
             n_alpha = n_dim_in
         self._n_alpha = n_alpha
@@ -25,6 +38,8 @@ class GibbsRegressor(ISymbolicPredictor):
         self._possible_ws = theano.shared(np.array(possible_ws), name = 'possible_ws')
         assert alpha_update_policy in ('sequential', 'random')
         self._alpha_update_policy = alpha_update_policy
+        self._alpha_chunk_size = alpha_chunk_size
+        self._max_chunk_elements = max_chunk_elements
 
     def _add_alpha_update(self):
         new_alpha = (self._alpha+self._n_alpha) % self._w.shape[0] \
@@ -41,20 +56,95 @@ class GibbsRegressor(ISymbolicPredictor):
         assert x.tag.test_value.shape[0] == y.tag.test_value.shape[0]
         assert w.get_value().shape[1] == y.tag.test_value.shape[1]
         v_current = x.dot(w)  # (n_samples, n_dim_out)
-        v_0 = v_current[None, :, :] - w[alpha, None, :]*x.T[alpha, :, None]  # (n_alpha, n_samples, n_dim_out)
-        possible_vs = v_0[:, :, :, None] + possible_ws[None, None, None, :]*x.T[alpha, :, None, None]  # (n_alpha, n_samples, n_dim_out, n_possible_ws)
-        all_zs = tt.nnet.sigmoid(possible_vs)  # (n_alpha, n_samples, n_dim_out, n_possible_ws)
-        log_likelihoods = tt.sum(tt.log(bernoulli(y[None, :, :, None], all_zs[:, :, :, :])), axis = 1)  # (n_alpha, n_dim_out, n_possible_ws)
-        # Question: Need to shift for stability here or will Theano take care of that?
+        return GibbsRegressor.compute_p_wa_given_v(v_current, w[alpha], x.T[alpha].T, y, possible_ws)
+
+    @staticmethod
+    def compute_p_wa_given_v(v_current, w_alpha, x_alpha, y, possible_ws):
+        """
+        Compute the probability of the rows w_alpha taking on each of the values in possible_ws, given the current
+        pre-sigmoid outputs v_current = x.dot(w).  Keeping v_current around lets us update it incrementally, rather than
+        recomputing x.dot(w) every time some rows change.
+
+        :param v_current: (n_samples, n_dim_out) current pre-sigmoid outputs
+        :param w_alpha: (n_alpha, n_dim_out) current values of the rows being sampled
+        :param x_alpha: (n_samples, n_alpha) columns of the input corresponding to those rows
+        :param y: (n_samples, n_dim_out) binary targets
+        :param possible_ws: (n_possible_ws, ) possible weight values
+        :return: (n_alpha, n_dim_out, n_possible_ws) probabilities
+        """
+        v_0 = v_current[None, :, :] - w_alpha[:, None, :]*x_alpha.T[:, :, None]  # (n_alpha, n_samples, n_dim_out)
+        possible_vs = v_0[:, :, :, None] + possible_ws[None, None, None, :]*x_alpha.T[:, :, None, None]  # (n_alpha, n_samples, n_dim_out, n_possible_ws)
+        # log(bernoulli(y, sigm(v))) = y*v - softplus(v), which (unlike taking the log of the sigmoid) can't underflow to -inf
+        log_likelihoods = tt.sum(y[None, :, :, None]*possible_vs - tt.nnet.softplus(possible_vs), axis = 1)  # (n_alpha, n_dim_out, n_possible_ws)
         # Stupid theano didn't implement softmax very nicely so we have to do some reshaping.
-        return tt.nnet.softmax(log_likelihoods.reshape([alpha.shape[0]*w.shape[1], possible_ws.shape[0]]))\
-            .reshape([alpha.shape[0], w.shape[1], possible_ws.shape[0]])  # (n_alpha, n_dim_out, n_possible_ws)
+        return tt.nnet.softmax(log_likelihoods.reshape([w_alpha.shape[0]*w_alpha.shape[1], possible_ws.shape[0]]))\
+            .reshape([w_alpha.shape[0], w_alpha.shape[1], possible_ws.shape[0]])  # (n_alpha, n_dim_out, n_possible_ws)
+
+    def _get_sweep_inputs(self, n_alpha, n_dim_out):
+        """
+        :return: A list of variables that _sample_rows needs for the whole sweep (here, the random numbers).
+        """
+        return [self._rng.uniform(size = (n_alpha, n_dim_out))]
+
+    def _get_sweep_state(self):
+        """
+        :return: A list of shared variables (other than w) that get updated row-by-row through the sweep.
+        """
+        return []
+
+    def _sample_rows(self, p_wa, alpha, chunk_ixs, inputs, state):
+        """
+        :param p_wa: (n_chunk, n_dim_out, n_possible_ws) probabilities of the weights in the chunk
+        :param alpha: (n_chunk, ) indices of the rows in the chunk
+        :param chunk_ixs: A slice selecting the chunk from the n_alpha rows being sampled in this sweep
+        :param inputs: The variables returned by _get_sweep_inputs
+        :param state: The current values of the variables returned by _get_sweep_state
+        :return: The new (n_chunk, n_dim_out) values of the rows, and the list of new state values.
+        """
+        uniform, = inputs
+        return sample_categorical(uniform[chunk_ixs], p_wa, values = self._possible_ws), []
+
+    def _sweep(self, x, y):
+        """
+        Resample the n_alpha rows of w, chunk by chunk.  After each chunk we correct v_current = x.dot(w) with the change
+        in those rows (a rank-n_chunk update), so each chunk is sampled given all the rows updated before it.
+
+        :return: The new value of w, and the list of new values of the sweep state.
+        """
+        n_alpha = self._alpha.shape[0]
+        inputs = self._get_sweep_inputs(n_alpha, self._w.shape[1])
+        initial_state = self._get_sweep_state()
+
+        def sample_chunk(start, stop, w, v_current, *state):
+            alpha = self._alpha[start:stop]
+            w_alpha = w[alpha]
+            x_alpha = x.T[alpha].T  # (n_samples, n_chunk)
+            p_wa = self.compute_p_wa_given_v(v_current, w_alpha, x_alpha, y, self._possible_ws)
+            new_w_alpha, new_state = self._sample_rows(p_wa, alpha, slice(start, stop), inputs, state)
+            new_v = v_current + x_alpha.dot(new_w_alpha - w_alpha)
+            return [tt.set_subtensor(w[alpha], new_w_alpha), new_v] + list(new_state)
+
+        v_current = x.dot(self._w)
+        if self._alpha_chunk_size is None and self._max_chunk_elements is None:
+            results = sample_chunk(0, n_alpha, self._w, v_current, *initial_state)
+        else:
+            chunk_size = n_alpha if self._alpha_chunk_size is None else tt.minimum(self._alpha_chunk_size, n_alpha)
+            if self._max_chunk_elements is not None:
+                elements_per_row = x.shape[0]*y.shape[1]*self._possible_ws.shape[0]
+                chunk_size = tt.clip(self._max_chunk_elements // elements_per_row, 1, chunk_size)
+            n_chunks = (n_alpha + chunk_size - 1) // chunk_size
+            results, _ = theano.scan(
+                lambda i, *args: sample_chunk(i*chunk_size, tt.minimum((i+1)*chunk_size, n_alpha), *args),
+                sequences = [tt.arange(n_chunks)],
+                outputs_info = [self._w, v_current] + initial_state,
+                n_steps = n_chunks
+                )
+            results = [r[-1] for r in results]
+        return results[0], results[2:]
 
     @symbolic_updater
     def train(self, x, y):
-        p_wa = self.compute_p_wa(self._w, x, y, self._alpha, self._possible_ws)  # (n_alpha, n_dim_out, n_possible_ws)
-        w_sample = sample_categorical(self._rng, p_wa, values = self._possible_ws)
-        w_new = tt.set_subtensor(self._w[self._alpha], w_sample)  # (n_dim_in, n_dim_out)
+        w_new, _ = self._sweep(x, y)
         add_update(self._w, w_new)
         self._add_alpha_update()
 
@@ -70,17 +160,24 @@ class HerdedGibbsRegressor(GibbsRegressor):
         GibbsRegressor.__init__(self, n_dim_in, n_dim_out, possible_ws=possible_ws, **kwargs)
         self._phi = theano.shared(np.zeros((n_dim_in, n_dim_out, len(possible_ws)), dtype = 'float'), name = 'phi')
 
+    def _get_sweep_inputs(self, n_alpha, n_dim_out):
+        return []
+
+    def _get_sweep_state(self):
+        return [self._phi]
+
+    def _sample_rows(self, p_wa, alpha, chunk_ixs, inputs, state):
+        phi, = state
+        phi_alpha = phi[alpha] + p_wa  # (n_chunk, n_dim_out, n_possible_ws)
+        k_chosen = tt.argmax(phi_alpha, axis = 2)  # (n_chunk, n_dim_out)
+        selected_phi_indices = (tt.arange(alpha.shape[0])[:, None], tt.arange(phi.shape[1])[None, :], k_chosen)
+        new_phi_alpha = tt.set_subtensor(phi_alpha[selected_phi_indices], phi_alpha[selected_phi_indices]-1)  # (n_chunk, n_dim_out, n_possible_ws)
+        w_sample = self._possible_ws[k_chosen]  # (n_chunk, n_dim_out)
+        return w_sample, [tt.set_subtensor(phi[alpha], new_phi_alpha)]  # (n_dim_in, n_dim_out, n_possible_ws)
+
     @symbolic_updater
     def train(self, x, y):
-        p_wa = self.compute_p_wa(self._w, x, y, self._alpha, self._possible_ws)
-        phi_alpha = self._phi[self._alpha] + p_wa  # (n_alpha, n_dim_out, n_possible_ws)
-
-        k_chosen = tt.argmax(phi_alpha, axis = 2)  # (n_alpha, n_dim_out)
-        selected_phi_indices = (tt.arange(self._alpha.shape[0])[:, None], tt.arange(y.shape[1])[None, :], k_chosen)
-        new_phi_alpha = tt.set_subtensor(phi_alpha[selected_phi_indices], phi_alpha[selected_phi_indices]-1)  # (n_alpha, n_dim_out, n_possible_ws)
-        w_sample = self._possible_ws[k_chosen]  # (n_alpha, n_dim_out)
-        new_phi = tt.set_subtensor(self._phi[self._alpha], new_phi_alpha)  # (n_dim_in, n_dim_out, n_possible_ws)
-        w_new = tt.set_subtensor(self._w[self._alpha], w_sample)  # (n_dim_in, n_dim_out)
+        w_new, (phi_new, ) = self._sweep(x, y)
         add_update(self._w, w_new)
-        add_update(self._phi, new_phi)
+        add_update(self._phi, phi_new)
         self._add_alpha_update()
@@ -4,6 +4,7 @@ from plato.tools.regressors.simple_sampling_regressors import GibbsRegressor, He
 from utils.datasets.synthetic_logistic import get_logistic_regression_data
 from utils.predictors.predictor_tests import assert_online_predictor_not_broken
 from pytest import raises
+import numpy as np
 
 __author__ = 'peter'
 
@@ -83,7 +84,41 @@ def test_gibbs_logistic_regressor_full_update():
             )
 
 
+def test_chunked_sweeps():
+    """
+    A whole-matrix sweep in chunks should do the same as resampling those chunks on separate calls, and an exact sweep
+    (chunks of 1 row) over all the weights in one call should learn, unlike the full update above.
+    """
+    n_samples = 30
+    n_dims = 20
+    x_tr, y_tr, _, _, _ = get_logistic_regression_data(n_dims = n_dims, n_training=n_samples, n_test=15, noise_factor = 0.1)
+
+    one_call = HerdedGibbsRegressor(n_dim_in=n_dims, n_dim_out=1, n_alpha='all', alpha_chunk_size=3, possible_ws = [-1, 0, 1])
+    many_calls = HerdedGibbsRegressor(n_dim_in=n_dims, n_dim_out=1, n_alpha=3, possible_ws = [-1, 0, 1])
+    budgeted = HerdedGibbsRegressor(n_dim_in=n_dims, n_dim_out=1, n_alpha='all', max_chunk_elements=3*n_samples*3, possible_ws = [-1, 0, 1])
+    one_call.train.compile()(x_tr, y_tr)
+    budgeted.train.compile()(x_tr, y_tr)
+    f_train = many_calls.train.compile()
+    for _ in xrange(7):  # The 7th call covers row 18, 19 (and wraps to 0, which we exclude from the comparison)
+        f_train(x_tr, y_tr)
+    assert np.array_equal(one_call._w.get_value()[1:], many_calls._w.get_value()[1:])
+    assert np.allclose(one_call._phi.get_value()[1:], many_calls._phi.get_value()[1:])
+    assert np.array_equal(one_call._w.get_value(), budgeted._w.get_value())
+
+    assert_online_predictor_not_broken(
+        predictor_constructor = lambda n_dim_in, n_dim_out:
+            GibbsRegressor(n_dim_in = n_dim_in, n_dim_out = n_dim_out,
+                n_alpha = 'all',
+                alpha_chunk_size = 1,
+                possible_ws= (-1, 1),
+                seed = 2143
+                ).compile(),
+        n_epochs=20
+        )
+
+
 if __name__ == '__main__':
+    test_chunked_sweeps()
     test_gibbs_logistic_regressor_full_update()
     test_herded_logistic_regressor()
     test_gibbs_logistic_regressor()
@@ -0,0 +1,145 @@
+from collections import OrderedDict, namedtuple
+import json
+import platform
+import time
+import numpy as np
+from fileman.local_dir import make_file_dir
+
+__author__ = 'peter'
+
+"""
+Tools for timing code and catching performance regressions.
+
+Performance results are stored as a flat dict<str: float> of metrics, whose names look like
+'case/function/metric@batch_size' (e.g. 'mlp/train/samples_per_sec@100').  The part of the name between the last '/'
+and the '@' (e.g. 'samples_per_sec') determines whether higher or lower is better, and the default regression threshold.
+"""
+
+# Metrics for which a bigger number is better.  For all others (times, latencies), smaller is better.
+HIGHER_IS_BETTER = ('samples_per_sec', )
+
+# Relative change (in the bad direction) that we tolerate before calling it a regression.  Compilation is noisier than
+# running, so it gets more slack.
+DEFAULT_THRESHOLDS = {
+    'trace_time': 0.5,
+    'compile_time': 0.5,
+    'samples_per_sec': 0.2,
+    'latency': 0.2,
+    }
+
+# Threshold for metric types which are not in DEFAULT_THRESHOLDS.
+FALLBACK_THRESHOLD = 0.2
+
+PerfRegression = namedtuple('PerfRegression', ['metric', 'baseline', 'current', 'relative_change', 'threshold'])
+
+
+def time_calls(fcn, args = (), min_time = 0.2, min_calls = 3, max_calls = 1000, warmup_calls = 1):
+    """
+    Repeatedly call a function and time each call.
+    :param fcn: The function to call
+    :param args: A tuple of arguments to pass to the function on each call
+    :param min_time: Keep calling until at least this many seconds have been spent in calls...
+    :param min_calls: ... and at least this many calls have been made...
+    :param max_calls: ... but never make more than this many calls.
+    :param warmup_calls: Number of untimed calls to make first (to fill caches, allocate memory, etc)
+    :return: An array of the duration (in seconds) of each timed call.
+    """
+    for _ in xrange(warmup_calls):
+        fcn(*args)
+    durations = []
+    total_time = 0
+    while len(durations) < max_calls and (len(durations) < min_calls or total_time < min_time):
+        start_time = time.time()
+        fcn(*args)
+        durations.append(time.time() - start_time)
+        total_time += durations[-1]
+    return np.array(durations)
+
+
+def get_metric_type(metric_name):
+    """
+    :param metric_name: A metric name like 'mlp/train/samples_per_sec@100'
+    :return: The type of metric, e.g. 'samples_per_sec'
+    """
+    return metric_name.split('/')[-1].split('@')[0]
+
+
+def get_environment_info():
+    """
+    :return: A dict describing the machine and libraries that the results were obtained with.  Results are only really
+        comparable between identical environments.
+    """
+    import theano
+    return OrderedDict([
+        ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('host', platform.node()),
+        ('processor', platform.processor()),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('theano', theano.__version__),
+        ('device', theano.config.device),
+        ('floatX', theano.config.floatX),
+        ])
+
+
+def save_perf_results(results, path, environment = None):
+    """
+    Save performance results to a json file.
+    :param results: A dict<metric_name: value>
+    :param path: Path to the json file
+    :param environment: A dict describing the environment (defaults to get_environment_info())
+    """
+    if environment is None:
+        environment = get_environment_info()
+    with open(make_file_dir(path), 'w') as f:
+        json.dump(OrderedDict([('environment', environment), ('results', results)]), f, indent = 2)
+
+
+def load_perf_results(path):
+    """
+    :param path: Path to a json file saved with save_perf_results
+    :return: An OrderedDict<metric_name: value>
+    """
+    with open(path) as f:
+        return json.load(f, object_pairs_hook = OrderedDict)['results']
+
+
+def compare_to_baseline(results, baseline, thresholds = {}):
+    """
+    Find the metrics that have gotten worse, relative to a baseline, by more than the allowed threshold.  Metrics that
+    are not in both the results and the baseline are ignored.
+
+    :param results: A dict<metric_name: value> of current results
+    :param baseline: A dict<metric_name: value> of baseline results
+    :param thresholds: A dict<metric_type: float> overriding DEFAULT_THRESHOLDS.  e.g. {'latency': 0.1} means that
+        we complain if any latency grows by more than 10%.  Metric types with no threshold get FALLBACK_THRESHOLD.
+    :return: A list of PerfRegression objects, one for each metric that regressed.
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **thresholds)
+    regressions = []
+    for metric_name, value in results.iteritems():
+        if metric_name not in baseline or baseline[metric_name] == 0:
+            continue
+        metric_type = get_metric_type(metric_name)
+        relative_change = (value - baseline[metric_name]) / float(baseline[metric_name])
+        worsening = -relative_change if metric_type in HIGHER_IS_BETTER else relative_change
+        threshold = thresholds.get(metric_type, FALLBACK_THRESHOLD)
+        if worsening > threshold:
+            regressions.append(PerfRegression(metric_name, baseline[metric_name], value, relative_change, threshold))
+    return regressions
+
+
+def format_perf_results(results, baseline = None):
+    """
+    :param results: A dict<metric_name: value>
+    :param baseline: Optionally, a dict<metric_name: value> of baseline results to show alongside.
+    :return: A string table of the results.
+    """
+    width = max(len(k) for k in results.keys()) if len(results) > 0 else 0
+    lines = []
+    for metric_name, value in results.iteritems():
+        line = '%s  %.4g' % (metric_name.ljust(width), value)
+        if baseline is not None and metric_name in baseline and baseline[metric_name] != 0:
+            line += '  (baseline: %.4g, %+.1f%%)' % (baseline[metric_name], 100.*(value-baseline[metric_name])/baseline[metric_name])
+        lines.append(line)
+    return '\n'.join(lines)
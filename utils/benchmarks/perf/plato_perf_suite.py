@@ -0,0 +1,236 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+import sys
+import numpy as np
+from plato.core import symbolic_simple, symbolic_updater, create_shared_variable
+from plato.tools.convnet.convnet import ConvNet, ConvLayer, Nonlinearity, Pooler
+from plato.tools.dbn.dbn import DeepBeliefNet
+from plato.tools.lstm.long_short_term_memory import AutoencodingLSTM
+from plato.tools.mlp.mlp import MultiLayerPerceptron
+from plato.tools.optimization.cost import negative_log_likelihood_dangerous
+from plato.tools.optimization.optimizers import SimpleGradientDescent, AdaMax
+from plato.tools.rbm.rbm_parts import StochasticNonlinearity, FullyConnectedBridge
+from plato.tools.rbm.restricted_boltzmann_machine import simple_rbm
+from plato.tools.regressors.online_regressor import OnlineRegressor
+from plato.tools.va.variational_autoencoder import VariationalAutoencoder, EncoderDecoderNetworks
+import theano.tensor as tt
+from utils.benchmarks.perf.perf_tools import time_calls, save_perf_results, load_perf_results, compare_to_baseline, \
+    format_perf_results, DEFAULT_THRESHOLDS
+
+__author__ = 'peter'
+
+"""
+A suite of performance benchmarks for Plato models.
+
+For each model, we measure:
+- trace_time: Time to build the symbolic graph of the train/predict functions
+- compile_time: Time for theano to compile it
+- samples_per_sec@N: Training throughput at minibatch size N
+- latency@N: Time for one call to the prediction function with a minibatch of size N
+
+Run it from the command line, e.g.
+
+    python -m utils.benchmarks.perf.plato_perf_suite --save perf_results.json
+    python -m utils.benchmarks.perf.plato_perf_suite --baseline perf_results.json
+
+The second command exits with a nonzero status if anything has gotten slower than the thresholds allow (see
+perf_tools.DEFAULT_THRESHOLDS).
+"""
+
+N_IN = 784
+N_OUT = 10
+
+
+def _mnist_like_batch(rng, n, binary = False):
+    x = rng.rand(n, N_IN)
+    return (x > 0.5).astype(float) if binary else x
+
+
+def _build_online_regressor(rng):
+    predictor = OnlineRegressor(input_size = N_IN, output_size = N_OUT, optimizer = SimpleGradientDescent(eta = 0.01))
+    make_batch = lambda n: ((_mnist_like_batch(rng, n), rng.randint(N_OUT, size = n)), (_mnist_like_batch(rng, n), ))
+    return predictor.train, predictor.predict, make_batch
+
+
+def _build_mlp(rng):
+    mlp = MultiLayerPerceptron.from_init(layer_sizes = [N_IN, 500, N_OUT], hidden_activation = 'relu',
+        output_activation = 'softmax', w_init = 0.01, rng = rng)
+    optimizer = SimpleGradientDescent(eta = 0.01)
+
+    @symbolic_updater
+    def train(x, y):
+        optimizer(cost = negative_log_likelihood_dangerous(mlp(x), y), parameters = mlp.parameters)
+
+    make_batch = lambda n: ((_mnist_like_batch(rng, n), rng.randint(N_OUT, size = n)), (_mnist_like_batch(rng, n), ))
+    return train, mlp, make_batch
+
+
+def _build_rbm(rng):
+    rbm = simple_rbm(
+        visible_layer = StochasticNonlinearity('bernoulli'),
+        bridge = FullyConnectedBridge(w = 0.01*rng.randn(N_IN, 500), b = 0, b_rev = 0),
+        hidden_layer = StochasticNonlinearity('bernoulli')
+        )
+    make_batch = lambda n: ((_mnist_like_batch(rng, n, binary = True), ), (_mnist_like_batch(rng, n, binary = True), ))
+    return rbm.get_training_fcn(n_gibbs = 1, persistent = False), rbm.propup, make_batch
+
+
+def _build_dbn(rng):
+    dbn = DeepBeliefNet(
+        layers = {
+            'vis': StochasticNonlinearity('bernoulli'),
+            'hid': StochasticNonlinearity('bernoulli'),
+            'ass': StochasticNonlinearity('bernoulli'),
+            },
+        bridges = {
+            ('vis', 'hid'): FullyConnectedBridge(w = 0.01*rng.randn(N_IN, 500), b_rev = 0),
+            ('hid', 'ass'): FullyConnectedBridge(w = 0.01*rng.randn(500, 500), b_rev = 0),
+            }
+        )
+    train = dbn.get_constrastive_divergence_function(visible_layers = 'vis', hidden_layers = 'hid', n_gibbs = 1)
+    predict = dbn.get_inference_function(input_layers = 'vis', output_layers = 'ass', path = [('vis', 'hid'), ('hid', 'ass')], smooth = True)
+    make_batch = lambda n: ((_mnist_like_batch(rng, n, binary = True), ), (_mnist_like_batch(rng, n, binary = True), ))
+    return train, predict, make_batch
+
+
+def _build_lstm(rng):
+    """
+    Here the "batch size" is the length of the sequence fed in to each call.
+    """
+    n_symbols = 20
+    aelstm = AutoencodingLSTM(n_input = n_symbols, n_hidden = 100, initializer_fcn = lambda shape: 0.01*rng.randn(*shape))
+    train = aelstm.get_training_function(optimizer = AdaMax(alpha = 1e-3), update_states = False)
+
+    @symbolic_simple
+    def predict(inputs):
+        return aelstm.lstm.multi_step(inputs, update_states = False)
+
+    onehot_sequence = lambda n: np.eye(n_symbols)[rng.randint(n_symbols, size = n)]
+    make_batch = lambda n: ((onehot_sequence(n+1), ), (onehot_sequence(n), ))
+    return train, predict, make_batch
+
+
+def _build_vae(rng):
+    vae = VariationalAutoencoder(
+        pq_pair = EncoderDecoderNetworks(x_dim = N_IN, z_dim = 20, encoder_hidden_sizes = [200], decoder_hidden_sizes = [200],
+            w_init = lambda n_in, n_out: 0.01*rng.randn(n_in, n_out), x_distribution = 'bernoulli', z_distribution = 'gaussian'),
+        optimizer = AdaMax(alpha = 0.003),
+        rng = rng.randint(1e9)
+        )
+    make_batch = lambda n: ((_mnist_like_batch(rng, n, binary = True), ), (_mnist_like_batch(rng, n, binary = True), ))
+    return vae.train, vae.sample_z_given_x, make_batch
+
+
+def _build_convnet(rng):
+    convnet = ConvNet(OrderedDict([
+        ('conv1', ConvLayer(w = 0.01*rng.randn(16, 1, 5, 5), b = np.zeros(16))),
+        ('relu1', Nonlinearity('relu')),
+        ('pool1', Pooler(region = (2, 2))),
+        ('conv2', ConvLayer(w = 0.01*rng.randn(32, 16, 5, 5), b = np.zeros(32))),
+        ('relu2', Nonlinearity('relu')),
+        ('pool2', Pooler(region = (2, 2))),
+        ]))  # (n, 1, 28, 28) -> (n, 32, 4, 4)
+    w_out = create_shared_variable(0.01*rng.randn(32*4*4, N_OUT))
+    parameters = [p for layer in convnet.layers.values() if isinstance(layer, ConvLayer) for p in layer.parameters] + [w_out]
+    optimizer = SimpleGradientDescent(eta = 0.01)
+
+    @symbolic_simple
+    def predict(x):
+        return tt.nnet.softmax(convnet(x).flatten(2).dot(w_out))
+
+    @symbolic_updater
+    def train(x, y):
+        optimizer(cost = negative_log_likelihood_dangerous(predict(x), y), parameters = parameters)
+
+    images = lambda n: rng.rand(n, 1, 28, 28)
+    make_batch = lambda n: ((images(n), rng.randint(N_OUT, size = n)), (images(n), ))
+    return train, predict, make_batch
+
+
+# Each case is a function which takes a numpy RandomState and returns (train_fcn, predict_fcn, make_batch), where
+# train_fcn and predict_fcn are symbolic functions, and make_batch(n) returns (train_args, predict_args) for a
+# minibatch of size n.
+PERF_CASES = OrderedDict([
+    ('regressor', _build_online_regressor),
+    ('mlp', _build_mlp),
+    ('rbm', _build_rbm),
+    ('dbn', _build_dbn),
+    ('lstm', _build_lstm),
+    ('vae', _build_vae),
+    ('convnet', _build_convnet),
+    ])
+
+
+def run_perf_case(case_name, batch_sizes = (1, 10, 100), min_time = 0.2, seed = 1234):
+    """
+    Run the performance benchmarks for one model.
+    :param case_name: The name of a case in PERF_CASES
+    :param batch_sizes: The minibatch sizes at which to measure training throughput and prediction latency
+    :param min_time: The minimum time to spend timing calls at each batch size (see time_calls).
+    :param seed: Random seed for initializing the model and generating data
+    :return: An OrderedDict<metric_name: value>
+    """
+    rng = np.random.RandomState(seed)
+    symbolic_train, symbolic_predict, make_batch = PERF_CASES[case_name](rng)
+    results = OrderedDict()
+    for fcn_name, symbolic_fcn, arg_index, metric in [('train', symbolic_train, 0, 'samples_per_sec'), ('predict', symbolic_predict, 1, 'latency')]:
+        f = symbolic_fcn.compile()
+        f(*make_batch(batch_sizes[0])[arg_index])  # Trace and compile
+        results['%s/%s/trace_time' % (case_name, fcn_name)] = f.compilation_times['trace']
+        results['%s/%s/compile_time' % (case_name, fcn_name)] = f.compilation_times['compile']
+        for n in batch_sizes:
+            median_time = np.median(time_calls(f, args = make_batch(n)[arg_index], min_time = min_time))
+            results['%s/%s/%s@%s' % (case_name, fcn_name, metric, n)] = n / median_time if metric == 'samples_per_sec' else median_time
+    return results
+
+
+def run_perf_suite(cases = None, verbose = True, **run_perf_case_kwargs):
+    """
+    Run the performance benchmarks for several models.
+    :param cases: A list of case names (see PERF_CASES), or None to run all of them.
+    :param verbose: Print results as they come in.
+    :param run_perf_case_kwargs: See run_perf_case
+    :return: An OrderedDict<metric_name: value>
+    """
+    if cases is None:
+        cases = PERF_CASES.keys()
+    results = OrderedDict()
+    for case_name in cases:
+        case_results = run_perf_case(case_name, **run_perf_case_kwargs)
+        if verbose:
+            print format_perf_results(case_results)
+        results.update(case_results)
+    return results
+
+
+def main(args = None):
+    parser = ArgumentParser(description = 'Run the Plato performance benchmarks.')
+    parser.add_argument('--cases', default = None, help = 'Comma-separated cases to run (default: all of %s)' % (','.join(PERF_CASES.keys()), ))
+    parser.add_argument('--batch-sizes', default = '1,10,100', help = 'Comma-separated minibatch sizes')
+    parser.add_argument('--min-time', type = float, default = 0.2, help = 'Minimum seconds of timed calls per measurement')
+    parser.add_argument('--save', default = None, help = 'Save results to this json file')
+    parser.add_argument('--baseline', default = None, help = 'Compare results to the ones in this json file')
+    parser.add_argument('--threshold', type = float, default = None, help = 'Override all regression thresholds (e.g. 0.1 for 10%%)')
+    args = parser.parse_args(args)
+
+    results = run_perf_suite(
+        cases = args.cases.split(',') if args.cases is not None else None,
+        batch_sizes = [int(n) for n in args.batch_sizes.split(',')],
+        min_time = args.min_time,
+        verbose = False
+        )
+    baseline = load_perf_results(args.baseline) if args.baseline is not None else None
+    print format_perf_results(results, baseline = baseline)
+    if args.save is not None:
+        save_perf_results(results, args.save)
+    if baseline is not None:
+        regressions = compare_to_baseline(results, baseline, thresholds =
+            {} if args.threshold is None else {metric_type: args.threshold for metric_type in DEFAULT_THRESHOLDS})
+        for r in regressions:
+            print 'REGRESSION: %s went from %.4g to %.4g (%+.1f%%, threshold %.0f%%)' % (r.metric, r.baseline, r.current, 100*r.relative_change, 100*r.threshold)
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+import numpy as np
+from plato.interfaces.helpers import get_theano_rng
+from plato.tools.optimization.sampling import sample_categorical
+import theano
+import theano.tensor as tt
+from theano.tensor.shared_randomstreams import RandomStreams
+from utils.benchmarks.perf.perf_tools import time_calls, format_perf_results
+
+__author__ = 'peter'
+
+"""
+Compare the speed of sample_categorical across random number sources and sampling methods, and of generating uniform,
+normal and binomial numbers with each type of random stream.
+
+e.g.
+    python -m utils.benchmarks.perf.sampling_benchmark --n-categories 2,10,100
+
+Results use the metric naming of perf_tools ('categorical/mrg-inverse_cdf/latency@10000x10' is the time to draw 10000
+samples from 10 categories), so they can be saved and compared to a baseline in the same way as the plato_perf_suite.
+"""
+
+RNG_CONSTRUCTORS = OrderedDict([
+    ('mrg', lambda: get_theano_rng(seed = 1234, rngtype = 'mrg')),
+    ('default', lambda: RandomStreams(1234)),
+    ('external', lambda: None),  # Uniform random numbers passed in as an input
+    ])
+
+METHODS = ('inverse_cdf', 'gumbel', 'multinomial')
+
+
+def compile_categorical_sampler(rng_name, method):
+    """
+    :param rng_name: A key in RNG_CONSTRUCTORS
+    :param method: A sampling method (see sample_categorical)
+    :return: A function taking an (n_samples, n_categories) array of probabilities and returning n_samples samples, or
+        None if the method is not available for this random number source.
+    """
+    p = tt.matrix('p')
+    if rng_name == 'external':
+        if method == 'multinomial':
+            return None
+        uniform = tt.vector('uniform')
+        f = theano.function([p, uniform], sample_categorical(uniform, p, method = method))
+        rng = np.random.RandomState(1234)
+        return lambda p_val: f(p_val, rng.rand(p_val.size).astype(theano.config.floatX))
+    else:
+        return theano.function([p], sample_categorical(RNG_CONSTRUCTORS[rng_name](), p, method = method))
+
+
+def run_sampling_benchmark(n_samples = 10000, n_categories = (2, 10, 100), rng_names = None, methods = METHODS, min_time = 0.2):
+    """
+    :param n_samples: Number of distributions to sample from in each call
+    :param n_categories: A list of numbers of categories to try
+    :param rng_names: Random number sources to compare (keys of RNG_CONSTRUCTORS), or None for all.
+    :param methods: Sampling methods to compare
+    :param min_time: Minimum seconds of timed calls per measurement
+    :return: An OrderedDict<metric_name: median seconds per call>
+    """
+    if rng_names is None:
+        rng_names = RNG_CONSTRUCTORS.keys()
+    rng = np.random.RandomState(1234)
+    results = OrderedDict()
+    for rng_name in rng_names:
+        for method in methods:
+            f = compile_categorical_sampler(rng_name, method)
+            if f is None:
+                continue
+            for k in n_categories:
+                p = rng.rand(n_samples, k).astype(theano.config.floatX)
+                results['categorical/%s-%s/latency@%sx%s' % (rng_name, method, n_samples, k)] = np.median(time_calls(f, args = (p, ), min_time = min_time))
+    return results
+
+
+GENERATORS = OrderedDict([
+    ('uniform', lambda rng, shape: rng.uniform(size = shape)),
+    ('normal', lambda rng, shape: rng.normal(size = shape)),
+    ('binomial', lambda rng, shape: rng.binomial(p = 0.3*tt.ones(shape), size = shape, dtype = theano.config.floatX)),
+    ])
+
+
+def run_generation_benchmark(shape = (1000, 1000), rngtypes = ('mrg', 'default'), distributions = None, min_time = 0.2):
+    """
+    :param shape: Shape of the array of random numbers to generate in each call
+    :param rngtypes: Types of random stream to compare (see get_theano_rng)
+    :param distributions: Distributions (keys of GENERATORS) to compare, or None for all.
+    :param min_time: Minimum seconds of timed calls per measurement
+    :return: An OrderedDict<metric_name: median seconds per call>
+    """
+    if distributions is None:
+        distributions = GENERATORS.keys()
+    results = OrderedDict()
+    for rngtype in rngtypes:
+        for distribution in distributions:
+            f = theano.function([], GENERATORS[distribution](get_theano_rng(seed = 1234, rngtype = rngtype), shape))
+            results['generation/%s-%s/latency@%s' % (rngtype, distribution, 'x'.join(str(n) for n in shape))] = np.median(time_calls(f, min_time = min_time))
+    return results
+
+
+def main(args = None):
+    parser = ArgumentParser(description = 'Compare categorical sampling methods and random number sources.')
+    parser.add_argument('--n-samples', type = int, default = 10000, help = 'Number of distributions to sample from per call')
+    parser.add_argument('--n-categories', default = '2,10,100', help = 'Comma-separated numbers of categories')
+    parser.add_argument('--min-time', type = float, default = 0.2, help = 'Minimum seconds of timed calls per measurement')
+    args = parser.parse_args(args)
+    results = run_sampling_benchmark(n_samples = args.n_samples, n_categories = [int(k) for k in args.n_categories.split(',')],
+        min_time = args.min_time)
+    results.update(run_generation_benchmark(min_time = args.min_time))
+    print format_perf_results(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+from utils.benchmarks.perf.perf_tools import time_calls, compare_to_baseline, save_perf_results, load_perf_results
+from utils.benchmarks.perf.plato_perf_suite import run_perf_case, main
+from utils.benchmarks.perf.sampling_benchmark import run_sampling_benchmark, run_generation_benchmark
+
+__author__ = 'peter'
+
+
+def test_time_calls():
+
+    calls = []
+    durations = time_calls(lambda x: calls.append(x), args = (3, ), min_time = 0, min_calls = 5, warmup_calls = 2)
+    assert len(durations) == 5
+    assert calls == [3]*7
+
+
+def test_compare_to_baseline():
+
+    baseline = {
+        'mlp/train/compile_time': 1.,
+        'mlp/train/samples_per_sec@10': 1000.,
+        'mlp/predict/latency@10': 0.01,
+        'rbm/predict/latency@10': 0.01,
+        }
+    results = {
+        'mlp/train/compile_time': 1.4,  # Worse, but within the (lenient) compile threshold
+        'mlp/train/samples_per_sec@10': 700.,  # Fewer samples per second: regression
+        'mlp/predict/latency@10': 0.005,  # Faster: fine
+        'rbm/predict/latency@10': 0.015,  # Slower: regression
+        'dbn/predict/latency@10': 100.,  # Not in baseline: ignored
+        }
+    regressions = compare_to_baseline(results, baseline)
+    assert sorted(r.metric for r in regressions) == ['mlp/train/samples_per_sec@10', 'rbm/predict/latency@10']
+
+    regressions = compare_to_baseline(results, baseline, thresholds = {'compile_time': 0.3, 'latency': 0.6})
+    assert sorted(r.metric for r in regressions) == ['mlp/train/compile_time', 'mlp/train/samples_per_sec@10']
+
+    # Metric types without a threshold of their own get the fallback threshold
+    regressions = compare_to_baseline(
+        results = {'rbm/sample/flips_per_step@10': 1.1, 'rbm/sample/burn_in@10': 2.},
+        baseline = {'rbm/sample/flips_per_step@10': 1., 'rbm/sample/burn_in@10': 1.}
+        )
+    assert [r.metric for r in regressions] == ['rbm/sample/burn_in@10']
+
+
+def test_plato_perf_suite():
+
+    results = run_perf_case('regressor', batch_sizes = (1, 10), min_time = 0.01)
+    assert results.keys() == [
+        'regressor/train/trace_time',
+        'regressor/train/compile_time',
+        'regressor/train/samples_per_sec@1',
+        'regressor/train/samples_per_sec@10',
+        'regressor/predict/trace_time',
+        'regressor/predict/compile_time',
+        'regressor/predict/latency@1',
+        'regressor/predict/latency@10',
+        ]
+    assert all(v > 0 for v in results.values())
+
+    path = os.path.join(tempfile.mkdtemp(), 'perf.json')
+    save_perf_results(results, path)
+    assert load_perf_results(path) == results
+
+    fast_baseline = {k: v*(10 if 'samples_per_sec' in k else 0.1) for k, v in results.iteritems()}
+    save_perf_results(fast_baseline, path)
+    assert main(['--cases', 'regressor', '--batch-sizes', '1,10', '--min-time', '0.01', '--baseline', path]) == 1
+
+
+def test_sampling_benchmark():
+
+    results = run_sampling_benchmark(n_samples = 100, n_categories = (3, ), min_time = 0.01)
+    assert len(results) == 8  # 3 methods for each of the 2 random streams, and no multinomial for external numbers
+    assert 'categorical/external-gumbel/latency@100x3' in results
+    assert all(v > 0 for v in results.values())
+
+    results = run_generation_benchmark(shape = (10, 10), min_time = 0.01)
+    assert len(results) == 6 and 'generation/mrg-binomial/latency@10x10' in results
+
+
+if __name__ == '__main__':
+    test_time_calls()
+    test_compare_to_baseline()
+    test_plato_perf_suite()
+    test_sampling_benchmark()
@@ -10,16 +10,21 @@ from utils.benchmarks.predictor_comparison import LearningCurveData
 __author__ = 'peter'
 
 
-def plot_learning_curves(learning_curves, xscale = 'sqrt', yscale = 'linear', hang = None, title = None, figure_name = None, y_title = 'Score'):
+def plot_learning_curves(learning_curves, xscale = 'sqrt', yscale = 'linear', hang = None, title = None, figure_name = None, y_title = 'Score',
+        confidence = 0.95, x_axis = 'epoch'):
     """
     Plot a set of PredictionResults.  These can be obtained by running compare_predictors.
-    See module test_compare_predictors for an example.
+    See module test_compare_predictors for an example.  Learning curves with several repetitions (see
+    compare_predictors_over_seeds) are plotted as the mean, with a shaded confidence interval.
 
     :param learning_curves: An OrderedDict<str: LearningCurveData>
     :param xscale: {'linear', 'log', 'symlog', 'sqrt'}
     :param yscale: {'linear', 'log', 'symlog', 'sqrt'}
     :param hang: True for blocking plot.  False to keep executing.
     :param title: Title of the plot
+    :param confidence: Confidence level of the intervals shown for curves with several repetitions.
+    :param x_axis: What to plot scores against: 'epoch', 'seconds' (of training time, not including testing), or
+        'samples' (seen in training).
     :return:
     """
 
@@ -33,18 +38,21 @@ def plot_learning_curves(learning_curves, xscale = 'sqrt', yscale = 'linear', ha
     legend = []
 
     for (record_name, record), colour in zip(learning_curves.iteritems(), cycle(colours)):
-        times, scores = record.get_results()
-        if np.array_equal(times.values()[0], [None]):  # Offline result... make a horizontal line
-            assert all(len(s)==1 for s in scores.values())
-            if 'Training' in scores:
-                plt.axhline(scores['Training'], color=colour, linestyle = '--')
-            if 'Test' in scores:
-                plt.axhline(scores['Test'], color=colour, linestyle = '-')
-        else:
-            if 'Training' in scores:  # Online result... make a learning curve
-                plt.plot(times['Training']+(1 if xscale == 'log' else 0), scores['Training'], '--'+colour)
-            if 'Test' in scores:
-                plt.plot(times['Test']+(1 if xscale == 'log' else 0), scores['Test'], '-'+colour)
+        times, scores = record.get_results(x_axis = x_axis)
+        for set_name, linestyle in [('Training', '--'), ('Test', '-')]:
+            if set_name not in scores:
+                continue
+            mean, lower, upper = record.get_mean_and_confidence_interval(set_name, confidence = confidence)
+            if np.array_equal(times[set_name], [None]):  # Offline result... make a horizontal line
+                assert len(mean)==1
+                plt.axhline(mean[0], color=colour, linestyle = linestyle)
+                if record.n_reps > 1:
+                    plt.axhspan(lower[0], upper[0], color=colour, alpha = 0.2)
+            else:  # Online result... make a learning curve
+                t = times[set_name]+(1 if xscale == 'log' else 0)
+                plt.plot(t, mean, linestyle+colour)
+                if record.n_reps > 1:
+                    plt.fill_between(t, lower, upper, color=colour, alpha = 0.2)
         plt.gca().set_xscale(xscale)
         plt.gca().set_yscale(yscale)
         if 'Training' in scores:
@@ -52,7 +60,7 @@ def plot_learning_curves(learning_curves, xscale = 'sqrt', yscale = 'linear', ha
         if 'Test' in scores:
             legend.append('%s-test' % record_name)
 
-    plt.xlabel('Epoch')
+    plt.xlabel({'epoch': 'Epoch', 'seconds': 'Training Time (s)', 'samples': 'Samples Seen'}[x_axis])
     plt.ylabel(y_title)
     plt.legend(legend, loc = 'best')
     if title is not None:
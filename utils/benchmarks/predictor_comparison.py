@@ -1,16 +1,24 @@
-from general.checkpoint_counter import CheckPointCounter
+from fileman.experiment_record import load_experiment_checkpoint, save_experiment_checkpoint
+from general.checkpoint_counter import get_checkpoint_steps
 from general.should_be_builtins import bad_value
+from plato.interfaces.param_serialzation import dumps_params, loads_params
 from utils.benchmarks.train_and_test import get_evaluation_function
 from collections import OrderedDict
+from itertools import izip
 from utils.tools.iteration import checkpoint_minibatch_index_generator
 from utils.tools.mymath import sqrtspace
+from utils.tools.parallel import forked_imap
 import numpy as np
+import pickle
+from scipy import stats
+import time
 from utils.tools.processors import RunningAverage
 
 
 def compare_predictors(dataset, online_predictors={}, offline_predictors={}, minibatch_size = 'full',
         evaluation_function = 'mse', test_epochs = sqrtspace(0, 1, 10), report_test_scores = True,
-        test_on = 'training+test', test_batch_size = None, accumulators = None, online_test_callbacks = {}):
+        test_on = 'training+test', test_batch_size = None, accumulators = None, online_test_callbacks = {}, checkpoint_name = None,
+        n_processes = 1, stopping_policy = None, checkpoint_predictors = None):
     """
     Compare a set of predictors by running them on a dataset, and return the learning curves for each predictor.
 
@@ -40,6 +48,21 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
         Special case: accum_fcn can be 'avg' to make a running average.
     :param online_test_callbacks: A dict<str: fcn> where fcn is a callback that takes an online
         predictor as an argument.  Useful for logging/plotting/debugging progress during training.
+    :param checkpoint_name: If not None, and this is called within an experiment, the results are checkpointed under this
+        name (see fileman.experiment_record.save_experiment_checkpoint) as each predictor finishes.  When the experiment
+        is resumed, predictors whose results are already in the checkpoint are not run again.  When running in one
+        process, online predictors are also checkpointed after each test (see assess_online_predictor), so a resumed
+        experiment continues the predictor that was running from its last test.
+    :param n_processes: Number of processes in which to run predictors in parallel.  1 runs all predictors in this
+        process.  None uses one process per CPU.  Worker processes are forked from this one, so the dataset is shared
+        rather than copied to each (see utils.tools.parallel).  Note that in this case, the predictors are trained in
+        the workers, so the predictor objects in this process are not modified.  Printed output is prefixed by the
+        name of the predictor that produced it.
+    :param stopping_policy: A stopping policy (see utils.benchmarks.stopping_policies), or list of stopping policies,
+        which can end the training of online predictors before the last test epoch.  Can also be a dict<str: policy>
+        to give policies to only some predictors.
+    :param checkpoint_predictors: How to checkpoint the state of online predictors between tests: None, 'params' or
+        'pickle' (see assess_online_predictor's checkpoint_predictor).
     :return: An OrderedDict<LearningCurveData>
     """
 
@@ -54,16 +77,20 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
     minibatch_size = _pack_into_dict(minibatch_size, expected_keys=online_predictors.keys())
     accumulators = _pack_into_dict(accumulators, expected_keys=online_predictors.keys())
     online_test_callbacks = _pack_into_dict(online_test_callbacks, expected_keys=online_predictors.keys(), allow_subset=True)
+    stopping_policy = _pack_into_dict(stopping_policy, expected_keys=online_predictors.keys(), allow_subset=True)
     test_epochs = np.array(test_epochs)
     if isinstance(evaluation_function, str):
         evaluation_function = get_evaluation_function(evaluation_function)
 
-    records = OrderedDict()
+    records = load_experiment_checkpoint(checkpoint_name, default = OrderedDict()) if checkpoint_name is not None else OrderedDict()
 
-    # Run the offline predictors
-    for predictor_name, (predictor_type, predictor) in type_constructor_dict.iteritems():
-        print '%s\nRunning predictor %s\n%s' % ('='*20, predictor_name, '-'*20)
-        records[predictor_name] = \
+    for predictor_name in records:
+        print 'Skipping predictor %s: Results were loaded from checkpoint.' % (predictor_name, )
+    names_to_run = [k for k in type_constructor_dict if k not in records]
+
+    def run_predictor(predictor_name):
+        predictor_type, predictor = type_constructor_dict[predictor_name]
+        return \
             assess_offline_predictor(
                 predictor=predictor,
                 dataset = dataset,
@@ -82,13 +109,70 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
                 report_test_scores = report_test_scores,
                 test_on = test_on,
                 test_batch_size = test_batch_size,
-                test_callback=online_test_callbacks[predictor_name] if predictor_name in online_test_callbacks else None
+                test_callback=online_test_callbacks[predictor_name] if predictor_name in online_test_callbacks else None,
+                stopping_policy=stopping_policy[predictor_name] if predictor_name in stopping_policy else None,
+                # Forked workers can't add to this process's checkpoint, so only checkpoint within predictors in-process
+                checkpoint_name = _get_predictor_checkpoint_name(checkpoint_name, predictor_name) if checkpoint_name is not None and n_processes == 1 else None,
+                checkpoint_predictor = checkpoint_predictors
                 ) if predictor_type == 'online' else \
             bad_value(predictor_type)
 
+    def run_predictor_and_announce(predictor_name):
+        print '%s\nRunning predictor %s\n%s' % ('='*20, predictor_name, '-'*20)
+        return run_predictor(predictor_name)
+
+    results = \
+        (run_predictor_and_announce(name) for name in names_to_run) if n_processes == 1 else \
+        forked_imap([lambda name=name: run_predictor(name) for name in names_to_run], n_processes = n_processes,
+            log_prefixes = ['[%s] ' % (name, ) for name in names_to_run])
+
+    for predictor_name, record in izip(names_to_run, results):
+        records[predictor_name] = record
+        if checkpoint_name is not None:
+            save_experiment_checkpoint(**{checkpoint_name: records, _get_predictor_checkpoint_name(checkpoint_name, predictor_name): None})
+
     print 'Done!'
 
-    return records
+    return OrderedDict((k, records[k]) for k in type_constructor_dict)
+
+
+def _get_predictor_checkpoint_name(checkpoint_name, predictor_name):
+    return '%s/%s' % (checkpoint_name, predictor_name)
+
+
+def compare_predictors_over_seeds(dataset, online_predictors={}, offline_predictors={}, seeds = range(5),
+        minibatch_size = 'full', accumulators = None, online_test_callbacks = {}, stopping_policy = None, **compare_predictors_kwargs):
+    """
+    Compare predictors, running each predictor once for each of a set of random seeds.  This lets you see whether
+    differences between predictors are bigger than the differences between runs of the same predictor.  Use
+    n_processes (see compare_predictors) to run the repetitions in parallel.
+
+    :param dataset: A DataSet object
+    :param online_predictors: A dict<str: function> where function takes a seed and returns an IPredictor.  The function
+        should use the seed to initialize the predictor (and its random number generators, if any).
+    :param offline_predictors: A dict<str: function> where function takes a seed and returns an offline predictor
+        (see compare_predictors).
+    :param seeds: A list of seeds (one repetition is done per seed)
+    :param minibatch_size, accumulators, online_test_callbacks, stopping_policy: As in compare_predictors
+    :param compare_predictors_kwargs: Other arguments for compare_predictors
+    :return: An OrderedDict<LearningCurveData> whose scores have a repetitions axis (see LearningCurveData.from_repetitions)
+    """
+    rep_name = lambda name, seed: '%s-seed%s' % (name, seed)
+    expand = lambda value_or_dict: {rep_name(k, seed): v for k, v in value_or_dict.iteritems() for seed in seeds} \
+        if isinstance(value_or_dict, dict) else value_or_dict
+
+    records = compare_predictors(
+        dataset = dataset,
+        online_predictors = {rep_name(k, seed): constructor(seed) for k, constructor in online_predictors.iteritems() for seed in seeds},
+        offline_predictors = {rep_name(k, seed): constructor(seed) for k, constructor in offline_predictors.iteritems() for seed in seeds},
+        minibatch_size = expand(minibatch_size),
+        accumulators = expand(accumulators),
+        online_test_callbacks = expand(online_test_callbacks),
+        stopping_policy = expand(stopping_policy),
+        **compare_predictors_kwargs
+        )
+    return OrderedDict((k, LearningCurveData.from_repetitions([records[rep_name(k, seed)] for seed in seeds]))
+        for k in sorted(offline_predictors.keys())+sorted(online_predictors.keys()))
 
 
 def _pack_into_dict(value_or_dict, expected_keys, allow_subset = False):
@@ -144,7 +228,8 @@ def assess_offline_predictor(predictor, dataset, evaluation_function, test_on =
 
 
 def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs, minibatch_size, test_on = 'training+test',
-        accumulator = None, report_test_scores=True, test_batch_size = None, test_callback = None):
+        accumulator = None, report_test_scores=True, test_batch_size = None, test_callback = None, stopping_policy = None,
+        checkpoint_name = None, checkpoint_predictor = None):
     """
     Train an online predictor and return the LearningCurveData.
 
@@ -159,10 +244,32 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
     :param report_test_scores: Print out the test scores as they're computed (T/F)
     :param test_callback: A callback which takes the predictor, and is called every time a test
         is done.  This can be useful for plotting/debugging the state.
-    :return: LearningCurveData containing the score on the test sets
+    :param stopping_policy: A stopping policy or list of stopping policies (see utils.benchmarks.stopping_policies),
+        which are checked after each test.  If any says to stop, training ends there, and the reason is recorded (see
+        LearningCurveData.get_stop_reason).
+    :param checkpoint_name: If not None, and this is called within an experiment, the learning curve so far is
+        checkpointed under this name (see fileman.experiment_record.save_experiment_checkpoint) after each test, along
+        with the state of the predictor if checkpoint_predictor is given.  When the experiment is resumed, training
+        continues from the last checkpoint.  (Accumulator states are not checkpointed.)
+    :param checkpoint_predictor: How to save the state of the predictor with each checkpoint:
+        None: Don't.  The checkpoint just shows the learning curve so far, and a resumed run starts over.
+        'params': Save its parameters with plato.interfaces.param_serialzation.dumps_params (for IParameterized predictors)
+        'pickle': Pickle the whole predictor.
+    :return: LearningCurveData containing the score on the test sets.  At each test, this also records the time spent
+        training so far (not counting time spent testing) and the number of samples seen (see get_training_clock).
     """
 
     record = LearningCurveData()
+    training_time = 0.
+    n_tests_done = 0
+
+    checkpoint = load_experiment_checkpoint(checkpoint_name) if checkpoint_name is not None else None
+    if checkpoint is not None and checkpoint_predictor is not None:
+        record, training_time, n_tests_done = checkpoint['record'], checkpoint['training_time'], checkpoint['n_tests']
+        predictor = _load_predictor_state(predictor, checkpoint['predictor'], checkpoint_predictor)
+        print 'Resuming from checkpoint after %s tests.' % (n_tests_done, )
+        if record.get_stop_reason() is not None or n_tests_done == len(test_epochs):
+            return record
 
     testing_sets = dataset_to_testing_sets(dataset, test_on)
     if accumulator is None:
@@ -177,41 +284,96 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
     if isinstance(evaluation_function, str):
         evaluation_function = get_evaluation_function(evaluation_function)
 
-    def do_test(current_epoch):
+    stopping_policies = \
+        [] if stopping_policy is None else \
+        stopping_policy if isinstance(stopping_policy, (list, tuple)) else \
+        [stopping_policy]
+
+    def do_test(current_epoch, n_samples_seen):
+        """
+        Test the predictor, and return True if it's time to stop training.
+        """
+        record.add_training_clock(training_time, n_samples_seen)
         scores = [(k, evaluation_function(process_in_batches(prediction_functions[k], x, test_batch_size), y)) for k, (x, y) in testing_sets.iteritems()]
         if report_test_scores:
             print 'Scores at Epoch %s: %s' % (current_epoch, ', '.join('%s: %.3f' % (set_name, score) for set_name, score in scores))
         record.add(current_epoch, scores)
         if test_callback is not None:
             record.add(current_epoch, ('callback', test_callback(predictor)))
+        for policy in stopping_policies:
+            stop_reason = policy(record)
+            if stop_reason is not None:
+                print 'Stopping at Epoch %s: %s' % (current_epoch, stop_reason)
+                record.set_stop_reason(stop_reason)
+                break
+        if checkpoint_name is not None:
+            save_experiment_checkpoint(**{checkpoint_name: dict(record = record, training_time = training_time,
+                n_tests = len(record.get_training_clock()[0]),
+                predictor = _get_predictor_state(predictor, checkpoint_predictor) if checkpoint_predictor is not None else None)})
+        return record.get_stop_reason() is not None
 
     if minibatch_size == 'stretch':
         test_samples = (np.array(test_epochs) * dataset.training_set.n_samples).astype(int)
         i=0
         if test_samples[0] == 0:
-            do_test(i)
+            if n_tests_done == 0 and do_test(i, 0):
+                return record
             i += 1
         for indices in checkpoint_minibatch_index_generator(n_samples=dataset.training_set.n_samples, checkpoints=test_samples, slice_when_possible=True):
+            if i < n_tests_done:  # Already done before resuming
+                i += 1
+                continue
+            start_time = time.time()
             predictor.train(dataset.training_set.input[indices], dataset.training_set.target[indices])
-            do_test(test_epochs[i])
+            training_time += time.time() - start_time
+            if do_test(test_epochs[i], test_samples[i]):
+                break
             i += 1
     else:
-        checker = CheckPointCounter(test_epochs)
-        last_n_samples_seen = 0
-        for (n_samples_seen, input_minibatch, target_minibatch) in \
-                dataset.training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = float('inf'), single_channel = True):
-            current_epoch = (float(last_n_samples_seen))/dataset.training_set.n_samples
-            last_n_samples_seen = n_samples_seen
-            time_for_a_test, done = checker.check(current_epoch)
-            if time_for_a_test:
-                do_test(current_epoch)
-            if done:
+        # Work out in advance which steps to test on, so that we can train in a tight loop between tests.
+        n_samples = dataset.training_set.n_samples
+        true_minibatch_size = n_samples if minibatch_size == 'full' else minibatch_size
+        test_steps, _ = get_checkpoint_steps(test_epochs, step_size = true_minibatch_size, unit_size = n_samples)
+        step = test_steps[n_tests_done-1] if n_tests_done > 0 else 0
+        for test_step in test_steps[n_tests_done:]:
+            if test_step > step:
+                start_time = time.time()
+                for ixs in _minibatch_indices(n_samples, true_minibatch_size, start_step = step, stop_step = test_step):
+                    predictor.train(dataset.training_set.input[ixs], dataset.training_set.target[ixs])
+                training_time += time.time() - start_time
+                step = test_step
+            if do_test(float(step*true_minibatch_size)/n_samples, step*true_minibatch_size):
                 break
-            predictor.train(input_minibatch, target_minibatch)
 
     return record
 
 
+def _get_predictor_state(predictor, method):
+    return dumps_params(predictor) if method == 'params' else pickle.dumps(predictor, protocol = 2) if method == 'pickle' else bad_value(method)
+
+
+def _load_predictor_state(predictor, state, method):
+    """
+    :return: The predictor, in the given state.  (For 'pickle', this is a new predictor object).
+    """
+    if method == 'params':
+        loads_params(predictor, state)
+        return predictor
+    else:
+        return pickle.loads(state) if method == 'pickle' else bad_value(method)
+
+
+def _minibatch_indices(n_samples, minibatch_size, start_step, stop_step):
+    """
+    Yield indices of the minibatches for training steps start_step to stop_step, looping through the data.  Indices are
+    slices where the minibatch does not wrap around the end of the data.
+    """
+    for start in xrange(start_step*minibatch_size, stop_step*minibatch_size, minibatch_size):
+        offset = start % n_samples
+        yield slice(offset, offset+minibatch_size) if offset+minibatch_size <= n_samples else \
+            np.arange(start, start+minibatch_size) % n_samples
+
+
 def process_in_batches(func, data, batch_size):
     """
     Sometimes a function requires too much internal memory, so you have to process things in batches.
@@ -237,11 +399,20 @@ class LearningCurveData(object):
     A container for the learning curves resulting from running a predictor
     on a dataset.  Use this object to incrementally write results, and then
     retrieve them as a whole.
+
+    Results from several repetitions of the same experiment (e.g. with different seeds) can be combined with
+    from_repetitions.  These are stored in an (n_tests, n_sets, n_reps) array, and can't be added to.
     """
+
+    _score_array = None  # (n_tests, n_sets, n_reps) array of scores, if this was made with from_repetitions.
+    _training_clock = None  # List of (training_time, n_samples_seen) at each test, for online predictors.
+    _stop_reason = None  # Reason for stopping training early, if a stopping policy did so.
+
     def __init__(self):
         self._times = {}
         self._scores = OrderedDict()
         self._latest_score = None
+        self._training_clock = []
 
     def add(self, time, scores):
         """
@@ -250,6 +421,7 @@ class LearningCurveData(object):
             Eg: [('training', 0.104), ('test', 0.119)]
         :return:
         """
+        assert self._score_array is None, "You can't add results to learning curves combined from repetitions."
         if np.isscalar(scores):
             scores = [('Score', scores)]
         elif isinstance(scores, tuple):
@@ -264,14 +436,125 @@ class LearningCurveData(object):
             self._times[k].append(time)
             self._scores[k].append(v)
 
-    def get_results(self):
+    def set_stop_reason(self, reason):
+        """
+        :param reason: A string describing why training was stopped before the last test epoch.
+        """
+        self._stop_reason = reason
+
+    def get_stop_reason(self):
+        """
+        :return: A string describing why training was stopped early, or None if it wasn't.  For results combined from
+            repetitions, a list of these (one per repetition).
+        """
+        return self._stop_reason
+
+    def add_training_clock(self, training_time, n_samples_seen):
         """
+        Record how much training had been done at the time of a test.  Call this once per test.
+        :param training_time: Wall time (in seconds) spent training so far, not including time spent testing.
+        :param n_samples_seen: Number of training samples seen so far.
+        """
+        assert self._score_array is None, "You can't add results to learning curves combined from repetitions."
+        self._training_clock.append((training_time, n_samples_seen))
+
+    def get_training_clock(self):
+        """
+        :return: (training_times, n_samples_seen, samples_per_sec), each a length n_tests vector, where:
+            training_times is the wall time (in seconds) spent training before each test
+            n_samples_seen is the number of training samples seen before each test
+            samples_per_sec is the average training speed up to each test (nan if no training was done yet)
+        """
+        assert self._training_clock is not None and len(self._training_clock) > 0, \
+            'No training clock was recorded.  Only online predictors have one, and only if they were run after it was added.'
+        training_times, n_samples_seen = (np.array(v, dtype = float) for v in zip(*self._training_clock))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            samples_per_sec = np.where(training_times > 0, n_samples_seen / training_times, np.nan)
+        return training_times, n_samples_seen, samples_per_sec
+
+    def get_results(self, x_axis = 'epoch'):
+        """
+        :param x_axis: What to use as the time of each test: 'epoch', 'seconds' (of training) or 'samples' (seen).
         :return: (times, results), where:
             times is a length-N vector indicating the time of each test
             scores is a (length_N, n_scores) array indicating the each score at each time
                 OR a (length_N, n_scores, n_reps) array where n_reps indexes each repetition or the same experiment
         """
-        return {k: np.array(t) for k, t in self._times.iteritems()}, OrderedDict((k, np.array(v)) for k, v in self._scores.iteritems())
+        if self._score_array is not None:
+            times, scores = {k: self._test_times for k in self._set_names}, \
+                OrderedDict((k, self._score_array[:, i, :]) for i, k in enumerate(self._set_names))
+        else:
+            times, scores = {k: np.array(t) for k, t in self._times.iteritems()}, OrderedDict((k, np.array(v)) for k, v in self._scores.iteritems())
+        if x_axis != 'epoch' and not all(np.array_equal(t, [None]) for t in times.values()):  # (Offline results have no time axis)
+            training_times, n_samples_seen, _ = self.get_training_clock()
+            test_times = \
+                training_times if x_axis == 'seconds' else \
+                n_samples_seen if x_axis == 'samples' else \
+                bad_value(x_axis)
+            times = {k: test_times for k in times}
+        return times, scores
+
+    @classmethod
+    def from_repetitions(cls, records):
+        """
+        Combine the learning curves from repetitions of the same experiment.  All repetitions must be tested at the same
+        times on the same sets.  Non-numeric results (such as the outputs of test callbacks) are dropped.  Repetitions
+        that were stopped early (see stopping_policies) have their missing scores filled in with nan.
+        :param records: A list of LearningCurveData objects
+        :return: A LearningCurveData object, where get_scores returns an (n_tests, n_reps) array for each set.
+        """
+        all_times, all_scores = zip(*[r.get_results() for r in records])
+        set_names = [k for k, v in all_scores[0].iteritems() if np.issubdtype(v.dtype, np.number)]
+        test_times = max((times[set_names[0]] for times in all_times), key = len)
+        for times, scores in zip(all_times, all_scores):
+            assert [k for k in scores if k in set_names] == set_names, 'All repetitions must be tested on the same sets.'
+            assert all(np.array_equal(times[k], test_times[:len(times[k])]) for k in set_names), 'All repetitions must be tested at the same times.'
+        pad = lambda x: np.concatenate([np.asarray(x, dtype = float), np.full((len(test_times)-len(x), )+np.shape(x)[1:], np.nan)])
+        combined = cls()
+        combined._set_names = set_names
+        combined._test_times = test_times
+        combined._score_array = np.array([[pad(scores[k]) for k in set_names] for scores in all_scores]).transpose(2, 1, 0)
+        if all(r._training_clock for r in records):  # Average the training clock over repetitions
+            combined._training_clock = [tuple(c) for c in np.nanmean([pad(r._training_clock) for r in records], axis = 0)]
+        if any(r.get_stop_reason() is not None for r in records):
+            combined._stop_reason = [r.get_stop_reason() for r in records]
+        return combined
+
+    @property
+    def n_reps(self):
+        return 1 if self._score_array is None else self._score_array.shape[2]
+
+    def get_score_array(self):
+        """
+        :return: (times, set_names, scores), where:
+            times is a length n_tests vector indicating the time of each test
+            set_names is a list of the names of the n_sets sets that were tested on
+            scores is an (n_tests, n_sets, n_reps) array of scores
+        """
+        if self._score_array is not None:
+            return self._test_times, self._set_names, self._score_array
+        times, scores = self.get_results()
+        set_names = scores.keys()
+        return times[set_names[0]], set_names, np.array([scores[k] for k in set_names], dtype = float).T[:, :, None]
+
+    def get_mean_and_confidence_interval(self, which_test_set = None, confidence = 0.95):
+        """
+        Get the mean score over repetitions, and a confidence interval for the mean (based on the t-distribution).
+        :param which_test_set: Which test set to get scores for (can be None if there's only one)
+        :param confidence: The confidence level of the interval
+        :return: (mean, lower, upper): Each is an (n_tests, ) array.  Where there's only one repetition, lower=upper=mean.
+            Repetitions which were stopped before a test are left out of the statistics for that test.
+        """
+        scores = np.asarray(self.get_scores(which_test_set), dtype = float)
+        if scores.ndim == 1:
+            scores = scores[:, None]
+        if scores.shape[1] == 1:
+            return scores[:, 0], scores[:, 0], scores[:, 0]
+        n_reps = np.sum(~np.isnan(scores), axis = 1)
+        mean = np.nanmean(scores, axis = 1)
+        std = np.sqrt(np.nansum((scores - mean[:, None])**2, axis = 1) / np.maximum(n_reps-1, 1))
+        half_width = np.where(n_reps > 1, stats.t.ppf((1+confidence)/2., np.maximum(n_reps-1, 1)) * std / np.sqrt(n_reps), 0)
+        return mean, mean - half_width, mean + half_width
 
     def get_scores(self, which_test_set = None):
         """
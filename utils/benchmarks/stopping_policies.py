@@ -0,0 +1,120 @@
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+Policies for stopping the training of an online predictor before its last test point.
+
+A stopping policy is a callable which is given the LearningCurveData after each test, and returns None to keep going or
+a string explaining why training should stop.  Policies don't keep any state of their own (everything they need is in
+the LearningCurveData), so one policy object can be shared between all the predictors in a comparison.
+
+e.g.
+    compare_predictors(..., stopping_policy = [TargetScore(99, set_name = 'Test'), Patience(5), Divergence()])
+"""
+
+
+class IStoppingPolicy(object):
+
+    def __call__(self, record):
+        """
+        :param record: The LearningCurveData so far
+        :return: None if training should continue, otherwise a string describing why it should stop.
+        """
+        raise NotImplementedError()
+
+
+class Patience(IStoppingPolicy):
+    """
+    Stop when the score has not improved on its best value for a given number of tests.
+    """
+
+    def __init__(self, n_tests, set_name = 'Test', higher_is_better = True, min_improvement = 0):
+        """
+        :param n_tests: Number of tests without improvement to tolerate
+        :param set_name: Which test set's score to watch
+        :param higher_is_better: True if higher scores are better (e.g. percent correct), False if lower is better (e.g. mse)
+        :param min_improvement: An improvement has to beat the previous best score by more than this.
+        """
+        self.n_tests = n_tests
+        self.set_name = set_name
+        self.higher_is_better = higher_is_better
+        self.min_improvement = min_improvement
+
+    def __call__(self, record):
+        scores = np.asarray(record.get_scores(self.set_name), dtype = float) * (1 if self.higher_is_better else -1)
+        if len(scores) <= self.n_tests:
+            return None
+        best_before = np.max(scores[:-self.n_tests])
+        if np.max(scores[-self.n_tests:]) <= best_before + self.min_improvement:
+            return '%s score has not improved in %s tests' % (self.set_name, self.n_tests)
+        return None
+
+
+class TargetScore(IStoppingPolicy):
+    """
+    Stop when the score reaches a target.
+    """
+
+    def __init__(self, target, set_name = 'Test', higher_is_better = True):
+        """
+        :param target: The score to reach
+        :param set_name: Which test set's score to watch
+        :param higher_is_better: True if we're waiting for the score to rise to the target, False if to fall to it.
+        """
+        self.target = target
+        self.set_name = set_name
+        self.higher_is_better = higher_is_better
+
+    def __call__(self, record):
+        score = record.get_scores(self.set_name)[-1]
+        if (score >= self.target) if self.higher_is_better else (score <= self.target):
+            return '%s score %s reached target of %s' % (self.set_name, score, self.target)
+        return None
+
+
+class Divergence(IStoppingPolicy):
+    """
+    Stop when a score becomes nan or infinite, or goes past a limit.
+    """
+
+    def __init__(self, set_names = None, limit = None, higher_is_better = True):
+        """
+        :param set_names: Names of the sets whose scores to watch, or None to watch all of them.
+        :param limit: Optionally, stop if a score gets worse than this (e.g. below 0 percent correct, or above some mse)
+        :param higher_is_better: True if higher scores are better, False if lower is better.
+        """
+        self.set_names = set_names
+        self.limit = limit
+        self.higher_is_better = higher_is_better
+
+    def __call__(self, record):
+        _, scores = record.get_results()
+        for set_name in (self.set_names if self.set_names is not None else scores.keys()):
+            if not np.issubdtype(scores[set_name].dtype, np.number):
+                continue  # e.g. callback outputs
+            score = scores[set_name][-1]
+            if not np.all(np.isfinite(score)):
+                return '%s score diverged to %s' % (set_name, score)
+            if self.limit is not None and ((score < self.limit) if self.higher_is_better else (score > self.limit)):
+                return '%s score %s went past limit of %s' % (set_name, score, self.limit)
+        return None
+
+
+class TimeBudget(IStoppingPolicy):
+    """
+    Stop when the training time exceeds a budget.  Only time spent training counts (see
+    LearningCurveData.get_training_clock), so the budget is the same whether or not you test often.
+    """
+
+    def __init__(self, seconds):
+        """
+        :param seconds: Maximum number of seconds to spend training
+        """
+        self.seconds = seconds
+
+    def __call__(self, record):
+        training_times, _, _ = record.get_training_clock()
+        if training_times[-1] >= self.seconds:
+            return 'Training time of %.3gs exceeded budget of %.3gs' % (training_times[-1], self.seconds)
+        return None
@@ -1,6 +1,9 @@
+from fileman.experiment_record import Experiment, delete_experiment
+from general.checkpoint_counter import CheckPointCounter
 from sklearn.svm import SVC
-from utils.benchmarks.predictor_comparison import compare_predictors, assess_online_predictor
+from utils.benchmarks.predictor_comparison import compare_predictors, assess_online_predictor, compare_predictors_over_seeds
 from utils.benchmarks.plot_learning_curves import plot_learning_curves
+from utils.benchmarks.train_and_test import get_evaluation_function
 from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
 from utils.predictors.i_predictor import IPredictor
 from utils.predictors.perceptron import Perceptron
@@ -78,6 +81,186 @@ def test_stretch_minibatches():
     assert np.array_equal(p1_trained_out, p2_trained_out)
 
 
+def test_training_clock(hang_plot = False):
+
+    dataset = get_synthetic_clusters_dataset()
+    n_training = dataset.training_set.n_samples
+    predictor = Perceptron(alpha = 0.1, w = .1*np.random.RandomState(45).randn(dataset.input_shape[0], dataset.n_categories)).to_categorical()
+
+    for minibatch_size in (10, 'stretch'):
+        record = assess_online_predictor(predictor, dataset, evaluation_function='percent_correct', test_epochs=[0, .5, 1],
+            minibatch_size=minibatch_size, test_on = 'training+test')
+        training_times, n_samples_seen, samples_per_sec = record.get_training_clock()
+        assert np.array_equal(n_samples_seen, [0, n_training/2, n_training])
+        assert training_times[0] == 0 and 0 < training_times[1] <= training_times[2]
+        assert np.isnan(samples_per_sec[0]) and np.all(samples_per_sec[1:] > 0)
+        times, scores = record.get_results(x_axis = 'seconds')
+        assert np.array_equal(times['Test'], training_times) and len(scores['Test']) == 3
+        assert np.array_equal(record.get_results(x_axis = 'samples')[0]['Training'], n_samples_seen)
+
+    plot_learning_curves({'perceptron': record}, x_axis = 'seconds', xscale = 'linear', hang = hang_plot)
+
+
+def test_parallel_compare_predictors():
+
+    dataset = get_synthetic_clusters_dataset()
+
+    def get_records(n_processes):
+        w_constructor = lambda rng = np.random.RandomState(45): .1*rng.randn(dataset.input_shape[0], dataset.n_categories)
+        return compare_predictors(
+            dataset = dataset,
+            offline_predictors={'SVM': SVC()},
+            online_predictors={
+                'fast-perceptron': Perceptron(alpha = 0.1, w = w_constructor()).to_categorical(),
+                'slow-perceptron': Perceptron(alpha = 0.001, w = w_constructor()).to_categorical()
+                },
+            minibatch_size = 10,
+            test_epochs = sqrtspace(0, 10, 20),
+            evaluation_function='percent_correct',
+            n_processes = n_processes
+            )
+
+    serial_records = get_records(n_processes=1)
+    parallel_records = get_records(n_processes=2)
+    assert parallel_records.keys() == serial_records.keys() == ['SVM', 'fast-perceptron', 'slow-perceptron']
+    for k in serial_records:
+        assert np.array_equal(parallel_records[k].get_scores('Test'), serial_records[k].get_scores('Test'))
+
+
+def test_compare_predictors_over_seeds(hang_plot = False):
+
+    dataset = get_synthetic_clusters_dataset()
+
+    w_constructor = lambda seed: .1*np.random.RandomState(seed).randn(dataset.input_shape[0], dataset.n_categories)
+    records = compare_predictors_over_seeds(
+        dataset = dataset,
+        offline_predictors={'SVM': lambda seed: SVC()},
+        online_predictors={'slow-perceptron': lambda seed: Perceptron(alpha = 0.001, w = w_constructor(seed)).to_categorical()},
+        seeds = [1, 2, 3],
+        minibatch_size = 10,
+        test_epochs = sqrtspace(0, 10, 20),
+        evaluation_function='percent_correct'
+        )
+    assert records.keys() == ['SVM', 'slow-perceptron']
+    assert records['slow-perceptron'].n_reps == 3
+    times, set_names, scores = records['slow-perceptron'].get_score_array()
+    assert sorted(set_names) == ['Test', 'Training'] and scores.shape == (20, 2, 3)
+    assert not np.array_equal(scores[0, :, 0], scores[0, :, 1])  # Different seeds give different initial scores
+    mean, lower, upper = records['slow-perceptron'].get_mean_and_confidence_interval('Test')
+    assert mean.shape == lower.shape == upper.shape == (20, )
+    assert np.all(lower <= mean) and np.all(mean <= upper) and np.any(lower < upper)
+    assert 95 < mean[-1] <= 100
+    assert 99 < records['SVM'].get_mean_and_confidence_interval('Test')[0][0] <= 100
+
+    plot_learning_curves(records, hang = hang_plot)
+
+
+def _assess_with_checkpoint_counter(predictor, dataset, test_epochs, minibatch_size, evaluation_function):
+    """
+    The test loop that assess_online_predictor used before test steps were precomputed: step through the minibatches,
+    and ask a CheckPointCounter before each one whether it's time to test.
+    :return: A list of (epoch, n_samples_seen, test_score) at each test
+    """
+    tests = []
+    checker = CheckPointCounter(test_epochs)
+    last_n_samples_seen = 0
+    for (n_samples_seen, input_minibatch, target_minibatch) in \
+            dataset.training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = float('inf'), single_channel = True):
+        current_epoch = (float(last_n_samples_seen))/dataset.training_set.n_samples
+        time_for_a_test, done = checker.check(current_epoch)
+        if time_for_a_test:
+            tests.append((current_epoch, last_n_samples_seen, evaluation_function(predictor.predict(dataset.test_set.input), dataset.test_set.target)))
+        if done:
+            break
+        last_n_samples_seen = n_samples_seen
+        predictor.train(input_minibatch, target_minibatch)
+    return tests
+
+
+def test_test_points_match_checkpoint_counter():
+    """
+    Precomputing the test steps should give exactly the learning curves we got by checking a CheckPointCounter on every
+    training step.
+    """
+    dataset = get_synthetic_clusters_dataset()
+    evaluation_function = get_evaluation_function('percent_correct')
+    get_predictor = lambda: Perceptron(alpha = 0.01, w = .1*np.random.RandomState(45).randn(dataset.input_shape[0], dataset.n_categories)).to_categorical(n_categories = dataset.n_categories)
+    for test_epochs in [sqrtspace(0, 3, 13), [0.05, 0.1, 0.1, 1./3, 0.35, 2.5]]:
+        for minibatch_size in [1, 7, 10, 'full']:
+            old_tests = _assess_with_checkpoint_counter(get_predictor(), dataset, test_epochs, minibatch_size, evaluation_function)
+            record = assess_online_predictor(predictor = get_predictor(), dataset = dataset, evaluation_function = evaluation_function,
+                test_epochs = test_epochs, minibatch_size = minibatch_size, test_on = 'test', report_test_scores = False)
+            old_epochs, old_n_samples, old_scores = zip(*old_tests)
+            times, scores = record.get_results()
+            assert np.allclose(times['Test'], old_epochs), (test_epochs, minibatch_size)
+            assert np.array_equal(record.get_training_clock()[1], old_n_samples), (test_epochs, minibatch_size)
+            assert np.array_equal(scores['Test'], old_scores), (test_epochs, minibatch_size)
+
+
+class _CrashingPredictor(IPredictor):
+    """
+    Wraps a predictor, and crashes on a given number of training calls.
+    """
+    crash_on_call = None  # A class attribute, so that it isn't saved when the predictor is pickled
+    n_calls_made = []
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.n_train_calls = 0
+
+    def train(self, x, y):
+        self.n_train_calls += 1
+        _CrashingPredictor.n_calls_made.append(self.n_train_calls)
+        if self.n_train_calls == _CrashingPredictor.crash_on_call:
+            raise Exception('Crash!')
+        self.predictor.train(x, y)
+
+    def predict(self, x):
+        return self.predictor.predict(x)
+
+
+def test_resume_online_predictor():
+
+    dataset = get_synthetic_clusters_dataset()
+    test_epochs = sqrtspace(0, 2, 10)
+    records = []
+
+    def run_predictor():
+        predictor = _CrashingPredictor(Perceptron(alpha = 0.01, w = .1*np.random.RandomState(45).randn(dataset.input_shape[0], dataset.n_categories)).to_categorical())
+        records.append(assess_online_predictor(predictor = predictor, dataset = dataset, evaluation_function = 'percent_correct',
+            test_epochs = test_epochs, minibatch_size = 10, report_test_scores = False, checkpoint_name = 'learning_curve',
+            checkpoint_predictor = 'pickle'))
+
+    run_predictor()
+    uninterrupted_record = records[-1]  # Outside of an experiment, nothing is checkpointed
+    n_calls_uninterrupted = len(_CrashingPredictor.n_calls_made)
+
+    _CrashingPredictor.n_calls_made = []
+    _CrashingPredictor.crash_on_call = n_calls_uninterrupted // 2
+    exp = Experiment(function = run_predictor, name = 'test_resume_online_predictor')
+    try:
+        exp.run(save_result = True, resume = True)
+        raise AssertionError('Experiment should have crashed')
+    except Exception as err:
+        assert err.message == 'Crash!'
+    _CrashingPredictor.crash_on_call = None
+    _CrashingPredictor.n_calls_made = []
+    exp_rec = exp.run(save_result = True, resume = True)
+
+    # Training continued from the last test before the crash, rather than from the start
+    assert 0 < len(_CrashingPredictor.n_calls_made) < n_calls_uninterrupted
+    assert _CrashingPredictor.n_calls_made[-1] == n_calls_uninterrupted
+    record = records[-1]
+    assert np.array_equal(record.get_scores('Test'), uninterrupted_record.get_scores('Test'))
+    assert np.array_equal(record.get_training_clock()[1], uninterrupted_record.get_training_clock()[1])
+    delete_experiment(exp_rec.get_identifier())
+
+
 if __name__ == '__main__':
     test_compare_predictors(hang_plot=True)
     test_stretch_minibatches()
+    test_training_clock(hang_plot=True)
+    test_parallel_compare_predictors()
+    test_compare_predictors_over_seeds(hang_plot=True)
+    test_test_points_match_checkpoint_counter()
+    test_resume_online_predictor()
@@ -0,0 +1,79 @@
+from utils.benchmarks.predictor_comparison import LearningCurveData, assess_online_predictor, compare_predictors_over_seeds
+from utils.benchmarks.stopping_policies import Patience, TargetScore, Divergence, TimeBudget
+from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
+from utils.predictors.perceptron import Perceptron
+from utils.tools.mymath import sqrtspace
+import numpy as np
+
+__author__ = 'peter'
+
+
+def _make_record(test_scores, training_times = None):
+    record = LearningCurveData()
+    for i, score in enumerate(test_scores):
+        record.add(i, [('Test', score)])
+        record.add_training_clock(training_times[i] if training_times is not None else i, i*10)
+    return record
+
+
+def test_stopping_policies():
+
+    assert Patience(2)(_make_record([1, 2, 3, 3])) is None
+    assert Patience(2)(_make_record([1, 3, 3, 3])) is not None
+    assert Patience(2, higher_is_better=False)(_make_record([3, 2, 2.5, 2.1])) is not None
+    assert Patience(2, min_improvement=0.5)(_make_record([1, 2, 2.1, 2.2])) is not None
+
+    assert TargetScore(90)(_make_record([50, 80])) is None
+    assert TargetScore(90)(_make_record([50, 80, 90])) is not None
+    assert TargetScore(0.1, higher_is_better=False)(_make_record([1, 0.05])) is not None
+
+    assert Divergence()(_make_record([1, 2])) is None
+    assert Divergence()(_make_record([1, np.nan])) is not None
+    assert Divergence()(_make_record([1, np.inf])) is not None
+    assert Divergence(limit = 10, higher_is_better=False)(_make_record([1, 11])) is not None
+
+    assert TimeBudget(5)(_make_record([1, 2], training_times=[0, 4])) is None
+    assert TimeBudget(5)(_make_record([1, 2], training_times=[0, 6])) is not None
+
+
+def test_early_stopping_in_benchmarks():
+
+    dataset = get_synthetic_clusters_dataset()
+    w_constructor = lambda seed: .1*np.random.RandomState(seed).randn(dataset.input_shape[0], dataset.n_categories)
+
+    record = assess_online_predictor(
+        predictor = Perceptron(alpha = 0.1, w = w_constructor(45)).to_categorical(),
+        dataset = dataset,
+        evaluation_function = 'percent_correct',
+        test_epochs = sqrtspace(0, 10, 20),
+        minibatch_size = 10,
+        stopping_policy = [Divergence(), TargetScore(95, set_name = 'Test')]
+        )
+    scores = record.get_scores('Test')
+    assert len(scores) < 20 and scores[-1] >= 95 and np.all(scores[:-1] < 95)
+    assert 'target' in record.get_stop_reason()
+
+    never_done = LearningCurveData()
+    assert never_done.get_stop_reason() is None
+
+    # Repetitions that stop at different times get combined, with missing scores left out of the statistics
+    records = compare_predictors_over_seeds(
+        dataset = dataset,
+        online_predictors = {'perceptron': lambda seed: Perceptron(alpha = 0.1, w = w_constructor(seed)).to_categorical()},
+        seeds = [1, 2, 3],
+        minibatch_size = 10,
+        test_epochs = sqrtspace(0, 10, 20),
+        evaluation_function = 'percent_correct',
+        stopping_policy = TargetScore(95, set_name = 'Test'),
+        )
+    combined = records['perceptron']
+    assert len(combined.get_stop_reason()) == 3
+    times, set_names, score_array = combined.get_score_array()
+    assert score_array.shape[0] < 20
+    mean, lower, upper = combined.get_mean_and_confidence_interval('Test')
+    assert not np.any(np.isnan(mean))
+
+
+if __name__ == '__main__':
+    test_stopping_policies()
+    test_early_stopping_in_benchmarks()
@@ -3,13 +3,14 @@ from general.should_be_builtins import memoize
 
 from utils.datasets.datasets import DataSet, DataCollection
 from fileman.file_getter import get_file, unzip_gz
+from utils.tools.packed_binary import PackedBinaryArray
 
 
 __author__ = 'peter'
 
 
 @memoize  # This should save time on tests and dataset should be immutable so it's all good.
-def get_mnist_dataset(n_training_samples = None, n_test_samples = None, flat = False, binarize = False):
+def get_mnist_dataset(n_training_samples = None, n_test_samples = None, flat = False, binarize = False, packed = False):
     """
     The MNIST DataSet - the Drosophila of machine learning.
 
@@ -17,6 +18,8 @@ def get_mnist_dataset(n_training_samples = None, n_test_samples = None, flat = F
     :param n_test_samples: Cap on the number of test samples
     :param flat: Set to True if we just want flat 784-dimensional input data instead of 28x28 images.
     :param binarize: Binarize inputs by thresholding them at 0.5
+    :param packed: If binarizing, store the inputs as PackedBinaryArrays (8 pixels per byte), which unpack into floats
+        when you index them (e.g. when taking minibatches).
     :return: A DataSet object containing the MNIST data
     """
     filename = get_file(
@@ -38,5 +41,9 @@ def get_mnist_dataset(n_training_samples = None, n_test_samples = None, flat = F
         x_tr = x_tr>0.5
         x_ts = x_ts>0.5
         x_vd = x_vd>0.5
+        if packed:
+            x_tr, x_ts, x_vd = [(PackedBinaryArray.from_array(x, dtype = float), ) for x in (x_tr, x_ts, x_vd)]
+    else:
+        assert not packed, 'Only binarized data can be packed'
 
     return DataSet(training_set=DataCollection(x_tr, y_tr), test_set=DataCollection(x_ts, y_ts), validation_set=DataCollection(x_vd, y_vd))
@@ -0,0 +1,103 @@
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+Compact storage for binary data: 8 binary values per byte, instead of one per float (which takes 32-64x the memory).
+Data is kept packed, and unpacked when it's needed for computation.
+
+e.g.
+    data = PackedBinaryArray.from_array(binary_images)  # (n_samples, 28, 28) binary array -> 98 bytes per sample
+    for minibatch in minibatch_iterate(data, minibatch_size = 20):  # Minibatches come out unpacked, as floats
+        train(minibatch)
+"""
+
+# Number of 1-bits in each byte value
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in xrange(256)], dtype = np.uint8)
+
+
+def pack_bits(x):
+    """
+    :param x: A (..., n_dims) array of binary (bool, or 0/1) values
+    :return: A (..., ceil(n_dims/8)) uint8 array with the bits packed along the last axis.
+    """
+    return np.packbits(np.asarray(x, dtype = bool), axis = -1)
+
+
+def unpack_bits(packed, n_dims, dtype = bool):
+    """
+    :param packed: A (..., n_bytes) uint8 array of packed bits
+    :param n_dims: The number of bits to unpack along the last axis (the last byte may be padded)
+    :param dtype: The dtype to unpack into
+    :return: A (..., n_dims) array of binary values
+    """
+    return np.unpackbits(packed, axis = -1)[..., :n_dims].astype(dtype)
+
+
+def packed_hamming_distance(a, b, block_size = 256):
+    """
+    Hamming distance between every pair of rows of two packed binary arrays, computed by looking up the bit-counts of
+    their XOR.  We go through a in blocks, so the largest temporary is (block_size, n_b, n_bytes) bytes.
+
+    :param a: An (n_a, n_bytes) packed array, or a PackedBinaryArray
+    :param b: An (n_b, n_bytes) packed array, or a PackedBinaryArray
+    :param block_size: Number of rows of a to compare at a time
+    :return: An (n_a, n_b) integer array of the number of bits at which the rows differ.
+    """
+    a = a.packed if isinstance(a, PackedBinaryArray) else a
+    b = b.packed if isinstance(b, PackedBinaryArray) else b
+    assert a.ndim == b.ndim == 2 and a.shape[1] == b.shape[1]
+    distances = np.empty((len(a), len(b)), dtype = int)
+    for start in xrange(0, len(a), block_size):
+        differing_bits = np.bitwise_xor(a[start:start+block_size, None, :], b[None, :, :])
+        distances[start:start+block_size] = np.sum(_POPCOUNT_TABLE[differing_bits], axis = -1)
+    return distances
+
+
+class PackedBinaryArray(object):
+    """
+    An array of binary samples, stored with 8 values per byte.  Indexing it (along the samples axis) returns unpacked
+    samples, so it can stand in for the unpacked array wherever minibatches are pulled out of a dataset.
+    """
+
+    def __init__(self, packed, sample_shape, dtype = float):
+        """
+        :param packed: An (n_samples, n_bytes) uint8 array of packed bits
+        :param sample_shape: The shape of each unpacked sample
+        :param dtype: The dtype to unpack into
+        """
+        assert packed.dtype == np.uint8 and packed.ndim == 2
+        self.packed = packed
+        self.sample_shape = tuple(sample_shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_array(cls, x, dtype = None):
+        """
+        :param x: An (n_samples, ...) array of binary values
+        :param dtype: The dtype to unpack into (defaults to x's dtype)
+        """
+        return cls(pack_bits(x.reshape(len(x), -1)), sample_shape = x.shape[1:], dtype = x.dtype if dtype is None else dtype)
+
+    @property
+    def shape(self):
+        return (len(self.packed), ) + self.sample_shape
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        """
+        :param index: An index, slice, or array of indices into the samples
+        :return: The unpacked samples
+        """
+        rows = self.packed[index]
+        n_dims = int(np.prod(self.sample_shape))
+        return unpack_bits(rows, n_dims, dtype = self.dtype).reshape(rows.shape[:-1] + self.sample_shape)
+
+    def unpack(self):
+        return self[:]
@@ -0,0 +1,104 @@
+from multiprocessing import Pool, Queue, cpu_count
+from threading import Thread
+import sys
+
+__author__ = 'peter'
+
+"""
+Run functions in parallel worker processes.
+
+Workers are forked from the current process, so the functions do not need to be picklable, and any data they refer to
+(e.g. a big dataset) is shared with the workers through copy-on-write memory, rather than being pickled and sent to each
+one.  Only the return values are pickled (and sent back).  This relies on the "fork" method of starting processes, so it
+only works on Unix.
+"""
+
+_FORKED_JOBS = None
+
+
+def forked_imap(functions, n_processes = None, log_prefixes = None):
+    """
+    Call each of a list of functions in a pool of forked worker processes, and yield their return values, in order, as
+    they become available.
+
+    :param functions: A list of functions taking no arguments.  Return values must be picklable.
+    :param n_processes: Number of worker processes (None to use one per CPU)
+    :param log_prefixes: Optionally, a list of strings, one per function.  If provided, everything that the function
+        prints is sent back and printed by this process, with the prefix prepended to each line, so that output from
+        different workers can be told apart.
+    :return: A generator of return values, in the same order as functions.
+    """
+    global _FORKED_JOBS
+    assert _FORKED_JOBS is None, "forked_imap can't be nested."
+    if len(functions) == 0:
+        return
+    if n_processes is None:
+        n_processes = cpu_count()
+    assert log_prefixes is None or len(log_prefixes) == len(functions)
+
+    log_queue = Queue() if log_prefixes is not None else None
+    _FORKED_JOBS = [(f, log_queue, None if log_prefixes is None else log_prefixes[i]) for i, f in enumerate(functions)]
+    sys.stdout.flush()
+    pool = Pool(processes = min(n_processes, len(functions)))
+    if log_queue is not None:
+        printer = Thread(target = _print_from_queue, args = (log_queue, ))
+        printer.daemon = True
+        printer.start()
+    completed = False
+    try:
+        for result in pool.imap(_call_forked_job, range(len(functions))):
+            yield result
+        completed = True
+    finally:
+        if completed:
+            pool.close()  # Lets the workers exit cleanly, so that all their logs get sent.
+        else:
+            pool.terminate()
+        pool.join()
+        _FORKED_JOBS = None
+        if log_queue is not None:
+            log_queue.put(None)
+            printer.join()
+
+
+def _call_forked_job(index):
+    fcn, log_queue, prefix = _FORKED_JOBS[index]
+    if log_queue is None:
+        return fcn()
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = _QueueWriter(log_queue, prefix)
+    try:
+        return fcn()
+    finally:
+        sys.stdout.flush()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+
+def _print_from_queue(log_queue):
+    while True:
+        line = log_queue.get()
+        if line is None:
+            break
+        sys.stdout.write(line)
+
+
+class _QueueWriter(object):
+    """
+    A file-like object that sends prefixed lines to a queue.
+    """
+
+    def __init__(self, queue, prefix):
+        self._queue = queue
+        self._prefix = prefix
+        self._partial_line = ''
+
+    def write(self, message):
+        lines = (self._partial_line + message).split('\n')
+        for line in lines[:-1]:
+            self._queue.put('%s%s\n' % (self._prefix, line))
+        self._partial_line = lines[-1]
+
+    def flush(self):
+        if self._partial_line != '':
+            self._queue.put('%s%s\n' % (self._prefix, self._partial_line))
+            self._partial_line = ''
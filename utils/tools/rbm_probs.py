@@ -1,8 +1,9 @@
 from general.numpy_helpers import get_rng
-from general.mymath import sigm, binary_permutations, cummean
+from general.mymath import sigm, cummean
 import numpy as np
 from sklearn.svm.classes import LinearSVC
 from utils.benchmarks.train_and_test import percent_correct
+from utils.tools.packed_binary import PackedBinaryArray, packed_hamming_distance
 
 __author__ = 'peter'
 
@@ -28,9 +29,11 @@ def logcummeanexp(x, axis):
     """
     A more numerically stable version of:
     np.log(cummean(np.exp(x), axis))
-    # TODO: Actually make this numerically stable.
     """
-    return np.log(cummean(np.exp(x), axis))
+    x = np.asarray(x, dtype = float)
+    counts_shape = [1]*x.ndim
+    counts_shape[axis] = x.shape[axis]
+    return np.logaddexp.accumulate(x, axis = axis) - np.log(np.arange(1, x.shape[axis]+1).reshape(counts_shape))
 
 
 def logdiffexp(x, axis = None):
@@ -42,84 +45,172 @@ def logdiffexp(x, axis = None):
     return alpha + np.log(np.diff(np.exp(x-alpha), axis = axis))
 
 
-def estimate_log_z(w, b_h, b_v, annealing_ratios, n_runs = 10, rng = None):
+def _softplus(x):
+    return np.logaddexp(0, x)
+
+
+def _ais_unnormalized_log_prob(visible, beta, w, b_h, b_v, base_b_v):
+    """
+    Log of the unnormalized marginal probability of visible vectors under the AIS intermediate distribution at inverse
+    temperature beta, which interpolates between the base-rate model (beta=0) and the RBM (beta=1)
+    """
+    return (1-beta)*visible.dot(base_b_v) + beta*visible.dot(b_v) + np.sum(_softplus(beta*(visible.dot(w)+b_h)), axis = -1)
+
+
+def estimate_log_z(w, b_h, b_v, annealing_ratios, n_runs = 10, base_b_v = None, use_theano = False, rng = None):
     """
     Use Annealed importance sampling
     http://www.iro.umontreal.ca/~lisa/pointeurs/breuleux+bengio_nc2011.pdf
     To estimate the probability of the test data given the RBM parameters.
 
-    This code is a Pythonified version of Russ Salakhutdinov's Matlab code:
-    http://www.utstat.toronto.edu/~rsalakhu/code_AIS/RBM_AIS.m
-
-    NOTE: THIS CODE DOES NOT SEEM TO BE PRODUCING GOOD RESULTS (They don't match with exact numbers.  Not sure why!)
-    Better option: Use the rbm_ais method from pylearn2 (from pylearn2.rbm_tools import rbm_ais)
+    We anneal from a base-rate model (an RBM with no weights and visible biases base_b_v) to the target RBM, following
+    Salakhutdinov & Murray (2008): "On the Quantitative Analysis of Deep Belief Networks".  All n_runs chains are run
+    together as one (n_runs, n_visible) array, so the python loop is only over the annealing steps (and with
+    use_theano, there is no python loop at all: the annealing is a scan in a compiled Plato function).
 
     :param w: Weights (n_visible, n_hidden)
     :param b_h: Hidden biases (n_hidden)
     :param b_v: Visible biases (n_visible)
     :param annealing_ratios: A monotonically increasing vector from 0 to 1
     :param n_runs: Number of annealing chains to use.
+    :param base_b_v: Visible biases of the base-rate model.  Defaults to zeros.  Setting them to the log-odds of the
+        data's pixel means gives a base model closer to the target, and so a lower-variance estimate.
+    :param use_theano: Run the annealing in a compiled theano function instead of numpy.
     :param rng: Random Number generator
-    :return:
+    :return: log_z, (log_z_upper, log_z_lower), where the bounds are the estimate +/- 3 standard deviations
     """
     assert annealing_ratios[0]==0 and annealing_ratios[-1]==1 and np.all(np.diff(annealing_ratios)>0)
     rng = get_rng(rng)
     n_visible, n_hidden = w.shape
-    visbiases_base = np.zeros_like(b_v)
-    neg_data = rng.rand(n_runs, n_visible) < sigm(visbiases_base)  # Collect
-    logww = - neg_data.dot(visbiases_base) - n_hidden*np.log(2)
-    w_h = neg_data.dot(w)+b_h
-    bv_base = neg_data.dot(visbiases_base)
-    bee_vee = bv_base
-    for t, r in enumerate(annealing_ratios):
-        exp_wh = np.exp(r*w_h)
-        logww += (1-r)*bv_base + r*bee_vee + np.sum(np.log(1+exp_wh), axis =1)
-        wake_hid_probs = exp_wh/(1+exp_wh)
-        wake_hid_states = wake_hid_probs > rng.rand(*wake_hid_probs.shape)
-        neg_vis_probs = sigm((1-r)*visbiases_base + r*(wake_hid_states.dot(w.T)+b_v))
-        neg_vis_states = neg_vis_probs > rng.rand(*neg_vis_probs.shape)
-
-        w_h = neg_vis_states.dot(w)+b_h
-        bv_base = neg_vis_states.dot(visbiases_base)
-        bee_vee = neg_vis_states.dot(b_v)
-
-        exp_wh = np.exp(r*w_h)
-        logww -= (1-r)*bv_base + r*bee_vee + np.sum(np.log(1+exp_wh), axis = 1)
-
-    exp_wh = np.exp(w_h)
-    logww += neg_data.dot(b_v) + np.sum(np.log(1+exp_wh), axis = 1)
-
-    np.mean(logww)
-    r_ais = logsumexp(logww) - np.log(n_runs)
-    log_z_base = np.sum(np.log(1+np.exp(visbiases_base))) + n_hidden*np.log(2)
+    base_b_v = np.zeros_like(b_v) if base_b_v is None else base_b_v
+    initial_visible = (rng.rand(n_runs, n_visible) < sigm(base_b_v)).astype(float)
+
+    if use_theano:
+        compiled_ais, theano_rng = _get_compiled_ais()
+        theano_rng.seed(rng.randint(1e9))
+        log_weights = compiled_ais(w, b_h, b_v, base_b_v, np.asarray(annealing_ratios, dtype = float), initial_visible)
+    else:
+        log_weights = np.zeros(n_runs)
+        visible = initial_visible
+        for beta_prev, beta in zip(annealing_ratios[:-1], annealing_ratios[1:]):
+            log_weights += _ais_unnormalized_log_prob(visible, beta, w, b_h, b_v, base_b_v) - _ais_unnormalized_log_prob(visible, beta_prev, w, b_h, b_v, base_b_v)
+            hidden = rng.rand(n_runs, n_hidden) < sigm(beta*(visible.dot(w)+b_h))
+            visible = (rng.rand(n_runs, n_visible) < sigm((1-beta)*base_b_v + beta*(hidden.dot(w.T)+b_v))).astype(float)
+
+    log_z_base = np.sum(_softplus(base_b_v)) + n_hidden*np.log(2)
+    r_ais = logmeanexp(log_weights, axis = 0)
     log_z_est = r_ais + log_z_base
-    aa = np.mean(logww)
-    logstd_AIS = np.log(np.std(np.exp(logww-aa))) + aa - np.log(n_runs)/2
+    aa = np.mean(log_weights)
+    logstd_AIS = np.log(np.std(np.exp(log_weights-aa))) + aa - np.log(n_runs)/2
     logZZ_est_up = logsumexp([np.log(3)+logstd_AIS, r_ais], axis = 0) + log_z_base
     logZZ_est_down = logdiffexp([(np.log(3)+logstd_AIS), r_ais], axis = 0) + log_z_base
     return log_z_est, (logZZ_est_up, logZZ_est_down)
 
 
-def compute_exact_log_z(w, b_h, b_v):
+_COMPILED_AIS = {}
+
+
+def _get_compiled_ais():
+    """
+    Return a compiled Plato function computing the AIS log-weights for all chains, with the annealing steps done in a
+    theano scan, and the theano random number generator it uses (so that it can be re-seeded).  These are cached, since
+    the function doesn't depend on the sizes of the arguments.
+    """
+    if 'ais' not in _COMPILED_AIS:
+        from plato.core import symbolic_simple, add_update
+        from plato.interfaces.helpers import get_theano_rng
+        import theano
+        import theano.tensor as tt
+        theano_rng = get_theano_rng(None)
+
+        def log_prob(visible, beta, w, b_h, b_v, base_b_v):
+            return (1-beta)*visible.dot(base_b_v) + beta*visible.dot(b_v) + tt.sum(tt.nnet.softplus(beta*(visible.dot(w)+b_h)), axis = 1)
+
+        @symbolic_simple
+        def ais_log_weights(w, b_h, b_v, base_b_v, annealing_ratios, initial_visible):
+
+            def anneal_step(beta_prev, beta, visible, log_weights):
+                log_weights = log_weights + log_prob(visible, beta, w, b_h, b_v, base_b_v) - log_prob(visible, beta_prev, w, b_h, b_v, base_b_v)
+                hidden_probs = tt.nnet.sigmoid(beta*(visible.dot(w)+b_h))
+                hidden = theano_rng.binomial(p = hidden_probs, size = hidden_probs.shape, dtype = visible.dtype)
+                visible_probs = tt.nnet.sigmoid((1-beta)*base_b_v + beta*(hidden.dot(w.T)+b_v))
+                visible = theano_rng.binomial(p = visible_probs, size = visible_probs.shape, dtype = visible.dtype)
+                return visible, log_weights
+
+            (_, log_weights), updates = theano.scan(anneal_step, sequences = [annealing_ratios[:-1], annealing_ratios[1:]],
+                outputs_info = [initial_visible, tt.zeros_like(initial_visible[:, 0])])
+            for shared_var, new_val in updates.items():  # Random number generator states
+                add_update(shared_var, new_val)
+            return log_weights[-1]
+
+        _COMPILED_AIS['ais'] = ais_log_weights.compile(add_test_values = False), theano_rng
+    return _COMPILED_AIS['ais']
+
+
+def compute_exact_log_z(w, b_h, b_v, chunk_size = 2**12, n_processes = 1):
     """
-    Compute the exact partition of an RBM.  Taken from:
+    Compute the exact partition of an RBM.  Adapted from:
     http://www.utstat.toronto.edu/~rsalakhu/code_AIS/calculate_true_partition.m
-    Computation scales with 2**n_hidden, so don't use this with over ~25 hidden units!
+
+    We sum over all states of the smaller layer, enumerating them in chunks of chunk_size states so that memory stays
+    bounded.  Computation still scales with 2**min(n_visible, n_hidden), so ~30 units is about the practical limit.  The
+    states can be split into a few contiguous ranges per process, between several processes.
 
     :param w: Weights (n_visible, n_hidden)
     :param b_h: Hidden biases (n_hidden)
     :param b_v: Visible biases (n_visible)
+    :param chunk_size: Number of states to enumerate at a time
+    :param n_processes: Number of (forked) processes to split the chunks between
     :return: A scalar indicating the exact Partition.
     """
     n_visible, n_hidden = w.shape
+    # Sum over the smaller layer: the RBM is symmetric, so we can swap visible and hidden
+    w, b_enumerated, b_summed = (w.T, b_v, b_h) if n_visible < n_hidden else (w, b_h, b_v)
+    n_enumerated = len(b_enumerated)
+    assert n_enumerated <= 40, 'Too big! Enumerating 2**%s states would take forever.' % (n_enumerated, )
+    n_states = 2**n_enumerated
+    if n_processes == 1:
+        return _log_z_of_range(w, b_enumerated, b_summed, 0, n_states, chunk_size)
+    else:
+        # A few contiguous ranges of states per process, each enumerated chunk by chunk within its worker.
+        from utils.tools.parallel import forked_imap
+        ranges = _split_states(n_states, chunk_size, n_ranges = 4*n_processes)
+        range_log_zs = list(forked_imap([lambda start=start, stop=stop: _log_z_of_range(w, b_enumerated, b_summed, start, stop, chunk_size)
+            for start, stop in ranges], n_processes = n_processes))
+        return logsumexp(np.array(range_log_zs), axis = 0)
+
+
+def _split_states(n_states, chunk_size, n_ranges):
+    """
+    :return: A list of at most n_ranges (start, stop) pairs which cover [0, n_states), with boundaries on multiples of
+        chunk_size.
+    """
+    n_chunks = (n_states + chunk_size - 1) // chunk_size
+    n_ranges = min(n_ranges, n_chunks)
+    boundaries = [min(n_states, (i*n_chunks//n_ranges)*chunk_size) for i in xrange(n_ranges+1)]
+    return zip(boundaries[:-1], boundaries[1:])
 
-    assert n_hidden < 26, 'Too big!'
-    all_hidden = binary_permutations(n_hidden)  # 2**n_hidden * n_hidden
-    log_prob_vv = all_hidden.dot(b_h) + np.sum(np.log(1+np.exp(all_hidden.dot(w.T)+b_v)), axis = 1)  #
-    log_z = logsumexp(log_prob_vv, axis = 0)
+
+def _log_z_of_range(w, b_enumerated, b_summed, start, stop, chunk_size):
+    """
+    :return: The log of the sum of unnormalized probabilities of the enumerated-layer states with indices in
+        [start, stop), which are enumerated chunk_size at a time.
+    """
+    log_z = -np.inf
+    for chunk_start in xrange(start, stop, chunk_size):
+        log_z = np.logaddexp(log_z, _log_z_of_chunk(w, b_enumerated, b_summed, chunk_start, min(chunk_start+chunk_size, stop)))
     return log_z
 
 
+def _log_z_of_chunk(w, b_enumerated, b_summed, start, stop):
+    """
+    :return: The log of the sum of unnormalized probabilities of the enumerated-layer states with indices in [start, stop)
+    """
+    states = (np.arange(start, stop)[:, None] >> np.arange(len(b_enumerated)-1, -1, -1)) & 1
+    log_probs = states.dot(b_enumerated) + np.sum(_softplus(states.dot(w.T)+b_summed), axis = 1)
+    return logsumexp(log_probs, axis = 0)
+
+
 def log_prob_data(w, b_h, b_v, log_z, data):
     """
     Given RBM parameters and the partition (log_z), compute the log-probability of the data.
@@ -154,15 +245,47 @@ def get_svm_score(w, b_h, dataset):
     return score
 
 
-def count_equal_elements(model_samples, test_samples, axis = -1):
+def count_equal_elements(model_samples, test_samples, axis = -1, block_size = 256):
     """
-    :param model_samples: (..., n_model_samples, n_dims) data
-    :param test_samples: (n_test_samples, n_dims) test data
+    Count the elements that are equal between every test sample and every model sample.  For binary data this is
+    n_dims minus the Hamming distance, which we get from a matrix product (x.y + (1-x).(1-y) = n_dims - |x| - |y| + 2x.y)
+    so that no (n_test_samples, n_model_samples, n_dims) temporary is ever created.  Other data is compared elementwise,
+    block_size test samples at a time.
+
+    :param model_samples: (..., n_model_samples, n_dims) data, or a PackedBinaryArray of samples
+    :param test_samples: (n_test_samples, n_dims) or (..., n_test_samples, n_dims) test data, or a PackedBinaryArray
+    :param axis: The dimension axis (must be the last one)
+    :param block_size: Number of test samples to compare at a time.
     :return: A (..., n_test_samples, n_model_samples) array containing the counts of equal elements.
     """
-    assert model_samples.shape[axis] == test_samples.shape[axis]
-    n_equal_elements = np.sum(test_samples[..., :, None, :] == model_samples[..., None, :, :], axis = axis)
-    return n_equal_elements, model_samples.shape[axis] - n_equal_elements
+    if isinstance(model_samples, PackedBinaryArray) and isinstance(test_samples, PackedBinaryArray):
+        # Packed binary samples: equal elements are the dims minus the hamming distance, which we count on the bytes.
+        n_dims = int(np.prod(model_samples.sample_shape))
+        n_equal_elements = n_dims - packed_hamming_distance(test_samples, model_samples, block_size = block_size)
+        return n_equal_elements, n_dims - n_equal_elements
+    assert axis in (-1, model_samples.ndim-1), 'The dimension axis must be the last one'
+    assert model_samples.shape[-1] == test_samples.shape[-1]
+    n_dims = model_samples.shape[-1]
+    n_test_samples = test_samples.shape[-2]
+    binary = _is_binary(model_samples) and _is_binary(test_samples)
+    if binary:
+        model_samples_t = np.swapaxes(model_samples, -1, -2).astype(np.float32)  # Float32 products are exact up to 2**24 dims
+        model_counts = np.sum(model_samples_t, axis = -2, keepdims=True)
+    leading_shape = np.broadcast(np.empty(model_samples.shape[:-2]), np.empty(test_samples.shape[:-2])).shape
+    n_equal_elements = np.empty(leading_shape + (n_test_samples, model_samples.shape[-2]), dtype = int)
+    for start in xrange(0, n_test_samples, block_size):
+        block = test_samples[..., start:start+block_size, :]
+        if binary:
+            block = block.astype(np.float32)
+            n_equal_block = n_dims - np.sum(block, axis=-1, keepdims=True) - model_counts + 2*np.matmul(block, model_samples_t)
+            n_equal_elements[..., start:start+block_size, :] = np.round(n_equal_block)
+        else:
+            n_equal_elements[..., start:start+block_size, :] = np.sum(block[..., :, None, :] == model_samples[..., None, :, :], axis = -1)
+    return n_equal_elements, n_dims - n_equal_elements
+
+
+def _is_binary(x):
+    return x.dtype == bool or np.all((x == 0) | (x == 1))
 
 
 def lop_p_given_n_equal(n_equal_elements, n_unequal_elements, beta):
@@ -180,20 +303,26 @@ def lop_p_given_n_equal(n_equal_elements, n_unequal_elements, beta):
     return np.mean(logcummeanexp(probability_per_pair, axis = -1), axis = -2)
 
 
-def log_p_data(x, y, beta):
+def log_p_data(x, y, beta, block_size = 256):
     """
     Given some collection of samples x, and some collection y, and a number beta defining the smoothness of your
     density function, return the average log-probability (per sample) of data y given the samples x.
     :param x: (n_chains, n_data_samples, n_dims) data
     :param y: (n_chains, n_test_sammples, n_dims) test data
     :param beta: The beta parameter (in 0.5...1)
+    :param block_size: Number of test samples to process at a time
     :return: A (n_particles, n_data_samples) vector indicating the avarage log probability of the x data given the density
         function defined by the y data and beta, where lop_p[i, j] is the average log probability of the samples up to the
         j'th sampling step from the i'th chain.
     """
     assert 0<=beta<1
-    n_equal_elements, n_unequal_elements = count_equal_elements(x, y, axis = -1)
-    return lop_p_given_n_equal(n_equal_elements, n_unequal_elements, beta)
+    # Go through the test samples in blocks, so we only hold (n_chains, block_size, n_data_samples) arrays at a time
+    n_test_samples = y.shape[-2]
+    sum_log_p = 0
+    for start in xrange(0, n_test_samples, block_size):
+        n_equal_elements, n_unequal_elements = count_equal_elements(x, y[..., start:start+block_size, :], axis = -1, block_size = block_size)
+        sum_log_p = sum_log_p + lop_p_given_n_equal(n_equal_elements, n_unequal_elements, beta) * n_equal_elements.shape[-2]
+    return sum_log_p / n_test_samples
 
 
 def select_beta(model_samples, n_beta, axis=-1, max_beta_selection_samples = None):
@@ -213,8 +342,10 @@ def select_beta(model_samples, n_beta, axis=-1, max_beta_selection_samples = Non
         sample_ixs = np.linspace(0, model_samples.shape[-2]-1, max_beta_selection_samples).astype(int)
         model_samples = model_samples[:, sample_ixs]
 
-    n_equal_elements, n_unequal_elements = count_equal_elements(model_samples=model_samples[chains, :], test_samples=model_samples[chains[::-1]], axis = axis)  # (n_chains, n_model_samples, n_model_samples)
-    probs_per_beta = [np.sum(lop_p_given_n_equal(n_equal_elements, n_unequal_elements, b)[-1], axis = 0) for b in beta_choices]
+    # Only the last chain's score (given the samples of the first) is used to pick beta, so we only count equal
+    # elements for that pair.  The counts are computed once, and every beta reuses them.
+    n_equal_elements, n_unequal_elements = count_equal_elements(model_samples=model_samples[chains[-1]], test_samples=model_samples[chains[::-1][-1]], axis = axis)  # (n_model_samples, n_model_samples)
+    probs_per_beta = [np.sum(lop_p_given_n_equal(n_equal_elements, n_unequal_elements, b), axis = 0) for b in beta_choices]
     beta_choice = beta_choices[np.argmax(probs_per_beta)]
     if beta_choice in beta_choices[[0, -1]]:
         print "WARNING: A beta on the end was selected (beta = %s).  That's fishy" % (beta_choice, )
@@ -0,0 +1,43 @@
+from utils.tools.iteration import minibatch_iterate
+from utils.tools.packed_binary import pack_bits, unpack_bits, packed_hamming_distance, PackedBinaryArray
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_pack_bits():
+
+    x = np.random.RandomState(1234).rand(5, 3, 13) > 0.5
+    packed = pack_bits(x)
+    assert packed.shape == (5, 3, 2) and packed.dtype == np.uint8
+    assert np.array_equal(unpack_bits(packed, n_dims = 13), x)
+    assert unpack_bits(packed, n_dims = 13, dtype = float).dtype == float
+
+
+def test_packed_binary_array():
+
+    x = np.random.RandomState(1234).rand(50, 7, 9) > 0.5
+    packed = PackedBinaryArray.from_array(x, dtype = float)
+    assert len(packed) == 50 and packed.shape == (50, 7, 9)
+    assert packed.nbytes == 50*8  # 63 bits per sample fit in 8 bytes
+    assert np.array_equal(packed.unpack(), x) and packed.unpack().dtype == float
+    assert np.array_equal(packed[3], x[3])
+    assert np.array_equal(packed[[4, 2]], x[[4, 2]])
+    for packed_minibatch, minibatch in zip(minibatch_iterate(packed, minibatch_size = 15, n_epochs = 2), minibatch_iterate(x, minibatch_size = 15, n_epochs = 2)):
+        assert np.array_equal(packed_minibatch, minibatch)
+
+
+def test_packed_hamming_distance():
+
+    rng = np.random.RandomState(1234)
+    a = rng.rand(30, 50) > 0.5
+    b = rng.rand(20, 50) > 0.5
+    naive_distances = np.sum(a[:, None, :] != b[None, :, :], axis = 2)
+    assert np.array_equal(packed_hamming_distance(pack_bits(a), pack_bits(b)), naive_distances)
+    assert np.array_equal(packed_hamming_distance(PackedBinaryArray.from_array(a), PackedBinaryArray.from_array(b), block_size = 7), naive_distances)
+
+
+if __name__ == '__main__':
+    test_pack_bits()
+    test_packed_binary_array()
+    test_packed_hamming_distance()
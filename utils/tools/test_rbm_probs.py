@@ -1,27 +1,91 @@
-from utils.tools.rbm_probs import estimate_log_z, compute_exact_log_z
+from general.mymath import binary_permutations
+from general.mymath import cummean
+from utils.tools.rbm_probs import estimate_log_z, compute_exact_log_z, logsumexp, count_equal_elements, \
+    logcummeanexp, log_p_data, lop_p_given_n_equal, select_beta, _split_states
+from utils.tools.packed_binary import PackedBinaryArray
 
 __author__ = 'peter'
 import numpy as np
 
 
+def _get_rbm_params(n_visible, n_hidden, mag = 1, seed = 1234):
+    rng = np.random.RandomState(seed)
+    return mag * rng.randn(n_visible, n_hidden), mag * rng.randn(n_hidden), mag * rng.randn(n_visible)
+
+
 def test_partition_estimate():
 
-    seed = 1234
-    mag = 1
-    n_visible = 200
-    n_hidden = 10
+    w, b_h, b_v = _get_rbm_params(n_visible = 200, n_hidden = 10)
+    exact_partition = compute_exact_log_z(w=w, b_v=b_v, b_h = b_h)
+    for use_theano in (False, True):
+        approx_partition, (upper, lower) = estimate_log_z(w=w, b_h=b_h, b_v=b_v, annealing_ratios=np.linspace(0, 1, 1000),
+            n_runs = 100, use_theano = use_theano, rng = 1234)
+        assert np.allclose(exact_partition, approx_partition, atol = 0, rtol = 0.01)
+        assert upper > approx_partition
 
-    rng = np.random.RandomState(seed)
 
-    b_v = mag * rng.randn(n_visible)
-    b_h = mag * rng.randn(n_hidden)
-    w = mag * rng.randn(n_visible, n_hidden)
+def test_exact_partition():
 
-    exact_partition = compute_exact_log_z(w=w, b_v=b_v, b_h = b_h)
-    approx_partition, (upper, lower) = estimate_log_z(w=w, b_h=b_h, b_v=b_v, annealing_ratios=np.linspace(0, 1, 1000), rng = None)
-    assert np.allclose(exact_partition, approx_partition, atol = 0, rtol = 0.1)  # Very approximate!
+    # Compare against summing over all hidden states at once.
+    for n_visible, n_hidden in [(20, 10), (8, 12)]:
+        w, b_h, b_v = _get_rbm_params(n_visible = n_visible, n_hidden = n_hidden)
+        all_hidden = binary_permutations(n_hidden)
+        naive_log_z = logsumexp(all_hidden.dot(b_h) + np.sum(np.log(1+np.exp(all_hidden.dot(w.T)+b_v)), axis = 1), axis = 0)
+        assert np.allclose(compute_exact_log_z(w=w, b_h=b_h, b_v=b_v), naive_log_z)
+        assert np.allclose(compute_exact_log_z(w=w, b_h=b_h, b_v=b_v, chunk_size = 100), naive_log_z)
+        assert np.allclose(compute_exact_log_z(w=w, b_h=b_h, b_v=b_v, chunk_size = 100, n_processes = 2), naive_log_z)
+
+    # The number of ranges handed out to processes doesn't grow with the number of states
+    for n_states, chunk_size, n_ranges in [(2**40, 2**12, 8), (1000, 100, 8), (1000, 300, 8), (10, 100, 8)]:
+        ranges = _split_states(n_states, chunk_size, n_ranges)
+        assert len(ranges) <= n_ranges
+        assert ranges[0][0] == 0 and ranges[-1][1] == n_states and all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+        assert all(start % chunk_size == 0 and start < stop for start, stop in ranges)
+
+
+def test_count_equal_elements():
+
+    rng = np.random.RandomState(1234)
+    model_samples = rng.rand(3, 40, 50) > 0.5
+    test_samples = rng.rand(30, 50) > 0.5
+    naive_n_equal = np.sum(test_samples[..., :, None, :] == model_samples[..., None, :, :], axis = -1)
+    for model, test in [(model_samples, test_samples), (model_samples.astype(float), test_samples.astype(int))]:
+        for block_size in (7, 256):
+            n_equal, n_unequal = count_equal_elements(model, test, block_size = block_size)
+            assert np.array_equal(n_equal, naive_n_equal)
+            assert np.array_equal(n_unequal, 50 - naive_n_equal)
+
+    n_equal, n_unequal = count_equal_elements(PackedBinaryArray.from_array(model_samples[0]), PackedBinaryArray.from_array(test_samples), block_size = 7)
+    assert np.array_equal(n_equal, naive_n_equal[0]) and np.array_equal(n_unequal, 50 - naive_n_equal[0])
+
+    # Test samples paired with chains, and non-binary data
+    test_samples = rng.randint(3, size = (3, 30, 50))
+    model_samples = rng.randint(3, size = (3, 40, 50))
+    n_equal, _ = count_equal_elements(model_samples, test_samples, block_size = 7)
+    assert np.array_equal(n_equal, np.sum(test_samples[..., :, None, :] == model_samples[..., None, :, :], axis = -1))
+
+
+def test_indirect_sampling_likelihood_pieces():
+
+    x = np.random.RandomState(1234).randn(4, 20)
+    assert np.allclose(logcummeanexp(x, axis = 1), np.log(cummean(np.exp(x), axis = 1)))
+    assert np.allclose(logcummeanexp(x-1000, axis = 1), np.log(cummean(np.exp(x), axis = 1))-1000)
+
+    rng = np.random.RandomState(1235)
+    model_samples = rng.rand(3, 40, 50) > 0.5
+    test_samples = rng.rand(30, 50) > 0.5
+    assert np.allclose(log_p_data(model_samples, test_samples, beta = 0.8, block_size = 7), log_p_data(model_samples, test_samples, beta = 0.8))
+
+    # Beta selection gives the same answer as scoring every beta against all the chains' counts.
+    n_equal, n_unequal = count_equal_elements(model_samples, model_samples[::-1])
+    betas = np.linspace(0.5, 1-.5/20, 20)
+    best_beta = betas[np.argmax([np.sum(lop_p_given_n_equal(n_equal, n_unequal, b)[-1]) for b in betas])]
+    assert select_beta(model_samples, n_beta = 20) == best_beta
 
 
 if __name__ == '__main__':
 
     test_partition_estimate()
+    test_exact_partition()
+    test_count_equal_elements()
+    test_indirect_sampling_likelihood_pieces()